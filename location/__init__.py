@@ -17,21 +17,347 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 __author__ = 'Fenix, Courgette'
-__version__ = '2.0'
+__version__ = '2.1'
 
 import b3
+import b3.cron
 import b3.plugin
 import b3.events
-import math
+import Queue
+import re
+import threading
+import time
+import traceback
 
+from timeit import default_timer
 from b3.functions import getCmd
+from b3.functions import vars2printf
 from ConfigParser import NoOptionError
+from ConfigParser import NoSectionError
+from collections import deque
+from functools import wraps
+from .geo import DISTANCE_MODELS
+from .geo import UNITS
+from .geo import DistanceMatrix
+from .geo import SpatialIndex
+from .history import LocationHistory
+from .metrics import LAG_BUCKETS
+from .metrics import Metrics
+from .metrics import PrometheusExporter
+from .metrics import StatsdExporter
+from .resolver import ClientResolver
+from .shedding import LoadShedder
+from .snapshot import LocationSnapshot
+from .stats import GeoStats
+from .shared import SharedCache
+from .store import LocationStore
+from .strings import STRINGS
+
+
+def _location_getter(attr):
+    """
+    Return a function which retrieves the given attribute from a location object ('--' when not available)
+    """
+    def getter(client, location):
+        value = getattr(location, attr, None) if location else None
+        return value if value else '--'
+    return getter
+
+
+# functions computing message substitution variables out of a client and its location
+MESSAGE_VARIABLES = {
+    'id': lambda client, location: client.id,
+    'name': lambda client, location: client.name,
+    'connections': lambda client, location: client.connections,
+    'country': _location_getter('country'),
+    'city': _location_getter('city'),
+    'region': _location_getter('region'),
+    'cc': _location_getter('cc'),
+    'rc': _location_getter('rc'),
+    'isp': _location_getter('isp'),
+}
+
+
+# team keywords accepted as command targets
+TEAMS = {
+    'red': b3.TEAM_RED,
+    'blue': b3.TEAM_BLUE,
+    'spec': b3.TEAM_SPEC,
+}
+
+
+class MessageTemplate(object):
+    """
+    A message template compiled out of the plugin configuration file: the
+    template is converted into a printf-style format string once, and the
+    variables it actually uses are collected so that only those are computed.
+    """
+    __slots__ = ('text', 'variables')
+
+    def __init__(self, text):
+        """
+        Object constructor.
+        :param text: The message template (using $variable placeholders)
+        """
+        self.text = vars2printf(text).strip()
+        self.variables = tuple((x, MESSAGE_VARIABLES.get(x)) for x in sorted(set(re.findall(r'%\((\w+)\)s', self.text))))
+
+    def render(self, client, location, **kwargs):
+        """
+        Render the template for the given client
+        :param client: The client whose information need to be displayed
+        :param location: The client location
+        :param kwargs: Additional variables (i.e: distance) overriding computed ones
+        :return: str
+        """
+        values = {}
+        for name, getter in self.variables:
+            if name in kwargs:
+                values[name] = kwargs[name]
+            elif getter:
+                values[name] = getter(client, location)
+            else:
+                values[name] = '--'
+        return self.text % values
+
+
+class AnnounceQueue(object):
+    """
+    Collect connect announcements and send them to the server: announcements
+    arriving within the configured window are coalesced into a single line, and
+    lines are never sent more often than the configured rate allows.
+    """
+    def __init__(self, plugin, window=0, rate=0, short=False):
+        """
+        Object constructor.
+        :param plugin: The LocationPlugin instance
+        :param window: The number of seconds announcements are collected for before being sent
+        :param rate: The maximum number of lines sent per second (0 = unlimited)
+        :param short: Whether to announce single clients with the short message
+        """
+        self.plugin = plugin
+        self.window = window
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.short = short
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._last = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, client):
+        """
+        Queue a connect announcement for the given client
+        :param client: The client who connected
+        """
+        with self._lock:
+            self._pending.append(client)
+            if self._timer:
+                return
+            if self.window > 0:
+                self._schedule(self.window)
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Send all the pending announcements in a single line (unless the rate limit requires to wait)
+        """
+        with self._lock:
+            timer, self._timer = self._timer, None
+            if timer and timer is not threading.current_thread():
+                # flushed before the window expired: the scheduled flush is not needed anymore
+                timer.cancel()
+            if not self._pending:
+                return
+            delay = self._last + self.interval - time.time()
+            if delay > 0:
+                self._schedule(delay)
+                return
+            clients = [x for x in self._pending if getattr(x, 'connected', True)]
+            self._pending = []
+            self._last = time.time()
+        if clients:
+            self.plugin.console.say(self.plugin.getAnnounceMessage(clients, self.short))
+
+    def cancel(self):
+        """
+        Discard all the pending announcements
+        """
+        with self._lock:
+            timer, self._timer = self._timer, None
+            self._pending = []
+        if timer:
+            timer.cancel()
+            if timer is not threading.current_thread():
+                timer.join()
+
+    def _schedule(self, delay):
+        """
+        Schedule a flush of the queue in the given number of seconds (must be called holding the lock)
+        """
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+
+class WorkerPool(object):
+    """
+    Execute plugin tasks on a set of worker threads so that the B3 event
+    dispatch thread is not kept busy while messages are rendered and sent.
+    Tasks are stored in a bounded queue: when the queue is full the configured
+    policy decides whether to drop the new task, drop the oldest one or block.
+    """
+    POLICIES = ('drop', 'oldest', 'block')
+
+    def __init__(self, plugin, workers, size=100, policy='drop'):
+        """
+        Object constructor.
+        :param plugin: The LocationPlugin instance
+        :param workers: The number of worker threads
+        :param size: The maximum number of pending tasks
+        :param policy: What to do when the queue is full (drop, oldest, block)
+        """
+        self.plugin = plugin
+        self.workers = workers
+        self.policy = policy
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._run, name='location-worker-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue a task for execution
+        :param func: The function to execute
+        :return: True if the task has been queued, False if it has been dropped
+        """
+        task = (func, args, kwargs, default_timer())
+        try:
+            self.queue.put_nowait(task)
+            return True
+        except Queue.Full:
+            if self.policy == 'block':
+                self.queue.put(task)
+                return True
+            self.dropped += 1
+            if self.policy == 'oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except Queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(task)
+                    self.plugin.warning('worker queue is full: dropped oldest pending task')
+                    return True
+                except Queue.Full:
+                    pass
+            self.plugin.warning('worker queue is full: dropped task %s' % getattr(func, '__name__', func))
+            return False
+
+    def join(self):
+        """
+        Block until all the queued tasks have been processed
+        """
+        self.queue.join()
+
+    def stop(self, timeout=5):
+        """
+        Process all the pending tasks and stop the worker threads
+        :param timeout: The maximum number of seconds to wait for each worker thread
+        """
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        """
+        Worker thread main loop
+        """
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                func, args, kwargs, queued = task
+                if self.plugin._metrics is not None:
+                    self.plugin._metrics.observe('location_worker_wait_seconds', default_timer() - queued)
+                func(*args, **kwargs)
+            except Exception, e:
+                self.plugin.error('unhandled exception in worker thread: %s\n%s' % (e, traceback.format_exc()))
+            finally:
+                self.queue.task_done()
 
 
 class LocationPlugin(b3.plugin.Plugin):
     
     _adminPlugin = None
     _announce = True
+    _announce_window = 0
+    _announce_rate = 0
+    _announcer = None
+    _load_shedding = False
+    _shed_queue_size = 10
+    _shed_lag = 3
+    _shed_window = 10
+    _shed_recovery = 30
+    _shedder = None
+    _shed_announcer = None
+    _shed_cron = None
+    _backlog = None
+    _workers = 0
+    _queue_size = 100
+    _queue_policy = 'drop'
+    _pool = None
+    _cache_file = ''
+    _cache_ttl = 7
+    _cache_flush = 10
+    _store = None
+    _store_cron = None
+    _store_errors = 3
+    _stored = None
+    _missed = None
+    _missed_ttl = 5
+    _shared_cache = ''
+    _shared_cache_size = 10000
+    _shared = None
+    _history_file = ''
+    _history_flush = 10
+    _history_max_age = 90
+    _history_max_entries = 100
+    _history = None
+    _history_cron = None
+    _matrix = None
+    _index = None
+    _snapshots = None
+    _distance_model = 'haversine'
+    _query_distance_model = 'haversine'
+    _distance_unit = 'km'
+    _stats = None
+    _lock = None
+    _templates = None
+    _resolver = None
+    _metrics = None
+    _command = None
+    _metrics_exporter = 'none'
+    _metrics_target = ''
+    _metrics_interval = 15
+    _exporter = None
+    _exporter_cron = None
 
     # plugin won't start w/o dependencies being satisfied
     requiresPlugins = ['geolocation']
@@ -55,17 +381,343 @@ class LocationPlugin(b3.plugin.Plugin):
             self.error('could not load settings/announce config value: %s' % e)
             self.debug('using default value (%s) for settings/announce' % self._announce)
 
+        try:
+            value = self.config.getfloat('settings', 'announce_window')
+            if value < 0:
+                raise ValueError('announce_window must be a positive number')
+            self._announce_window = value
+            self.debug('loaded announce_window setting: %s' % self._announce_window)
+        except NoOptionError:
+            self.warning('could not find settings/announce_window in config file, '
+                         'using default: %s' % self._announce_window)
+        except ValueError, e:
+            self.error('could not load settings/announce_window config value: %s' % e)
+            self.debug('using default value (%s) for settings/announce_window' % self._announce_window)
+
+        try:
+            value = self.config.getfloat('settings', 'announce_rate')
+            if value < 0:
+                raise ValueError('announce_rate must be a positive number')
+            self._announce_rate = value
+            self.debug('loaded announce_rate setting: %s' % self._announce_rate)
+        except NoOptionError:
+            self.warning('could not find settings/announce_rate in config file, using default: %s' % self._announce_rate)
+        except ValueError, e:
+            self.error('could not load settings/announce_rate config value: %s' % e)
+            self.debug('using default value (%s) for settings/announce_rate' % self._announce_rate)
+
+        try:
+            self._load_shedding = self.config.getboolean('settings', 'load_shedding')
+            self.debug('loaded load_shedding setting: %s' % self._load_shedding)
+        except NoOptionError:
+            self.warning('could not find settings/load_shedding in config file, '
+                         'using default: %s' % self._load_shedding)
+        except ValueError, e:
+            self.error('could not load settings/load_shedding config value: %s' % e)
+            self.debug('using default value (%s) for settings/load_shedding' % self._load_shedding)
+
+        try:
+            value = self.config.getint('settings', 'shed_queue_size')
+            if value < 0:
+                raise ValueError('shed_queue_size must be a positive number')
+            self._shed_queue_size = value
+            self.debug('loaded shed_queue_size setting: %s' % self._shed_queue_size)
+        except NoOptionError:
+            self.warning('could not find settings/shed_queue_size in config file, '
+                         'using default: %s' % self._shed_queue_size)
+        except ValueError, e:
+            self.error('could not load settings/shed_queue_size config value: %s' % e)
+            self.debug('using default value (%s) for settings/shed_queue_size' % self._shed_queue_size)
+
+        try:
+            value = self.config.getfloat('settings', 'shed_lag')
+            if value < 0:
+                raise ValueError('shed_lag must be a positive number')
+            self._shed_lag = value
+            self.debug('loaded shed_lag setting: %s' % self._shed_lag)
+        except NoOptionError:
+            self.warning('could not find settings/shed_lag in config file, using default: %s' % self._shed_lag)
+        except ValueError, e:
+            self.error('could not load settings/shed_lag config value: %s' % e)
+            self.debug('using default value (%s) for settings/shed_lag' % self._shed_lag)
+
+        try:
+            value = self.config.getfloat('settings', 'shed_window')
+            if value <= 0:
+                raise ValueError('shed_window must be greater than 0')
+            self._shed_window = value
+            self.debug('loaded shed_window setting: %s' % self._shed_window)
+        except NoOptionError:
+            self.warning('could not find settings/shed_window in config file, using default: %s' % self._shed_window)
+        except ValueError, e:
+            self.error('could not load settings/shed_window config value: %s' % e)
+            self.debug('using default value (%s) for settings/shed_window' % self._shed_window)
+
+        try:
+            value = self.config.getfloat('settings', 'shed_recovery')
+            if value < 0:
+                raise ValueError('shed_recovery must be a positive number')
+            self._shed_recovery = value
+            self.debug('loaded shed_recovery setting: %s' % self._shed_recovery)
+        except NoOptionError:
+            self.warning('could not find settings/shed_recovery in config file, '
+                         'using default: %s' % self._shed_recovery)
+        except ValueError, e:
+            self.error('could not load settings/shed_recovery config value: %s' % e)
+            self.debug('using default value (%s) for settings/shed_recovery' % self._shed_recovery)
+
+        try:
+            value = self.config.getint('settings', 'workers')
+            if value < 0:
+                raise ValueError('workers must be a positive number')
+            self._workers = value
+            self.debug('loaded workers setting: %s' % self._workers)
+        except NoOptionError:
+            self.warning('could not find settings/workers in config file, using default: %s' % self._workers)
+        except ValueError, e:
+            self.error('could not load settings/workers config value: %s' % e)
+            self.debug('using default value (%s) for settings/workers' % self._workers)
+
+        try:
+            value = self.config.getint('settings', 'queue_size')
+            if value < 1:
+                raise ValueError('queue_size must be greater than 0')
+            self._queue_size = value
+            self.debug('loaded queue_size setting: %s' % self._queue_size)
+        except NoOptionError:
+            self.warning('could not find settings/queue_size in config file, using default: %s' % self._queue_size)
+        except ValueError, e:
+            self.error('could not load settings/queue_size config value: %s' % e)
+            self.debug('using default value (%s) for settings/queue_size' % self._queue_size)
+
+        try:
+            value = self.config.get('settings', 'queue_policy').strip().lower()
+            if value not in WorkerPool.POLICIES:
+                raise ValueError('queue_policy must be one of: %s' % ', '.join(WorkerPool.POLICIES))
+            self._queue_policy = value
+            self.debug('loaded queue_policy setting: %s' % self._queue_policy)
+        except NoOptionError:
+            self.warning('could not find settings/queue_policy in config file, using default: %s' % self._queue_policy)
+        except ValueError, e:
+            self.error('could not load settings/queue_policy config value: %s' % e)
+            self.debug('using default value (%s) for settings/queue_policy' % self._queue_policy)
+
+        try:
+            self._cache_file = self.config.get('settings', 'cache_file').strip()
+            self.debug('loaded cache_file setting: %s' % self._cache_file)
+        except NoOptionError:
+            self.warning('could not find settings/cache_file in config file, using default: %s' % self._cache_file)
+
+        try:
+            value = self.config.getfloat('settings', 'cache_ttl')
+            if value <= 0:
+                raise ValueError('cache_ttl must be greater than 0')
+            self._cache_ttl = value
+            self.debug('loaded cache_ttl setting: %s' % self._cache_ttl)
+        except NoOptionError:
+            self.warning('could not find settings/cache_ttl in config file, using default: %s' % self._cache_ttl)
+        except ValueError, e:
+            self.error('could not load settings/cache_ttl config value: %s' % e)
+            self.debug('using default value (%s) for settings/cache_ttl' % self._cache_ttl)
+
+        try:
+            value = self.config.getint('settings', 'cache_flush')
+            if value < 1 or 60 % value:
+                raise ValueError('cache_flush must be a divisor of 60')
+            self._cache_flush = value
+            self.debug('loaded cache_flush setting: %s' % self._cache_flush)
+        except NoOptionError:
+            self.warning('could not find settings/cache_flush in config file, using default: %s' % self._cache_flush)
+        except ValueError, e:
+            self.error('could not load settings/cache_flush config value: %s' % e)
+            self.debug('using default value (%s) for settings/cache_flush' % self._cache_flush)
+
+        try:
+            self._shared_cache = self.config.get('settings', 'shared_cache').strip()
+            self.debug('loaded shared_cache setting: %s' % self._shared_cache)
+        except NoOptionError:
+            self.warning('could not find settings/shared_cache in config file, using default: %s' % self._shared_cache)
+
+        try:
+            value = self.config.getint('settings', 'shared_cache_size')
+            if value <= 0:
+                raise ValueError('shared_cache_size must be greater than 0')
+            self._shared_cache_size = value
+            self.debug('loaded shared_cache_size setting: %s' % self._shared_cache_size)
+        except NoOptionError:
+            self.warning('could not find settings/shared_cache_size in config file, '
+                         'using default: %s' % self._shared_cache_size)
+        except ValueError, e:
+            self.error('could not load settings/shared_cache_size config value: %s' % e)
+            self.debug('using default value (%s) for settings/shared_cache_size' % self._shared_cache_size)
+
+        try:
+            self._history_file = self.config.get('settings', 'history_file').strip()
+            self.debug('loaded history_file setting: %s' % self._history_file)
+        except NoOptionError:
+            self.warning('could not find settings/history_file in config file, using default: %s' % self._history_file)
+
+        try:
+            value = self.config.getint('settings', 'history_flush')
+            if value < 1 or 60 % value:
+                raise ValueError('history_flush must be a divisor of 60')
+            self._history_flush = value
+            self.debug('loaded history_flush setting: %s' % self._history_flush)
+        except NoOptionError:
+            self.warning('could not find settings/history_flush in config file, '
+                         'using default: %s' % self._history_flush)
+        except ValueError, e:
+            self.error('could not load settings/history_flush config value: %s' % e)
+            self.debug('using default value (%s) for settings/history_flush' % self._history_flush)
+
+        try:
+            value = self.config.getfloat('settings', 'history_max_age')
+            if value < 0:
+                raise ValueError('history_max_age must be a positive number')
+            self._history_max_age = value
+            self.debug('loaded history_max_age setting: %s' % self._history_max_age)
+        except NoOptionError:
+            self.warning('could not find settings/history_max_age in config file, '
+                         'using default: %s' % self._history_max_age)
+        except ValueError, e:
+            self.error('could not load settings/history_max_age config value: %s' % e)
+            self.debug('using default value (%s) for settings/history_max_age' % self._history_max_age)
+
+        try:
+            value = self.config.getint('settings', 'history_max_entries')
+            if value < 0:
+                raise ValueError('history_max_entries must be a positive number')
+            self._history_max_entries = value
+            self.debug('loaded history_max_entries setting: %s' % self._history_max_entries)
+        except NoOptionError:
+            self.warning('could not find settings/history_max_entries in config file, '
+                         'using default: %s' % self._history_max_entries)
+        except ValueError, e:
+            self.error('could not load settings/history_max_entries config value: %s' % e)
+            self.debug('using default value (%s) for settings/history_max_entries' % self._history_max_entries)
+
+        try:
+            value = self.config.get('settings', 'metrics_exporter').strip().lower()
+            if value not in ('none', 'prometheus', 'statsd'):
+                raise ValueError('metrics_exporter must be one of: none, prometheus, statsd')
+            self._metrics_exporter = value
+            self.debug('loaded metrics_exporter setting: %s' % self._metrics_exporter)
+        except NoOptionError:
+            self.warning('could not find settings/metrics_exporter in config file, '
+                         'using default: %s' % self._metrics_exporter)
+        except ValueError, e:
+            self.error('could not load settings/metrics_exporter config value: %s' % e)
+            self.debug('using default value (%s) for settings/metrics_exporter' % self._metrics_exporter)
+
+        try:
+            self._metrics_target = self.config.get('settings', 'metrics_target').strip()
+            self.debug('loaded metrics_target setting: %s' % self._metrics_target)
+        except NoOptionError:
+            self.warning('could not find settings/metrics_target in config file, '
+                         'using default: %s' % self._metrics_target)
+
+        try:
+            value = self.config.getint('settings', 'metrics_interval')
+            if value < 1 or 60 % value:
+                raise ValueError('metrics_interval must be a divisor of 60')
+            self._metrics_interval = value
+            self.debug('loaded metrics_interval setting: %s' % self._metrics_interval)
+        except NoOptionError:
+            self.warning('could not find settings/metrics_interval in config file, '
+                         'using default: %s' % self._metrics_interval)
+        except ValueError, e:
+            self.error('could not load settings/metrics_interval config value: %s' % e)
+            self.debug('using default value (%s) for settings/metrics_interval' % self._metrics_interval)
+
+        try:
+            value = self.config.get('settings', 'distance_model').strip().lower()
+            if value not in DISTANCE_MODELS:
+                raise ValueError('distance_model must be one of: %s' % ', '.join(sorted(DISTANCE_MODELS)))
+            self._distance_model = value
+            self.debug('loaded distance_model setting: %s' % self._distance_model)
+        except NoOptionError:
+            self.warning('could not find settings/distance_model in config file, '
+                         'using default: %s' % self._distance_model)
+        except ValueError, e:
+            self.error('could not load settings/distance_model config value: %s' % e)
+            self.debug('using default value (%s) for settings/distance_model' % self._distance_model)
+
+        try:
+            value = self.config.get('settings', 'query_distance_model').strip().lower()
+            if value not in DISTANCE_MODELS:
+                raise ValueError('query_distance_model must be one of: %s' % ', '.join(sorted(DISTANCE_MODELS)))
+            self._query_distance_model = value
+            self.debug('loaded query_distance_model setting: %s' % self._query_distance_model)
+        except NoOptionError:
+            self.warning('could not find settings/query_distance_model in config file, '
+                         'using default: %s' % self._query_distance_model)
+        except ValueError, e:
+            self.error('could not load settings/query_distance_model config value: %s' % e)
+            self.debug('using default value (%s) for settings/query_distance_model' % self._query_distance_model)
+
+        try:
+            value = self.config.get('settings', 'distance_unit').strip().lower()
+            if value not in UNITS:
+                raise ValueError('distance_unit must be one of: %s' % ', '.join(sorted(UNITS)))
+            self._distance_unit = value
+            self.debug('loaded distance_unit setting: %s' % self._distance_unit)
+        except NoOptionError:
+            self.warning('could not find settings/distance_unit in config file, '
+                         'using default: %s' % self._distance_unit)
+        except ValueError, e:
+            self.error('could not load settings/distance_unit config value: %s' % e)
+            self.debug('using default value (%s) for settings/distance_unit' % self._distance_unit)
+
+        if self._index is not None:
+            self._index.distance = DISTANCE_MODELS[self._query_distance_model]
+
+        self.openStore()
+        self.openSharedCache()
+        self.openHistory()
+        self.openExporter()
+
+        if self._announcer is not None:
+            self._announcer.cancel()
+        self._announcer = AnnounceQueue(self, self._announce_window, self._announce_rate)
+        self.openLoadShedder()
+
+        self.stopWorkers()
+        self.startWorkers()
+
         self._default_messages = {
             'client_connect': '^7$name ^3from ^7$city ^3(^7$country^3) connected',
+            'client_connect_many': '^7$count ^3players connected from ^7$countries',
+            'client_connect_short': '^7$name ^3(^7$cc^3)',
             'cmd_locate': '^7$name ^3is connected from ^7$city ^3(^7$country^3)',
             'cmd_locate_failed': '^7Could not locate ^1$name',
-            'cmd_distance': '^7$name ^3is ^7$distance ^3km away from you',
+            'cmd_distance': '^7$name ^3is ^7$distance ^3$unit away from you',
             'cmd_distance_self': '^7Sorry, I\'m not that smart...meh!',
             'cmd_distance_failed': '^7Could not compute distance with ^1$name',
             'cmd_isp': '^7$name ^3is using ^7$isp ^3as isp',
             'cmd_isp_failed': '^7Could not determine ^1$name ^7isp',
+            'cmd_nearest': '^7$name ^3is the nearest player: ^7$distance ^3$unit away from you',
+            'cmd_nearest_failed': '^7Could not find any player near you',
+            'cmd_farthest': '^7$name ^3is the farthest player: ^7$distance ^3$unit away from you',
+            'cmd_farthest_failed': '^7Could not find any player far from you',
+            'cmd_nearby': '^3Players within ^7$distance ^3$unit: ^7$players',
+            'cmd_nearby_failed': '^7Could not find any player within ^1$distance ^7$unit from you',
+            'cmd_geostats': '^7$count ^3players from ^7$countries ^3| average distance: ^7$average ^3$unit | '
+                            'median distance: ^7$median ^3$unit',
+            'cmd_geostats_failed': '^7No geolocation data available',
+            'cmd_lochistory': '^7$name ^3locations: ^7$history',
+            'cmd_lochistory_failed': '^7No location history for ^1$name',
         }
 
+        self._templates = {}
+        for name in self._default_messages:
+            try:
+                text = self.config.get('messages', name, True)
+            except (NoSectionError, NoOptionError):
+                self.warning('could not find messages/%s in config file, using default: %s' % (name, self._default_messages[name]))
+                text = self._default_messages[name]
+            self._templates[name] = MessageTemplate(text)
+            self.debug('loaded message template %s: %s' % (name, self._templates[name].text))
+
     def onStartup(self):
         """
         Initialize plugin settings.
@@ -83,11 +735,35 @@ class LocationPlugin(b3.plugin.Plugin):
                     cmd, alias = sp
                 func = getCmd(self, cmd)
                 if func:
-                    self._adminPlugin.registerCommand(self, cmd, level, func, alias)
+                    self._adminPlugin.registerCommand(self, cmd, level, self.deferred(func), alias)
+
+        # store coordinates of clients which have been geolocated already: location updates happen on the
+        # event thread, worker threads and the announce timers, so they are serialized with a lock
+        self._lock = threading.RLock()
+        self._matrix = DistanceMatrix()
+        self._index = SpatialIndex(distance=DISTANCE_MODELS[self._query_distance_model])
+        self._snapshots = {}
+        self._stored = {}
+        self._missed = {}
+        self._stats = GeoStats()
+        self._metrics = Metrics()
+        self._command = threading.local()
+        self._resolver = ClientResolver(self.console.clients)
+        for client in self.console.clients.getList():
+            self.updateClientLocation(client)
+
+        # remove expired locations from the persistent store every hour
+        self.console.cron + b3.cron.PluginCronTab(self, self.evictStore, 0, 0, '*')
 
         # register events needed
         self.registerEvent(self.console.getEventID('EVT_CLIENT_GEOLOCATION_SUCCESS'), self.onGeolocalization)
+        self.registerEvent(self.console.getEventID('EVT_CLIENT_DISCONNECT'), self.onDisconnect)
+        self.registerEvent(self.console.getEventID('EVT_CLIENT_CONNECT'), self.onRosterChange)
+        self.registerEvent(self.console.getEventID('EVT_CLIENT_AUTH'), self.onRosterChange)
+        self.registerEvent(self.console.getEventID('EVT_CLIENT_NAME_CHANGE'), self.onRosterChange)
         self.registerEvent(self.console.getEventID('EVT_PLUGIN_DISABLED'), self.onPluginDisable)
+        self.registerEvent(self.console.getEventID('EVT_STOP'), self.onStop)
+        self.registerEvent(self.console.getEventID('EVT_EXIT'), self.onStop)
 
         # notice plugin started
         self.debug('plugin started')
@@ -106,13 +782,71 @@ class LocationPlugin(b3.plugin.Plugin):
             plugin = self.console.getPlugin(req)
             if not plugin.isEnabled():
                 plugin.enable()
+        self.startWorkers()
 
     def onGeolocalization(self, event):
         """
         Handle EVT_CLIENT_GEOLOCATION_SUCCESS
         """
-        if self._announce and event.client.location and self.console.upTime() > 300:
-            self.console.say(self.getMessage('client_connect', self.getMessageVariables(event.client)))
+        # B3 timestamps events with 1 second resolution
+        lag = max(0.0, time.time() - event.time)
+        self._metrics.observe('location_event_lag_seconds', lag, LAG_BUCKETS)
+        level = self.sampleLoad(lag)
+        with self._metrics.timer('location_event_seconds', event='geolocation_success'):
+            self._stored.pop(event.client.cid, None)
+            self._missed.pop(event.client.cid, None)
+            self.updateClientLocation(event.client)
+            if self._store is not None and event.client.location:
+                self.dispatch(self.storeLocation, event.client)
+            if self._shared is not None and event.client.location:
+                self.dispatch(self.shareLocation, event.client)
+            if self._history is not None and event.client.location:
+                self.dispatch(self.recordLocation, event.client)
+            if self._announce and event.client.location and self.console.upTime() > 300:
+                if level >= LoadShedder.CRITICAL:
+                    self._metrics.increment('location_shed_total', action='skip_announce')
+                else:
+                    self.dispatch(self.announce, event.client)
+
+    def onDisconnect(self, event):
+        """
+        Handle EVT_CLIENT_DISCONNECT
+        """
+        with self._metrics.timer('location_event_seconds', event='client_disconnect'):
+            self._resolver.invalidate()
+            cid = event.client.cid if event.client else event.data
+            with self._lock:
+                self._snapshots.pop(cid, None)
+                self._stored.pop(cid, None)
+                self._missed.pop(cid, None)
+                self._stats.remove(cid, self._matrix.distances(cid))
+                self._matrix.remove(cid)
+                self._index.remove(cid)
+
+    def onRosterChange(self, event):
+        """
+        Handle EVT_CLIENT_CONNECT, EVT_CLIENT_AUTH and EVT_CLIENT_NAME_CHANGE
+        """
+        self._resolver.invalidate()
+
+    def onDisable(self):
+        """
+        Discard pending announcements and drain the worker queue when the plugin is disabled.
+        """
+        if self._announcer is not None:
+            self._announcer.cancel()
+        if self._shed_announcer is not None:
+            self._shed_announcer.cancel()
+        self.stopWorkers()
+        self.flushStore()
+        self.flushHistory()
+
+    def onStop(self, event):
+        """
+        Handle EVT_STOP and EVT_EXIT: B3 does not disable plugins when shutting down, so buffered locations and
+        history records must be written here
+        """
+        self.onDisable()
 
     def onPluginDisable(self, event):
         """
@@ -128,56 +862,741 @@ class LocationPlugin(b3.plugin.Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
-    @staticmethod
-    def getMessageVariables(client):
+    def getMessageVariables(self, client):
         """
         Return a dictionary with message substitution variables
         :param client: The client whose geolocation information we need to display
         :return: dict
         """
-        return {
-            'id': client.id,
-            'name': client.name,
-            'connections': client.connections,
-            'country': '--' if not client.location or not client.location.country else client.location.country,
-            'city': '--' if not client.location or not client.location.city else client.location.city,
-            'region': '--' if not client.location or not client.location.region else client.location.region,
-            'cc': '--' if not client.location or not client.location.cc else client.location.cc,
-            'rc': '--' if not client.location or not client.location.rc else client.location.rc,
-            'isp': '--' if not client.location or not client.location.isp else client.location.isp,
-        }
+        location = self.getSnapshot(client)
+        return dict((name, getter(client, location)) for name, getter in MESSAGE_VARIABLES.iteritems())
+
+    def renderMessage(self, name, client, **kwargs):
+        """
+        Render the given message template for the given client
+        :param name: The message name
+        :param client: The client whose geolocation information we need to display
+        :param kwargs: Additional message variables (i.e: distance)
+        :return: str
+        """
+        outcomes = getattr(self._command, 'outcomes', None)
+        if outcomes is not None and name.startswith('cmd_'):
+            # collected for the command being executed by this thread (i.e: cmd_locate_failed -> failed)
+            outcomes.append(name[4:].partition('_')[2] or 'ok')
+        kwargs.setdefault('unit', self._distance_unit)
+        return self._templates[name].render(client, self.getSnapshot(client), **kwargs)
+
+    def openStore(self):
+        """
+        Open the persistent location store (if enabled in the configuration file) and schedule the periodic flush
+        """
+        if self._store_cron is not None:
+            self.console.cron - self._store_cron
+            self._store_cron = None
+        if self._store is not None:
+            try:
+                self._store.close()
+            except Exception, e:
+                self.error('could not close persistent location store: %s' % e)
+            self._store = None
+        if self._cache_file:
+            path = self._cache_file if self._cache_file == ':memory:' else b3.getAbsolutePath(self._cache_file)
+            try:
+                # the database is opened on first use and expired records are evicted by the hourly cron
+                self._store = LocationStore(path, self._cache_ttl * 86400)
+                self.debug('using persistent location store: %s' % path)
+            except Exception, e:
+                self.error('could not open persistent location store %s: %s' % (path, e))
+            else:
+                second = '*/%s' % self._cache_flush if self._cache_flush < 60 else 0
+                self._store_cron = b3.cron.PluginCronTab(self, self.flushStore, second)
+                self.console.cron + self._store_cron
+
+    def flushStore(self):
+        """
+        Write the buffered locations to the persistent store
+        """
+        store = self._store
+        if store is not None:
+            try:
+                store.flush()
+            except Exception, e:
+                self.error('could not write persistent location store: %s' % e)
+                self.checkStore(store)
+
+    def storeLocation(self, client):
+        """
+        Save the location of the given client in the persistent store
+        :param client: The client who has been geolocated
+        """
+        store = self._store
+        if store is None:
+            return
+        try:
+            store.put(client.guid, client.ip, client.location)
+        except Exception, e:
+            self.warning('could not write persistent location store: %s' % e)
+            self.checkStore(store)
+
+    def checkStore(self, store):
+        """
+        Disable the persistent store after repeated write failures
+        :param store: The store which could not be written
+        """
+        with self._lock:
+            if store.errors < self._store_errors or self._store is not store:
+                return
+            self._store = None
+            if self._store_cron is not None:
+                self.console.cron - self._store_cron
+                self._store_cron = None
+        self.error('persistent location store disabled after %s consecutive write failures' % store.errors)
+        try:
+            store.close()
+        except Exception:
+            pass
+
+    def openSharedCache(self):
+        """
+        Open the location cache shared with the other B3 instances running on this host (if enabled)
+        """
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+        if self._shared_cache:
+            path = b3.getAbsolutePath(self._shared_cache)
+            try:
+                # the socket is opened on first use
+                self._shared = SharedCache(path, self._cache_ttl * 86400, self._shared_cache_size)
+            except Exception, e:
+                self.error('could not open shared location cache (disabled): %s' % e)
+            else:
+                self.debug('using shared location cache: %s' % path)
+
+    def shareLocation(self, client):
+        """
+        Publish the location of the given client to the other B3 instances running on this host
+        :param client: The client who has been geolocated
+        """
+        try:
+            self._shared.put(client.guid, client.ip, client.location)
+        except Exception, e:
+            self._metrics.increment('location_shared_cache_total', outcome='error')
+            self.error('could not write shared location cache: %s' % e)
+
+    def openLoadShedder(self):
+        """
+        Create the load shedder (if enabled in the configuration file) and schedule the periodic load check
+        """
+        if self._shed_cron is not None:
+            self.console.cron - self._shed_cron
+            self._shed_cron = None
+        if self._shed_announcer is not None:
+            self._shed_announcer.cancel()
+            self._shed_announcer = None
+        self._shedder = None
+        if self._load_shedding:
+            self._shedder = LoadShedder(self._shed_queue_size, self._shed_lag, self._shed_recovery)
+            self._shed_announcer = AnnounceQueue(self, max(self._announce_window, self._shed_window),
+                                                 self._announce_rate, short=True)
+            if self._backlog is None:
+                self._backlog = deque(maxlen=100)
+            self._shed_cron = b3.cron.PluginCronTab(self, self.sampleLoad, '*/5')
+            self.console.cron + self._shed_cron
+        elif self._backlog:
+            self.flushBacklog()
+
+    def getEventQueueSize(self):
+        """
+        Return the number of events waiting in the B3 event queue
+        """
+        queue = getattr(self.console, 'queue', None)
+        return queue.qsize() if queue is not None else 0
+
+    def getShedQueueSize(self):
+        """
+        Return the B3 event queue size above which load shedding kicks in: the configured value is capped to half
+        the event queue capacity, so that critical mode (twice the threshold) is reached before the queue is full
+        """
+        queue = getattr(self.console, 'queue', None)
+        maxsize = getattr(queue, 'maxsize', 0) if queue is not None else 0
+        if maxsize > 0 and self._shed_queue_size > maxsize // 2:
+            return max(1, maxsize // 2)
+        return self._shed_queue_size
+
+    def sampleLoad(self, lag=None):
+        """
+        Update the load level out of the B3 event queue size and the given event lag
+        :param lag: The lag of the event being handled (None if not handling an event)
+        :return: The load level (LoadShedder.NORMAL when load shedding is disabled)
+        """
+        shedder = self._shedder
+        if shedder is None:
+            return LoadShedder.NORMAL
+        previous = shedder.level
+        # the B3 event queue is created after plugins load their configuration
+        shedder.queue_size = self.getShedQueueSize()
+        level = shedder.sample(self.getEventQueueSize(), lag)
+        if level > previous:
+            self.warning('event processing is lagging behind: switching to %s mode' % shedder.name)
+        elif level < previous:
+            self.info('event processing load decreased: switching to %s mode' % shedder.name)
+        if level == LoadShedder.NORMAL and self._backlog:
+            self.flushBacklog()
+        return level
+
+    def deferCommand(self, func, data, client, cmd):
+        """
+        Put a command aside until the load goes back to normal
+        """
+        if len(self._backlog) == self._backlog.maxlen:
+            self._metrics.increment('location_shed_total', action='drop_command')
+        self._metrics.increment('location_shed_total', action='defer_command')
+        self._backlog.append((func, data, client, cmd))
+
+    def flushBacklog(self):
+        """
+        Execute the commands put aside while the load was critical (skipping the ones of disconnected clients)
+        """
+        while self._backlog:
+            try:
+                func, data, client, cmd = self._backlog.popleft()
+            except IndexError:
+                break
+            if getattr(client, 'connected', True):
+                self.dispatch(func, data, client, cmd)
+
+    def openHistory(self):
+        """
+        Open the location history log (if enabled in the configuration file) and schedule the periodic flush
+        """
+        if self._history_cron is not None:
+            self.console.cron - self._history_cron
+            self._history_cron = None
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+        if self._history_file:
+            path = b3.getAbsolutePath(self._history_file)
+            self._history = LocationHistory(path, max_age=self._history_max_age * 86400,
+                                            max_entries=self._history_max_entries)
+            self.debug('recording location history: %s' % path)
+            second = '*/%s' % self._history_flush if self._history_flush < 60 else 0
+            self._history_cron = b3.cron.PluginCronTab(self, self.flushHistory, second)
+            self.console.cron + self._history_cron
+            # load the log in the background so that neither startup nor the first geolocation wait for it
+            thread = threading.Thread(target=self.compactHistory, name='location-history')
+            thread.setDaemon(True)
+            thread.start()
+
+    def recordLocation(self, client):
+        """
+        Append the location of the given client to the history log (if it changed)
+        :param client: The client who has been geolocated
+        """
+        try:
+            self._history.record(client.guid, client.ip, client.location)
+        except Exception, e:
+            self.error('could not record location history: %s' % e)
+
+    def flushHistory(self):
+        """
+        Write the buffered location history records to the log
+        """
+        if self._history is not None and self._history.loaded:
+            try:
+                self._history.flush()
+            except Exception, e:
+                self.error('could not write location history: %s' % e)
+
+    def compactHistory(self):
+        """
+        Remove the location history records exceeding the retention limits from the log (loading it if needed)
+        """
+        history = self._history
+        if history is not None:
+            try:
+                removed = history.compact()
+                if removed:
+                    self.debug('removed %s location history records' % removed)
+            except Exception, e:
+                self.error('could not compact location history: %s' % e)
+
+    def openExporter(self):
+        """
+        Create the metrics exporter (if enabled in the configuration file) and schedule the periodic export
+        """
+        if self._exporter_cron is not None:
+            self.console.cron - self._exporter_cron
+            self._exporter_cron = None
+        if self._exporter is not None:
+            self._exporter.close()
+            self._exporter = None
+        try:
+            if self._metrics_exporter == 'prometheus':
+                path = b3.getAbsolutePath(self._metrics_target or '@home/location.prom')
+                self._exporter = PrometheusExporter(path)
+                self.debug('exporting metrics to Prometheus text file: %s' % path)
+            elif self._metrics_exporter == 'statsd':
+                host, _, port = (self._metrics_target or '127.0.0.1').partition(':')
+                self._exporter = StatsdExporter(host, int(port or 8125))
+                self.debug('exporting metrics to StatsD server: %s:%s' % self._exporter.address)
+        except Exception, e:
+            self.error('could not create %s metrics exporter: %s' % (self._metrics_exporter, e))
+        if self._exporter is not None:
+            second = '*/%s' % self._metrics_interval if self._metrics_interval < 60 else 0
+            self._exporter_cron = b3.cron.PluginCronTab(self, self.exportMetrics, second)
+            self.console.cron + self._exporter_cron
+
+    def exportMetrics(self):
+        """
+        Sample the queue gauges and send the metrics to the configured exporter
+        """
+        self.updateGauges()
+        if self._exporter is not None:
+            try:
+                self._exporter.export(self._metrics)
+            except Exception, e:
+                self.error('could not export metrics: %s' % e)
+
+    def updateGauges(self):
+        """
+        Sample the current size of the queues this plugin depends on
+        """
+        queue = getattr(self.console, 'queue', None)
+        if queue is not None:
+            self._metrics.gauge('location_event_queue_size', queue.qsize())
+        pool = self._pool
+        self._metrics.gauge('location_worker_queue_size', pool.queue.qsize() if pool else 0)
+        self._metrics.gauge('location_worker_dropped', pool.dropped if pool else 0)
+        self._metrics.gauge('location_announce_pending', len(self._announcer) if self._announcer is not None else 0)
+        self._metrics.gauge('location_load_level', self._shedder.level if self._shedder is not None else 0)
+        self._metrics.gauge('location_deferred_commands', len(self._backlog) if self._backlog else 0)
+        self._metrics.gauge('location_clients_geolocated', len(self._matrix))
+        self._metrics.gauge('location_resolver_hits', self._resolver.hits)
+        self._metrics.gauge('location_resolver_misses', self._resolver.misses)
+        for name, table in STRINGS.iteritems():
+            self._metrics.gauge('location_interned_strings', len(table), table=name)
+
+    def evictStore(self):
+        """
+        Remove expired locations from the persistent store, the shared cache and the location history
+        """
+        if self._store is not None:
+            self.debug('removed %s expired locations from the persistent store' % self._store.evict())
+        if self._shared is not None and self._shared.serving:
+            self.debug('removed %s expired locations from the shared cache' % self._shared.evict())
+        self.compactHistory()
+
+    def startWorkers(self):
+        """
+        Start the worker pool (if enabled in the configuration file and not already running)
+        """
+        if self._workers > 0 and not self._pool:
+            self._pool = WorkerPool(self, self._workers, self._queue_size, self._queue_policy)
+            self._pool.start()
+            self.debug('started %s worker threads' % self._workers)
+
+    def stopWorkers(self):
+        """
+        Process all the pending tasks and stop the worker pool
+        """
+        if self._pool:
+            pool, self._pool = self._pool, None
+            pool.stop()
+            self.debug('stopped worker threads')
+
+    def dispatch(self, func, *args, **kwargs):
+        """
+        Execute the given function on the worker pool (or synchronously if the worker pool is disabled)
+        :param func: The function to execute
+        """
+        pool = self._pool
+        if pool:
+            pool.submit(func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
+    def deferred(self, func):
+        """
+        Wrap the given command handler so that it's executed through dispatch() and its execution time is measured
+        :param func: The command handler
+        """
+        command = func.__name__[4:]
+
+        def execute(data, client, cmd):
+            self._metrics.increment('location_commands_total', command=command)
+            self._command.outcomes = outcomes = []
+            try:
+                with self._metrics.timer('location_command_seconds', command=command):
+                    func(data, client, cmd)
+            except Exception:
+                self._metrics.increment('location_command_errors_total', command=command)
+                raise
+            finally:
+                self._command.outcomes = None
+            if outcomes:
+                # one outcome per command: multi-target commands succeed when at least one target succeeded
+                outcome = 'ok' if 'ok' in outcomes else outcomes[0]
+                self._metrics.increment('location_command_results_total', command=command, outcome=outcome)
+
+        @wraps(func)
+        def wrapper(data, client, cmd=None):
+            if self._shedder is not None and self.sampleLoad() >= LoadShedder.CRITICAL and \
+                    client.maxLevel < getattr(self._adminPlugin, '_admins_level', 20):
+                self.deferCommand(execute, data, client, cmd)
+                return
+            self.dispatch(execute, data, client, cmd)
+        return wrapper
+
+    def announce(self, client):
+        """
+        Announce the location of the given client
+        :param client: The client who connected
+        """
+        if self._shedder is not None and self._shedder.level >= LoadShedder.DEGRADED:
+            self._metrics.increment('location_shed_total', action='short_announce')
+            self._shed_announcer.push(client)
+        elif self._announce_window > 0 or self._announce_rate > 0:
+            self._announcer.push(client)
+        else:
+            self.console.say(self.renderMessage('client_connect', client))
+
+    def getLocation(self, client):
+        """
+        Return the location of the given client.
+        When the client has not been geolocated yet, the last known location is
+        retrieved from the cache shared with the other B3 instances running on
+        this host and then from the persistent store (if enabled).
+        :param client: The client whose location we need
+        :return: The client location object or None if not available
+        """
+        location = client.location
+        if location or (self._store is None and self._shared is None):
+            return location
+        connected = self.isConnected(client)
+        if connected:
+            try:
+                return self._stored[client.cid]
+            except KeyError:
+                pass
+            missed = self._missed.get(client.cid)
+            if missed is not None and time.time() - missed < self._missed_ttl:
+                return None
+        if self._shared is not None:
+            try:
+                location = self._shared.get(client.guid, client.ip)
+                self._metrics.increment('location_shared_cache_total', outcome='hit' if location else 'miss')
+            except Exception, e:
+                self._metrics.increment('location_shared_cache_total', outcome='error')
+                self.error('could not read shared location cache: %s' % e)
+        if location is None and self._store is not None:
+            try:
+                location = self._store.get(client.guid, client.ip)
+            except Exception, e:
+                self.error('could not read persistent location store: %s' % e)
+        if not connected:
+            return location
+        if location is not None or self._shared is None:
+            self._stored[client.cid] = location
+        else:
+            # misses are remembered only for a few seconds since a sibling instance may still publish the location
+            self._missed[client.cid] = time.time()
+        return location
+
+    def getAnnounceMessage(self, clients, short=False):
+        """
+        Return the connect announcement for the given list of clients
+        :param clients: The list of clients who connected
+        :param short: Whether to announce a single client with the short message
+        :return: str
+        """
+        if len(clients) == 1:
+            return self.renderMessage('client_connect_short' if short else 'client_connect', clients[0])
+        countries = []
+        for client in clients:
+            country = MESSAGE_VARIABLES['country'](client, self.getSnapshot(client))
+            if country != '--' and country not in countries:
+                countries.append(country)
+        return self.renderMessage('client_connect_many', clients[0], count=len(clients),
+                                  countries=', '.join(countries) or '--')
+
+    def findClient(self, handle, client=None):
+        """
+        Find a client matching the given handle, notifying the given client when
+        there is no match or more than one (like the admin plugin findClientPrompt)
+        :param handle: The search handle
+        :param client: The client who to notify search results
+        :return: The client found or None
+        """
+        matches = self._resolver.resolve(handle)
+        if not matches:
+            if client:
+                client.message(self._adminPlugin.getMessage('no_players', handle))
+            return None
+        if len(matches) > 1:
+            if client:
+                names = ['^7%s' % x.name if x.name == x.cid else '^7%s [^2%s^7]' % (x.name, x.cid) for x in matches]
+                client.message(self._adminPlugin.getMessage('players_matched', handle, ', '.join(names)))
+            return None
+        return matches[0]
+
+    def findTargets(self, data, client, exclude=None):
+        """
+        Find the clients targeted by a command: the argument can be a single client handle, a comma
+        separated list of handles, 'all' (every connected client) or a team (red, blue, spec)
+        :param data: The command argument
+        :param client: The client who to notify search results
+        :param exclude: A client which must not be included when targeting all the clients or a team
+        :return: list of clients (empty if none has been found)
+        """
+        handle = data.strip()
+        group = handle.lower()
+        if group == 'all' or group in TEAMS:
+            targets = [x for x in self.console.clients.getList() if x is not exclude and
+                       (group == 'all' or x.team == TEAMS[group])]
+            if not targets:
+                client.message(self._adminPlugin.getMessage('no_players', handle))
+            return sorted(targets, key=lambda x: int(x.cid) if str(x.cid).isdigit() else x.cid)
+        targets = []
+        for x in handle.split(','):
+            if x.strip():
+                sclient = self.findClient(x, client)
+                if sclient and sclient not in targets:
+                    targets.append(sclient)
+        return targets
+
+    def getTargetDistances(self, client, targets):
+        """
+        Return the distances between the given client and the given targets: when there is more than one
+        target all the distances are computed in a single pass over the roster distance matrix
+        :param client: The client at the center
+        :param targets: The list of target clients
+        :return: list of distances in the configured unit (False when a distance could not be computed)
+        """
+        if len(targets) == 1 or self._distance_model != 'haversine':
+            # the roster distance matrix is computed with the haversine model
+            return [self.getLocationDistance(client, x) for x in targets]
+        # make sure the coordinates of all the clients involved are up to date before computing the matrix row
+        points = [self.getGeoPoint(x) for x in targets]
+        if not self.getGeoPoint(client):
+            return [False] * len(targets)
+        row = dict(self._matrix.row(client.cid))
+        return [self.convertDistance(row[x.cid]) if point and x.cid in row else False
+                for x, point in zip(targets, points)]
+
+    def getLineWidth(self):
+        """
+        Return the maximum length of a message line which is not wrapped by the game server
+        """
+        prefix = len(getattr(self.console, 'msgPrefix', '') or '') + len(getattr(self.console, 'pmPrefix', '') or '')
+        return getattr(self.console, '_line_length', 80) - len(getattr(self.console, '_line_color_prefix', '') or '') \
+            - prefix - 2
+
+    def sayPacked(self, client, cmd, messages, separator=' ^7| '):
+        """
+        Send the given messages packing as many of them as possible in every line, so that the lowest
+        number of lines (one RCON command each) is sent to the game server
+        :param client: The client who issued the command
+        :param cmd: The command being executed
+        :param messages: The list of messages
+        :param separator: The separator placed between messages sent on the same line
+        """
+        width = self.getLineWidth()
+        lines = []
+        for message in messages:
+            if lines and len(lines[-1]) + len(separator) + len(message) <= width:
+                lines[-1] += separator + message
+            else:
+                lines.append(message)
+        for line in lines:
+            cmd.sayLoudOrPM(client, line)
+
+    def convertDistance(self, distance):
+        """
+        Convert the given distance (in Km) to the configured unit, rounded to 2 decimals
+        """
+        return round(distance * UNITS[self._distance_unit], 2)
 
     def getLocationDistance(self, client, sclient):
         """
-        Return the distance between 2 clients (in Km)
+        Return the distance between 2 clients (in the configured unit) computed with the configured distance model
         """
-        if not client.location or client.location.lat is None:
+        point1 = self.getGeoPoint(client)
+        if not point1:
             self.debug('could not compute distance: %s has not enough geolocation data' % client.name)
             return False
-        
-        if not sclient.location or sclient.location.lat is None:
+
+        point2 = self.getGeoPoint(sclient)
+        if not point2:
             self.debug('could not compute distance: %s has not enough geolocation data' % sclient.name)
             return False
 
         self.verbose('computing distance between %s and %s' % (client.name, sclient.name))
+        return self.convertDistance(DISTANCE_MODELS[self._distance_model](point1, point2))
+
+    def getSnapshot(self, client):
+        """
+        Return the location snapshot of the given client.
+        The snapshot is taken again if the client location object changed since it was taken.
+        :param client: The client whose location we need
+        :return: LocationSnapshot or None if the client location is not available
+        """
+        entry = self._snapshots.get(client.cid)
+        if entry is not None and entry[0] is self.getLocation(client):
+            return entry[1]
+        return self.updateClientLocation(client)
+
+    def isConnected(self, client):
+        """
+        Whether the given client is connected to the game server (clients loaded from the storage are not)
+        :param client: The client to check
+        """
+        return client.cid is not None and getattr(client, 'connected', True) and \
+            self.console.clients.getByCID(client.cid) is client
+
+    def getGeoPoint(self, client):
+        """
+        Return the precomputed coordinates of the given client
+        :param client: The client whose coordinates we need
+        :return: GeoPoint or None if the client has not enough geolocation data
+        """
+        snapshot = self.getSnapshot(client)
+        return snapshot.point if snapshot is not None else None
+
+    def updateClientLocation(self, client):
+        """
+        Take a snapshot of the location of the given client and store its coordinates in the roster distance matrix
+        :param client: The client whose location changed
+        :return: LocationSnapshot or None if the client location is not available
+        """
+        location = self.getLocation(client)
+        snapshot = LocationSnapshot.fromLocation(location) if location else None
+        if not self.isConnected(client):
+            # offline clients (i.e: found with an @id lookup) never disconnect: they are not cached nor indexed
+            return snapshot
+        with self._lock:
+            self._snapshots[client.cid] = (location, snapshot)
+            self._stats.remove(client.cid, self._matrix.distances(client.cid))
+            if snapshot is not None and snapshot.point is not None:
+                self._matrix.update(client.cid, snapshot.point)
+                self._index.update(client.cid, snapshot.point)
+                self.updateClientStats(client, snapshot, self._matrix.distances(client.cid))
+                return snapshot
+            self._matrix.remove(client.cid)
+            self._index.remove(client.cid)
+            if snapshot is not None:
+                self.updateClientStats(client, snapshot)
+            return snapshot
+
+    def updateClientStats(self, client, snapshot, distances=None):
+        """
+        Update the population statistics with the given client location (must be called holding the lock)
+        :param client: The client whose location changed
+        :param snapshot: The client location snapshot
+        :param distances: The distances from the other clients with coordinates (None if the client has none)
+        """
+        self._stats.add(client.cid, snapshot.cc, '%s-%s' % (snapshot.cc, snapshot.rc), snapshot.isp, distances)
+
+    def getGeoStats(self):
+        """
+        Return the current population statistics of geolocated clients
+        :return: dict with keys population, cc, rc, isp, average_distance, median_distance
+        """
+        with self._lock:
+            return self._stats.summary()
+
+    def getClientDistances(self, client):
+        """
+        Return the distances between the given client and all the other geolocated clients (in the configured unit)
+        computed with the configured distance model, like the ones displayed by !distance
+        :param client: The client whose distances we want to compute
+        :return: list of (client, distance) tuples
+        """
+        point = self.getGeoPoint(client)
+        if not point:
+            return []
+        distances = []
+        for cid, distance in self._matrix.row(client.cid):
+            sclient = self.console.clients.getByCID(cid)
+            if sclient:
+                if self._distance_model != 'haversine':
+                    # the roster distance matrix is computed with the haversine model
+                    spoint = self.getGeoPoint(sclient)
+                    if not spoint:
+                        continue
+                    distance = DISTANCE_MODELS[self._distance_model](point, spoint)
+                distances.append((sclient, self.convertDistance(distance)))
+        return distances
+
+    def getNearestClient(self, client):
+        """
+        Return the geolocated client which is the nearest to the given one
+        :param client: The client at the center of the search
+        :return: tuple (client, distance in the configured unit) or None if no other client has been geolocated
+        """
+        point = self.getGeoPoint(client)
+        if not point:
+            return None
+        exclude = set([client.cid])
+        while True:
+            found = self._index.nearest(point, exclude=exclude)
+            if not found:
+                return None
+            sclient = self.console.clients.getByCID(found[0])
+            if sclient and self.isConnected(sclient):
+                return sclient, self.convertDistance(found[1])
+            # indexed client which is not connected anymore: look for the next one
+            exclude.add(found[0])
+
+    def getClientsWithin(self, client, radius):
+        """
+        Return all the geolocated clients within the given distance from the given one
+        :param client: The client at the center of the search
+        :param radius: The search radius (in the configured unit)
+        :return: list of (client, distance) tuples sorted by distance
+        """
+        point = self.getGeoPoint(client)
+        if not point:
+            return []
+        clients = []
+        for cid, distance in self._index.within(point, radius / UNITS[self._distance_unit], exclude=client.cid):
+            sclient = self.console.clients.getByCID(cid)
+            if sclient:
+                clients.append((sclient, self.convertDistance(distance)))
+        return clients
 
-        lat1 = float(client.location.lat)
-        lon1 = float(client.location.lon)
-        lat2 = float(sclient.location.lat)
-        lon2 = float(sclient.location.lon)
-        
-        ###
-        # Haversine formula
-        ###
-        
-        radius = 6371  # Earth radius in Km
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        
-        a = math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat1)) \
-            * math.cos(math.radians(lat2)) * math.sin(dlon / 2) * math.sin(dlon / 2)
-        b = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return round(abs(radius * b), 2)
+    def getLocationHistory(self, client, limit=None):
+        """
+        Return the recorded locations of the given client
+        :param client: The client whose history we want
+        :param limit: The maximum number of entries to return (the most recent ones)
+        :return: list of HistoryEntry (timestamp, cc, rc, isp, lat, lon) in chronological order
+        """
+        if self._history is None:
+            return []
+        return self._history.history(client.guid, client.ip, limit)
+
+    def getLocationChanges(self, client, field='isp', since=None):
+        """
+        Return the changes of the given location field of a client (i.e: isp or country hopping)
+        :param client: The client whose history we want
+        :param field: The location field to look at (cc, rc or isp)
+        :param since: Consider only changes happened after this timestamp
+        :return: list of (before, after) HistoryEntry tuples in chronological order
+        """
+        if self._history is None:
+            return []
+        return self._history.changes(client.guid, client.ip, field, since)
+
+    def getDistanceMatrix(self):
+        """
+        Return the pairwise distance matrix of all the geolocated clients (in Km, always computed with the
+        haversine model)
+        :return: tuple (clients, rows) where rows[i][j] is the distance between clients[i] and clients[j]
+        """
+        cids, rows = self._matrix.matrix()
+        return [self.console.clients.getByCID(cid) for cid in cids], rows
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -187,48 +1606,165 @@ class LocationPlugin(b3.plugin.Plugin):
 
     def cmd_locate(self, data, client, cmd=None):
         """
-        <client> - display geolocation info of the specified client
+        <client|all|red|blue|spec|client1,client2,...> - display geolocation info of the specified clients
         """
         if not data: 
             client.message('^7missing data, try ^3!^7help locate')
         else:
-            sclient = self._adminPlugin.findClientPrompt(data, client)
-            if sclient:
-                if not sclient.location:
-                    cmd.sayLoudOrPM(client, self.getMessage('cmd_locate_failed', self.getMessageVariables(sclient)))
-                else:
-                    cmd.sayLoudOrPM(client, self.getMessage('cmd_locate', self.getMessageVariables(sclient)))
+            targets = self.findTargets(data, client)
+            if targets:
+                self.sayPacked(client, cmd, [self.renderMessage('cmd_locate' if self.getSnapshot(x)
+                                                                else 'cmd_locate_failed', x) for x in targets])
 
     def cmd_distance(self, data, client, cmd=None):
         """
-        <client> - display the world distance between you and the given client
+        <client|all|red|blue|spec|client1,client2,...> - display the world distance between you and the given clients
         """
         if not data: 
             client.message('^7missing data, try ^3!^7help distance')
         else:
-            sclient = self._adminPlugin.findClientPrompt(data, client)
-            if sclient:
-                if sclient == client:
-                    cmd.sayLoudOrPM(client, self.getMessage('cmd_distance_self', self.getMessageVariables(sclient)))
-                else:
-                    distance = self.getLocationDistance(client, sclient)
-                    if not distance:
-                        cmd.sayLoudOrPM(client, self.getMessage('cmd_distance_failed', self.getMessageVariables(sclient)))
+            targets = self.findTargets(data, client, exclude=client)
+            if targets:
+                messages = []
+                for sclient, distance in zip(targets, self.getTargetDistances(client, targets)):
+                    if sclient == client:
+                        messages.append(self.renderMessage('cmd_distance_self', sclient))
+                    elif not distance:
+                        messages.append(self.renderMessage('cmd_distance_failed', sclient))
                     else:
-                        variables = self.getMessageVariables(sclient)
-                        variables['distance'] = distance
-                        cmd.sayLoudOrPM(client, self.getMessage('cmd_distance', variables))
+                        messages.append(self.renderMessage('cmd_distance', sclient, distance=distance))
+                self.sayPacked(client, cmd, messages)
 
     def cmd_isp(self, data, client, cmd=None):
         """
-        <client> - display the isp the specified client is using
+        <client|all|red|blue|spec|client1,client2,...> - display the isp the specified clients are using
         """
         if not data:
             client.message('^7missing data, try ^3!^7help isp')
         else:
-            sclient = self._adminPlugin.findClientPrompt(data, client)
+            targets = self.findTargets(data, client)
+            if targets:
+                self.sayPacked(client, cmd, [self.renderMessage('cmd_isp' if self.getSnapshot(x)
+                                                                else 'cmd_isp_failed', x) for x in targets])
+
+    def cmd_nearest(self, data, client, cmd=None):
+        """
+        - display the connected client which is the nearest to you
+        """
+        nearest = self.getNearestClient(client)
+        if not nearest:
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_nearest_failed', client))
+        else:
+            sclient, distance = nearest
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_nearest', sclient, distance=distance))
+
+    def cmd_farthest(self, data, client, cmd=None):
+        """
+        - display the connected client which is the farthest from you
+        """
+        distances = self.getClientDistances(client)
+        if not distances:
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_farthest_failed', client))
+        else:
+            sclient, distance = max(distances, key=lambda x: x[1])
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_farthest', sclient, distance=distance))
+
+    def cmd_nearby(self, data, client, cmd=None):
+        """
+        <distance> - display the connected clients within the given distance from you
+        """
+        if not data:
+            client.message('^7missing data, try ^3!^7help nearby')
+            return
+
+        try:
+            radius = float(data.split()[0])
+            if radius <= 0:
+                raise ValueError
+            if radius.is_integer():
+                radius = int(radius)
+        except ValueError:
+            client.message('^7invalid distance, try ^3!^7help nearby')
+            return
+
+        clients = self.getClientsWithin(client, radius)
+        if not clients:
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_nearby_failed', client, distance=radius))
+        else:
+            players = ', '.join(['%s (%s)' % (sclient.name, distance) for sclient, distance in clients])
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_nearby', client, distance=radius, players=players))
+
+    def cmd_geostats(self, data, client, cmd=None):
+        """
+        - display the current population breakdown by country and distance statistics
+        """
+        stats = self._stats
+        with self._lock:
+            count = len(stats)
+            countries = ', '.join(['%s (%s)' % x for x in stats.cc.most_common(5)])
+            average = stats.average()
+            median = stats.median()
+        if not count:
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_geostats_failed', client))
+        else:
+            average = '--' if average is None else self.convertDistance(average)
+            median = '--' if median is None else self.convertDistance(median)
+            cmd.sayLoudOrPM(client, self.renderMessage('cmd_geostats', client, count=count, countries=countries,
+                                                       average=average, median=median))
+
+    def cmd_lochistory(self, data, client, cmd=None):
+        """
+        <client> - display the most recent locations of a client
+        """
+        if not data:
+            client.message('^7missing data, try ^3!^7help lochistory')
+        else:
+            sclient = self.findClient(data, client)
             if sclient:
-                if not sclient.location:
-                    cmd.sayLoudOrPM(client, self.getMessage('cmd_isp_failed', self.getMessageVariables(sclient)))
+                entries = self.getLocationHistory(sclient, 5)
+                if not entries:
+                    cmd.sayLoudOrPM(client, self.renderMessage('cmd_lochistory_failed', sclient))
                 else:
-                    cmd.sayLoudOrPM(client, self.getMessage('cmd_isp', self.getMessageVariables(sclient)))
+                    history = ', '.join(['%s %s-%s %s' % (time.strftime('%d/%m %H:%M', time.localtime(x.timestamp)),
+                                                          x.cc or '--', x.rc or '--', x.isp or '--')
+                                         for x in reversed(entries)])
+                    cmd.sayLoudOrPM(client, self.renderMessage('cmd_lochistory', sclient, history=history))
+
+    def cmd_locstats(self, data, client, cmd=None):
+        """
+        - display the plugin timing statistics and queue sizes
+        """
+        self.updateGauges()
+        metrics = self._metrics
+        snapshot = metrics.snapshot()
+
+        def timing(histogram):
+            return 'avg ^7%.2f ^3ms | p95 ^7%.2f ^3ms | max ^7%.2f ^3ms' % (histogram.average() * 1000,
+                                                                          histogram.quantile(0.95) * 1000,
+                                                                          histogram.max * 1000)
+
+        lines = []
+        histogram = metrics.histogram('location_event_seconds', event='geolocation_success')
+        if histogram is not None:
+            lag = metrics.histogram('location_event_lag_seconds')
+            lines.append('^3geolocation: ^7%s ^3events | %s | lag avg ^7%.1f ^3s' % (histogram.count, timing(histogram),
+                                                                                  lag.average()))
+        commands = sorted(set(dict(labels)['command'] for name, labels in snapshot['histograms']
+                              if name == 'location_command_seconds'))
+        for command in commands:
+            histogram = metrics.histogram('location_command_seconds', command=command)
+            outcomes = ['%s %s' % (dict(k[1])['outcome'], v) for k, v in sorted(snapshot['counters'].iteritems())
+                        if k[0] == 'location_command_results_total' and dict(k[1])['command'] == command]
+            lines.append('^3%s: ^7%s ^3calls%s | %s' % (command, histogram.count,
+                                                       ' (%s)' % ', '.join(outcomes) if outcomes else '',
+                                                       timing(histogram)))
+        gauges = snapshot['gauges']
+        lines.append('^3queues: event ^7%s ^3| worker ^7%s ^3(dropped ^7%s^3) | announce ^7%s' % (
+                     gauges.get(('location_event_queue_size', ()), '--'),
+                     gauges.get(('location_worker_queue_size', ()), 0),
+                     gauges.get(('location_worker_dropped', ()), 0),
+                     gauges.get(('location_announce_pending', ()), 0)))
+        if self._shedder is not None:
+            lines.append('^3load: ^7%s ^3| deferred commands ^7%s' % (self._shedder.name, len(self._backlog)))
+        for line in lines:
+            cmd.sayLoudOrPM(client, line)
@@ -0,0 +1,523 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import math
+import threading
+
+from array import array
+
+EARTH_RADIUS = 6371  # Earth radius in Km
+
+# WGS-84 ellipsoid parameters (in Km)
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+# conversion factors from Km to the supported distance units
+UNITS = {
+    'km': 1.0,
+    'mi': 0.621371192237334,
+}
+
+
+_numpy = False  # NumPy module, imported on first use
+
+
+def get_numpy():
+    """
+    Return the NumPy module (None if not available).
+    NumPy is imported on first use rather than when the plugin is loaded: importing
+    it is by far the most expensive part of the plugin startup.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Return the great-circle distance (in Km) between 2 points given in degrees
+    """
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat1)) \
+        * math.cos(math.radians(lat2)) * math.sin(dlon / 2) * math.sin(dlon / 2)
+    b = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return abs(EARTH_RADIUS * b)
+
+
+def chord_distance(chord):
+    """
+    Return the great-circle distance (in Km) matching the given chord length between 2 unit vectors
+    """
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+class GeoPoint(object):
+    """
+    Precomputed trigonometric data of a point on the Earth surface: once built,
+    distances can be computed without converting or parsing coordinates again.
+    """
+    __slots__ = ('lat', 'lon', 'rlat', 'rlon', 'coslat', 'x', 'y', 'z')
+
+    def __init__(self, lat, lon):
+        """
+        Object constructor.
+        :param lat: The point latitude (in degrees)
+        :param lon: The point longitude (in degrees)
+        """
+        self.lat = float(lat)
+        self.lon = float(lon)
+        self.rlat = math.radians(self.lat)
+        self.rlon = math.radians(self.lon)
+        self.coslat = math.cos(self.rlat)
+        self.x = self.coslat * math.cos(self.rlon)
+        self.y = self.coslat * math.sin(self.rlon)
+        self.z = math.sin(self.rlat)
+
+    def __repr__(self):
+        return 'GeoPoint(%r, %r)' % (self.lat, self.lon)
+
+    def distance(self, other):
+        """
+        Return the great-circle distance (in Km) between this point and the given one
+        """
+        dx = self.x - other.x
+        dy = self.y - other.y
+        dz = self.z - other.z
+        return chord_distance(math.sqrt(dx * dx + dy * dy + dz * dz))
+
+
+def distance_haversine(p1, p2):
+    """
+    Return the great-circle distance (in Km) between 2 GeoPoints on a sphere (computed from the chord length)
+    """
+    return p1.distance(p2)
+
+
+def distance_equirectangular(p1, p2):
+    """
+    Return the equirectangular approximation of the distance (in Km) between 2 GeoPoints: very fast and accurate
+    for short distances, the error grows with the distance and the latitude
+    """
+    dlon = p2.rlon - p1.rlon
+    if dlon > math.pi:
+        dlon -= 2 * math.pi
+    elif dlon < -math.pi:
+        dlon += 2 * math.pi
+    x = dlon * math.cos((p1.rlat + p2.rlat) / 2)
+    y = p2.rlat - p1.rlat
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+
+def distance_vincenty(p1, p2, iterations=100, tolerance=1e-12):
+    """
+    Return the distance (in Km) between 2 GeoPoints on the WGS-84 ellipsoid using Vincenty's inverse formula.
+    The formula does not converge for nearly antipodal points: the spherical distance is returned in that case.
+    """
+    if p1.lat == p2.lat and p1.lon == p2.lon:
+        return 0.0
+    u1 = math.atan((1 - WGS84_F) * math.tan(p1.rlat))
+    u2 = math.atan((1 - WGS84_F) * math.tan(p2.rlat))
+    sinu1, cosu1 = math.sin(u1), math.cos(u1)
+    sinu2, cosu2 = math.sin(u2), math.cos(u2)
+    l = p2.rlon - p1.rlon
+    lam = l
+    for _ in xrange(iterations):
+        sinlam, coslam = math.sin(lam), math.cos(lam)
+        sinsigma = math.sqrt((cosu2 * sinlam) ** 2 + (cosu1 * sinu2 - sinu1 * cosu2 * coslam) ** 2)
+        if sinsigma == 0:
+            return 0.0
+        cossigma = sinu1 * sinu2 + cosu1 * cosu2 * coslam
+        sigma = math.atan2(sinsigma, cossigma)
+        sinalpha = cosu1 * cosu2 * sinlam / sinsigma
+        cos2alpha = 1 - sinalpha * sinalpha
+        cos2sigmam = cossigma - 2 * sinu1 * sinu2 / cos2alpha if cos2alpha else 0.0
+        c = WGS84_F / 16 * cos2alpha * (4 + WGS84_F * (4 - 3 * cos2alpha))
+        previous = lam
+        lam = l + (1 - c) * WGS84_F * sinalpha * \
+            (sigma + c * sinsigma * (cos2sigmam + c * cossigma * (-1 + 2 * cos2sigmam * cos2sigmam)))
+        if abs(lam - previous) < tolerance:
+            break
+    else:
+        return p1.distance(p2)
+    u2 = cos2alpha * (WGS84_A * WGS84_A - WGS84_B * WGS84_B) / (WGS84_B * WGS84_B)
+    a = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    b = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    deltasigma = b * sinsigma * (cos2sigmam + b / 4 * (cossigma * (-1 + 2 * cos2sigmam * cos2sigmam) - b / 6 *
+                                 cos2sigmam * (-3 + 4 * sinsigma * sinsigma) * (-3 + 4 * cos2sigmam * cos2sigmam)))
+    return WGS84_B * a * (sigma - deltasigma)
+
+
+# great-circle distances (in Km) matching chord lengths from 0 to 2, sampled at LOOKUP_SIZE + 1 points
+LOOKUP_SIZE = 4096
+LOOKUP_TABLE = None  # built on first use by get_lookup_table()
+LOOKUP_LIMIT = LOOKUP_SIZE - LOOKUP_SIZE // 64
+
+
+def get_lookup_table():
+    """
+    Return the chord to great-circle distance table used by the lookup model, building it on first use
+    """
+    global LOOKUP_TABLE
+    if LOOKUP_TABLE is None:
+        LOOKUP_TABLE = array('d', [chord_distance(2.0 * i / LOOKUP_SIZE) for i in xrange(LOOKUP_SIZE + 1)])
+    return LOOKUP_TABLE
+
+
+def distance_lookup(p1, p2):
+    """
+    Return the great-circle distance (in Km) between 2 GeoPoints interpolating the chord to arc conversion
+    out of a precomputed table instead of computing the arcsine
+    """
+    dx = p1.x - p2.x
+    dy = p1.y - p2.y
+    dz = p1.z - p2.z
+    position = math.sqrt(dx * dx + dy * dy + dz * dz) * (LOOKUP_SIZE / 2)
+    i = int(position)
+    if i >= LOOKUP_LIMIT:
+        # the arcsine is too steep next to the antipode to be interpolated accurately
+        return chord_distance(position / (LOOKUP_SIZE / 2))
+    table = LOOKUP_TABLE or get_lookup_table()
+    lower = table[i]
+    return lower + (table[i + 1] - lower) * (position - i)
+
+
+# distance models selectable in the configuration file
+DISTANCE_MODELS = {
+    'equirectangular': distance_equirectangular,
+    'haversine': distance_haversine,
+    'vincenty': distance_vincenty,
+    'lookup': distance_lookup,
+}
+
+
+class DistanceMatrix(object):
+    """
+    Keep the unit vectors of a set of points packed in a contiguous array so that
+    distances can be computed for the whole set in a single pass: with NumPy
+    the computation is vectorized, otherwise a pure Python loop is used.
+    Access is serialized since NumPy reads the array buffer in place.
+    """
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self._keys = []
+        self._index = {}
+        self._vectors = array('d')
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        """
+        Return the list of keys stored in the matrix (in storage order)
+        """
+        return list(self._keys)
+
+    def update(self, key, point):
+        """
+        Add a point to the matrix or update its coordinates if already present
+        :param key: The key identifying the point
+        :param point: The GeoPoint to store
+        """
+        with self._lock:
+            if key in self._index:
+                i = self._index[key] * 3
+                self._vectors[i] = point.x
+                self._vectors[i + 1] = point.y
+                self._vectors[i + 2] = point.z
+            else:
+                self._index[key] = len(self._keys)
+                self._keys.append(key)
+                self._vectors.extend((point.x, point.y, point.z))
+
+    def remove(self, key):
+        """
+        Remove a point from the matrix: the last point is moved in the freed slot so the array stays packed
+        :param key: The key identifying the point
+        """
+        with self._lock:
+            i = self._index.pop(key, None)
+            if i is None:
+                return
+            last = len(self._keys) - 1
+            if i != last:
+                moved = self._keys[last]
+                self._keys[i] = moved
+                self._vectors[i * 3:i * 3 + 3] = self._vectors[last * 3:last * 3 + 3]
+                self._index[moved] = i
+            self._keys.pop()
+            del self._vectors[last * 3:]
+
+    def clear(self):
+        """
+        Remove all the points from the matrix
+        """
+        with self._lock:
+            self._keys = []
+            self._index = {}
+            self._vectors = array('d')
+
+    def row(self, key):
+        """
+        Return the distances (in Km) between the given point and all the points in the matrix
+        :param key: The key identifying the point
+        :return: list of (key, distance) tuples (the point itself excluded)
+        """
+        with self._lock:
+            i = self._index.get(key)
+            if i is None:
+                return []
+            values = self._row(i)
+            if get_numpy() is not None:
+                values = values.tolist()
+            return [(k, values[j]) for j, k in enumerate(self._keys) if j != i]
+
+    def distances(self, key):
+        """
+        Return the distances (in Km) between the given point and all the other points in the matrix
+        :param key: The key identifying the point
+        :return: a NumPy array (or a list when NumPy is not available) of distances in storage order
+        """
+        with self._lock:
+            i = self._index.get(key)
+            if i is None:
+                return []
+            values = self._row(i)
+            numpy = get_numpy()
+            if numpy is not None:
+                return numpy.delete(values, i)
+            del values[i]
+            return values
+
+    def matrix(self):
+        """
+        Return the full pairwise distance matrix (in Km)
+        :return: tuple (keys, rows) where rows[i][j] is the distance between keys[i] and keys[j]
+        """
+        with self._lock:
+            keys = list(self._keys)
+            if not keys:
+                return keys, []
+            if get_numpy() is not None:
+                v = self._numpy_vectors()
+                rows = self._numpy_distances(v[:, None, :], v[None, :, :]).tolist()
+            else:
+                rows = [self._row(i) for i in xrange(len(keys))]
+            return keys, rows
+
+    def _row(self, i):
+        """
+        Return the distances between the i-th point and all the points (itself included)
+        """
+        if get_numpy() is not None:
+            v = self._numpy_vectors()
+            return self._numpy_distances(v[i], v)
+        sqrt = math.sqrt
+        asin = math.asin
+        vectors = self._vectors
+        x1, y1, z1 = vectors[i * 3:i * 3 + 3]
+        values = []
+        append = values.append
+        for j in xrange(0, len(vectors), 3):
+            chord = sqrt((x1 - vectors[j]) ** 2 + (y1 - vectors[j + 1]) ** 2 + (z1 - vectors[j + 2]) ** 2)
+            append(2 * EARTH_RADIUS * asin(min(1.0, chord / 2)))
+        return values
+
+    def _numpy_vectors(self):
+        """
+        Return a (N, 3) NumPy view over the stored unit vectors (must be called holding the lock)
+        """
+        numpy = get_numpy()
+        return numpy.frombuffer(self._vectors, dtype=numpy.float64).reshape(-1, 3)
+
+    @staticmethod
+    def _numpy_distances(v1, v2):
+        """
+        Vectorized chord to great-circle distance conversion (unit vectors are broadcast by NumPy)
+        """
+        numpy = get_numpy()
+        chord = numpy.sqrt(((v1 - v2) ** 2).sum(axis=-1))
+        return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(1.0, chord / 2))
+
+
+class SpatialIndex(object):
+    """
+    Index points by the cell of a regular grid laid over their unit vectors so
+    that radius and nearest neighbour queries only visit the cells around the
+    queried point rather than every stored point. Access is serialized with a
+    lock since queries may run on worker threads while the event thread moves
+    points around.
+    """
+    def __init__(self, cell_size=500, distance=distance_haversine):
+        """
+        Object constructor.
+        :param cell_size: The size of a grid cell (in Km)
+        :param distance: The function computing the distance (in Km) between 2 GeoPoints
+        """
+        self.cell = 2 * math.sin(min(math.pi, float(cell_size) / EARTH_RADIUS) / 2)
+        self.distance = distance
+        self._lock = threading.RLock()
+        self._cells = {}
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _cell(self, point):
+        """
+        Return the coordinates of the grid cell containing the given point
+        """
+        return int(math.floor(point.x / self.cell)), int(math.floor(point.y / self.cell)), \
+            int(math.floor(point.z / self.cell))
+
+    def update(self, key, point):
+        """
+        Add a point to the index or move it if already present
+        :param key: The key identifying the point
+        :param point: The GeoPoint to store
+        """
+        cell = self._cell(point)
+        with self._lock:
+            self.remove(key)
+            self._cells.setdefault(cell, {})[key] = point
+            self._points[key] = (cell, point)
+
+    def remove(self, key):
+        """
+        Remove a point from the index
+        :param key: The key identifying the point
+        """
+        with self._lock:
+            entry = self._points.pop(key, None)
+            if entry:
+                bucket = self._cells[entry[0]]
+                del bucket[key]
+                if not bucket:
+                    del self._cells[entry[0]]
+
+    def clear(self):
+        """
+        Remove all the points from the index
+        """
+        with self._lock:
+            self._cells = {}
+            self._points = {}
+
+    def get(self, key):
+        """
+        Return the point identified by the given key (None if not indexed)
+        """
+        with self._lock:
+            entry = self._points.get(key)
+        return entry[1] if entry else None
+
+    def within(self, point, radius, exclude=None):
+        """
+        Return all the points within the given distance from the given point
+        :param point: The GeoPoint at the center of the search
+        :param radius: The search radius (in Km)
+        :param exclude: A key which must not be included in the result
+        :return: list of (key, distance) tuples sorted by distance
+        """
+        chord = 2 * math.sin(min(math.pi, float(radius) / EARTH_RADIUS) / 2)
+        span = int(math.ceil(chord / self.cell))
+        result = []
+        with self._lock:
+            if (2 * span + 1) ** 3 >= len(self._cells):
+                buckets = self._cells.itervalues()
+            else:
+                ci, cj, ck = self._cell(point)
+                buckets = (self._cells.get((ci + i, cj + j, ck + k)) for i in xrange(-span, span + 1)
+                           for j in xrange(-span, span + 1) for k in xrange(-span, span + 1))
+            for bucket in buckets:
+                if bucket:
+                    for key, other in bucket.iteritems():
+                        if key != exclude:
+                            distance = self.distance(point, other)
+                            if distance <= radius:
+                                result.append((key, distance))
+        result.sort(key=lambda x: x[1])
+        return result
+
+    def nearest(self, point, exclude=None):
+        """
+        Return the point which is the nearest to the given one.
+        Cells are visited in shells of increasing distance from the cell of the
+        given point and the search stops as soon as no closer point can exist.
+        :param point: The GeoPoint at the center of the search
+        :param exclude: A key (or a set of keys) which must not be included in the result
+        :return: tuple (key, distance) or None if there is no point in the index
+        """
+        exclude = exclude if isinstance(exclude, (set, frozenset)) else set([exclude])
+        best = None
+        ci, cj, ck = self._cell(point)
+        visited = 0
+        shell = 0
+        with self._lock:
+            while True:
+                if visited >= len(self._cells):
+                    # the grid is sparse: scanning occupied cells is cheaper than visiting more shells
+                    best = None
+                    for bucket in self._cells.itervalues():
+                        best = self._closest(point, bucket, exclude, best)
+                    break
+                for i in xrange(-shell, shell + 1):
+                    for j in xrange(-shell, shell + 1):
+                        if max(abs(i), abs(j)) == shell:
+                            ks = xrange(-shell, shell + 1)
+                        else:
+                            ks = (-shell, shell) if shell else (0,)
+                        for k in ks:
+                            visited += 1
+                            bucket = self._cells.get((ci + i, cj + j, ck + k))
+                            if bucket:
+                                best = self._closest(point, bucket, exclude, best)
+                # points in the next shells are at least shell * cell away (chord length)
+                if best is not None and 2 * math.sin(best[1] / EARTH_RADIUS / 2) <= shell * self.cell:
+                    break
+                if shell * self.cell > 2:
+                    break
+                shell += 1
+        return best
+
+    def _closest(self, point, bucket, exclude, best):
+        """
+        Return the closest point between the best one found so far and the ones in the given bucket (must be
+        called holding the lock)
+        """
+        for key, other in bucket.iteritems():
+            if key not in exclude:
+                distance = self.distance(point, other)
+                if best is None or distance < best[1]:
+                    best = (key, distance)
+        return best
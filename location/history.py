@@ -0,0 +1,396 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import math
+import os
+import struct
+import threading
+import time
+
+from array import array
+from collections import namedtuple
+from .strings import intern_location
+
+# a location of a client as recorded in the history log (lat and lon are None when not available)
+HistoryEntry = namedtuple('HistoryEntry', 'timestamp cc rc isp lat lon')
+
+
+class LocationHistory(object):
+    """
+    Append-only log of the locations of clients. The log is a binary file made
+    of 2 kinds of records following a fixed header:
+
+      - string records (tag S): define a string the first time it's used
+      - location records (tag L): timestamp, client key, country code, region
+        code and isp (as ids of previously defined strings) and coordinates
+        (single precision floats, NaN when not available)
+
+    A location record is appended only when the location of a client differs
+    from the last one recorded. Records are collected in memory and written
+    with a single append when flush() is called (or when the buffer is full),
+    so a busy server issues one small sequential write every few seconds. The
+    log is loaded on first use, reading one record at a time: a record left
+    incomplete by a crash is discarded. Only the most recent max_entries
+    records of every client are indexed, and records older than max_age are
+    never returned: compact() rewrites the log without them, so that the file
+    and the index stay bounded on long running servers.
+    """
+    MAGIC = 'B3LH'
+    VERSION = 1
+    HEADER = struct.Struct('<4sB3x')
+    STRING = struct.Struct('<cIH')
+    ENTRY = struct.Struct('<cIIIIIff')
+
+    def __init__(self, path, buffer_size=65536, max_age=0, max_entries=0):
+        """
+        Object constructor.
+        :param path: The path of the log file
+        :param buffer_size: The number of buffered bytes triggering a flush
+        :param max_age: The number of seconds a record is kept for (0 = forever)
+        :param max_entries: The maximum number of records kept for every client (0 = unlimited)
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._closed = False
+        self._file = None
+        self._size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._strings = []
+        self._ids = {}
+        self._offsets = {}
+        self._last = {}
+
+    @property
+    def loaded(self):
+        """
+        Whether the log has been loaded
+        """
+        return self._loaded
+
+    @staticmethod
+    def _key(guid, ip):
+        """
+        Return the key identifying a client in the log
+        """
+        return guid or 'ip:%s' % ip
+
+    def _records(self, f):
+        """
+        Read the records of the log one at a time, starting from the current position of the given file
+        :return: generator of (offset, end, tag, value) tuples: value is the (id, string) tuple of string records
+                 and the unpacked values of location records
+        """
+        offset = f.tell()
+        while True:
+            tag = f.read(1)
+            if tag == 'S':
+                data = tag + f.read(self.STRING.size - 1)
+                if len(data) < self.STRING.size:
+                    return
+                _, i, length = self.STRING.unpack(data)
+                string = f.read(length)
+                if len(string) < length:
+                    return
+                end = offset + self.STRING.size + length
+                yield offset, end, tag, (i, string.decode('utf-8'))
+            elif tag == 'L':
+                data = tag + f.read(self.ENTRY.size - 1)
+                if len(data) < self.ENTRY.size:
+                    return
+                end = offset + self.ENTRY.size
+                yield offset, end, tag, self.ENTRY.unpack(data)
+            else:
+                return
+            offset = end
+
+    def _load(self):
+        """
+        Load the string table and the index of the log (must be called holding the lock)
+        """
+        if self._loaded:
+            return
+        size = end = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                header = f.read(self.HEADER.size)
+                if len(header) == self.HEADER.size:
+                    magic, version = self.HEADER.unpack(header)
+                    if magic != self.MAGIC or version != self.VERSION:
+                        raise ValueError('%s is not a location history log' % self.path)
+                    end = self.HEADER.size
+                    for offset, end_, tag, value in self._records(f):
+                        if tag == 'S':
+                            if value[0] != len(self._strings):
+                                break
+                            self._define(value[1])
+                        else:
+                            if max(value[2:6]) >= len(self._strings):
+                                break
+                            self._index(value[2], offset, value[3:])
+                        end = end_
+
+        self._file = open(self.path, 'ab' if end else 'wb')
+        if end and end < size:
+            # incomplete record left by a crash
+            self._file.truncate(end)
+        if not end:
+            self._file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            self._file.flush()
+            end = self.HEADER.size
+        self._size = end
+        self._loaded = True
+
+    def _define(self, string):
+        """
+        Add a string to the string table
+        """
+        self._ids[string] = len(self._strings)
+        self._strings.append(string)
+
+    def _index(self, key, offset, values):
+        """
+        Index a location record
+        """
+        offsets = self._offsets.get(key)
+        if offsets is None:
+            offsets = self._offsets[key] = array('L')
+        offsets.append(offset)
+        if self.max_entries and len(offsets) > self.max_entries:
+            del offsets[0]
+        self._last[key] = values
+
+    def _intern(self, string):
+        """
+        Return the id of the given string, buffering its definition if it's new (must be called holding the lock)
+        """
+        i = self._ids.get(string)
+        if i is None:
+            i = len(self._strings)
+            self._define(string)
+            data = string.encode('utf-8')
+            self._append(self.STRING.pack('S', i, len(data)) + data)
+        return i
+
+    def _append(self, data):
+        """
+        Buffer a record (must be called holding the lock)
+        """
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+    def record(self, guid, ip, location, timestamp=None):
+        """
+        Record the location of a client (nothing is recorded if it didn't change or the log has been closed)
+        :param guid: The client GUID
+        :param ip: The client IP address
+        :param location: The client location object
+        :param timestamp: The timestamp of the location (defaults to now)
+        :return: True if the location has been recorded
+        """
+        if not guid and not ip:
+            return False
+
+        def coordinate(value):
+            try:
+                return struct.unpack('<f', struct.pack('<f', float(value)))[0]
+            except (TypeError, ValueError):
+                return float('nan')
+
+        strings = [getattr(location, x, None) or '' for x in ('cc', 'rc', 'isp')]
+        lat = coordinate(getattr(location, 'lat', None))
+        lon = coordinate(getattr(location, 'lon', None))
+        with self._lock:
+            if self._closed:
+                # late event received while the plugin is being disabled
+                return False
+            self._load()
+            key = self._intern(self._key(guid, ip))
+            values = tuple(self._intern(x if isinstance(x, unicode) else str(x).decode('utf-8', 'replace'))
+                           for x in strings) + (lat, lon)
+            last = self._last.get(key)
+            if last is not None and last[:3] == values[:3] and \
+                    all(a == b or (math.isnan(a) and math.isnan(b)) for a, b in zip(last[3:], values[3:])):
+                return False
+            self._index(key, self._size + self._buffered, values)
+            self._append(self.ENTRY.pack('L', int(timestamp if timestamp is not None else time.time()), key, *values))
+            if self._buffered >= self.buffer_size:
+                self._flush()
+            return True
+
+    def flush(self):
+        """
+        Write the buffered records to the log
+        :return: The number of bytes written
+        """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        """
+        Write the buffered records to the log (must be called holding the lock)
+        """
+        if not self._buffered:
+            return 0
+        written = self._buffered
+        self._file.write(''.join(self._buffer))
+        self._file.flush()
+        self._size += written
+        self._buffer = []
+        self._buffered = 0
+        return written
+
+    def _entry(self, values):
+        """
+        Build a HistoryEntry out of the values of a location record
+        """
+        timestamp, _, cc, rc, isp, lat, lon = values
+        return HistoryEntry(timestamp, intern_location('cc', self._strings[cc]) or None,
+                            intern_location('rc', self._strings[rc]) or None,
+                            intern_location('isp', self._strings[isp]) or None,
+                            None if math.isnan(lat) else lat, None if math.isnan(lon) else lon)
+
+    def history(self, guid=None, ip=None, limit=None):
+        """
+        Return the recorded locations of a client
+        :param guid: The client GUID
+        :param ip: The client IP address (used when the client has no GUID)
+        :param limit: The maximum number of entries to return (the most recent ones)
+        :return: list of HistoryEntry in chronological order
+        """
+        with self._lock:
+            self._load()
+            key = self._ids.get(self._key(guid, ip))
+            offsets = self._offsets.get(key) if key is not None else None
+            if not offsets:
+                return []
+            self._flush()
+            offsets = offsets[-limit:] if limit else offsets
+            oldest = time.time() - self.max_age if self.max_age else None
+            entries = []
+            with open(self.path, 'rb') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    values = self.ENTRY.unpack(f.read(self.ENTRY.size))
+                    if oldest is None or values[1] >= oldest:
+                        entries.append(self._entry(values[1:]))
+            return entries
+
+    def changes(self, guid=None, ip=None, field='isp', since=None):
+        """
+        Return the changes of the given location field of a client (i.e: isp or country hopping)
+        :param guid: The client GUID
+        :param ip: The client IP address (used when the client has no GUID)
+        :param field: The HistoryEntry field to look at (cc, rc or isp)
+        :param since: Consider only changes happened after this timestamp
+        :return: list of (before, after) HistoryEntry tuples in chronological order
+        """
+        entries = self.history(guid, ip)
+        changes = []
+        for before, after in zip(entries, entries[1:]):
+            if getattr(before, field) != getattr(after, field) and (since is None or after.timestamp >= since):
+                changes.append((before, after))
+        return changes
+
+    def compact(self, now=None):
+        """
+        Rewrite the log keeping only the records within the retention limits and the strings they use
+        :param now: The current timestamp (defaults to now)
+        :return: The number of location records removed
+        """
+        oldest = (now if now is not None else time.time()) - self.max_age if self.max_age else None
+        with self._lock:
+            if self._closed:
+                # closed while the compaction was waiting for the lock
+                return 0
+            self._load()
+            self._flush()
+            indexed = set()
+            for offsets in self._offsets.itervalues():
+                indexed.update(offsets)
+            path = self.path + '.tmp'
+            strings, ids, mapping, offsets, last = [], {}, {}, {}, {}
+            removed = 0
+            size = self.HEADER.size
+            with open(self.path, 'rb') as f, open(path, 'wb') as out:
+                f.seek(self.HEADER.size)
+                out.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+                for offset, end, tag, value in self._records(f):
+                    if offset >= self._size:
+                        break
+                    if tag != 'L':
+                        continue
+                    if offset not in indexed or (oldest is not None and value[1] < oldest):
+                        removed += 1
+                        continue
+                    values = []
+                    for i in value[2:6]:
+                        if i not in mapping:
+                            string = self._strings[i]
+                            mapping[i] = ids[string] = len(strings)
+                            strings.append(string)
+                            data = string.encode('utf-8')
+                            out.write(self.STRING.pack('S', mapping[i], len(data)) + data)
+                            size += self.STRING.size + len(data)
+                        values.append(mapping[i])
+                    values.extend(value[6:])
+                    out.write(self.ENTRY.pack('L', value[1], *values))
+                    offsets.setdefault(values[0], array('L')).append(size)
+                    last[values[0]] = tuple(values[1:])
+                    size += self.ENTRY.size
+            if not removed:
+                os.unlink(path)
+                return 0
+            self._file.close()
+            if os.name == 'nt':
+                # rename does not replace existing files on Windows
+                os.unlink(self.path)
+            os.rename(path, self.path)
+            self._file = open(self.path, 'ab')
+            self._size = size
+            self._strings = strings
+            self._ids = ids
+            self._offsets = offsets
+            self._last = last
+            return removed
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return sum(len(x) for x in self._offsets.itervalues())
+
+    def close(self):
+        """
+        Write the buffered records and close the log
+        """
+        with self._lock:
+            self._closed = True
+            if self._loaded:
+                self._flush()
+                self._file.close()
+                self._file = None
+                self._loaded = False
+                self._strings = []
+                self._ids = {}
+                self._offsets = {}
+                self._last = {}
@@ -0,0 +1,356 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import bisect
+import os
+import socket
+import threading
+
+from timeit import default_timer
+
+# histogram buckets upper bounds (in seconds) suitable for event handlers and commands
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# histogram buckets upper bounds (in seconds) suitable for event queue lag
+LAG_BUCKETS = (0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+
+
+class Histogram(object):
+    """
+    A fixed buckets histogram: observations are counted in the first bucket
+    whose upper bound is greater than or equal to the observed value.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        """
+        Object constructor.
+        :param buckets: The sorted list of buckets upper bounds (an unbounded bucket is appended automatically)
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Add an observation to the histogram
+        :param value: The observed value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def average(self):
+        """
+        Return the average of the observed values (None if nothing has been observed)
+        """
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """
+        Return an estimate of the given quantile, interpolating linearly inside the matching bucket
+        :param q: The quantile (i.e: 0.95)
+        :return: float or None if nothing has been observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def copy(self):
+        """
+        Return a copy of this histogram
+        """
+        other = Histogram(self.buckets)
+        other.counts = list(self.counts)
+        other.count = self.count
+        other.sum = self.sum
+        other.max = self.max
+        return other
+
+
+class Timer(object):
+    """
+    Context manager recording the time spent in a block of code in a histogram.
+    """
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, default_timer() - self.start, **self.labels)
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters, gauges and histograms. Every metric is
+    identified by its name and an optional set of labels (i.e: command=locate).
+    """
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        """
+        Return the key identifying a metric
+        """
+        return name, tuple(sorted(labels.iteritems()))
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increment a counter
+        :param name: The counter name
+        :param value: The increment
+        :param labels: The counter labels
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """
+        Set the current value of a gauge
+        :param name: The gauge name
+        :param value: The gauge value
+        :param labels: The gauge labels
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        """
+        Add an observation to a histogram
+        :param name: The histogram name
+        :param value: The observed value
+        :param buckets: The histogram buckets upper bounds (used only when the histogram is created)
+        :param labels: The histogram labels
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+        Return a context manager recording the time spent in a block of code
+        :param name: The histogram name
+        :param labels: The histogram labels
+        """
+        return Timer(self, name, labels)
+
+    def counter(self, name, **labels):
+        """
+        Return the current value of a counter (0 if it has never been incremented)
+        """
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        """
+        Return a copy of a histogram (None if nothing has been observed)
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            return histogram.copy() if histogram is not None else None
+
+    def snapshot(self):
+        """
+        Return a consistent copy of all the metrics
+        :return: dict with keys counters, gauges and histograms, each one mapping (name, labels) to the metric value
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': dict((k, v.copy()) for k, v in self._histograms.iteritems()),
+            }
+
+    def clear(self):
+        """
+        Reset all the metrics
+        """
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+
+def format_prometheus(snapshot):
+    """
+    Format a metrics snapshot using the Prometheus text exposition format
+    :param snapshot: The snapshot returned by Metrics.snapshot()
+    :return: str
+    """
+    def series(name, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                            for k, v in labels]))
+
+    lines = []
+    for kind, metrics in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+        declared = set()
+        for (name, labels), value in sorted(metrics.iteritems()):
+            if name not in declared:
+                lines.append('# TYPE %s %s' % (name, kind))
+                declared.add(name)
+            lines.append('%s %r' % (series(name, labels), value))
+
+    declared = set()
+    for (name, labels), histogram in sorted(snapshot['histograms'].iteritems()):
+        if name not in declared:
+            lines.append('# TYPE %s histogram' % name)
+            declared.add(name)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('%s %d' % (series(name + '_bucket', labels, (('le', bound),)), cumulative))
+        lines.append('%s %r' % (series(name + '_sum', labels), histogram.sum))
+        lines.append('%s %d' % (series(name + '_count', labels), histogram.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusExporter(object):
+    """
+    Write metrics to a text file in the Prometheus exposition format (to be
+    collected by the node_exporter textfile collector). The file is replaced
+    atomically so the collector never reads a partially written file.
+    """
+    def __init__(self, path):
+        """
+        Object constructor.
+        :param path: The path of the text file
+        """
+        self.path = path
+
+    def export(self, metrics):
+        """
+        Export the given metrics
+        :param metrics: The Metrics instance
+        """
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(format_prometheus(metrics.snapshot()))
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def close(self):
+        pass
+
+
+class StatsdExporter(object):
+    """
+    Send metrics to a StatsD compatible server over UDP. Counters are sent as
+    increments since the previous export, gauges as their current value, and
+    every histogram as the number of observations (counter) and the time spent
+    (in milliseconds, counter) since the previous export.
+    """
+    PACKET_SIZE = 512
+
+    def __init__(self, host, port=8125, prefix='b3.location'):
+        """
+        Object constructor.
+        :param host: The StatsD server host
+        :param port: The StatsD server port
+        :param prefix: The prefix of all the metric names
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sent = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        """
+        Return the StatsD name of a metric (label values become name components)
+        """
+        parts = [self.prefix, name] + [str(v).replace('.', '_').replace(' ', '_') for _, v in labels]
+        return '.'.join([x for x in parts if x])
+
+    def _delta(self, key, value):
+        """
+        Return the increment of a cumulative value since the previous export
+        """
+        delta = value - self._sent.get(key, 0)
+        self._sent[key] = value
+        return delta
+
+    def lines(self, snapshot):
+        """
+        Return the StatsD lines for the given metrics snapshot
+        """
+        lines = []
+        for (name, labels), value in sorted(snapshot['counters'].iteritems()):
+            delta = self._delta(('c', name, labels), value)
+            if delta:
+                lines.append('%s:%s|c' % (self._name(name, labels), delta))
+        for (name, labels), value in sorted(snapshot['gauges'].iteritems()):
+            lines.append('%s:%s|g' % (self._name(name, labels), value))
+        for (name, labels), histogram in sorted(snapshot['histograms'].iteritems()):
+            count = self._delta(('h', name, labels), histogram.count)
+            if count:
+                total = self._delta(('s', name, labels), histogram.sum)
+                lines.append('%s.count:%s|c' % (self._name(name, labels), count))
+                lines.append('%s.sum:%.3f|c' % (self._name(name, labels), total * 1000))
+        return lines
+
+    def export(self, metrics):
+        """
+        Export the given metrics
+        :param metrics: The Metrics instance
+        """
+        packet = ''
+        for line in self.lines(metrics.snapshot()):
+            if packet and len(packet) + len(line) + 1 > self.PACKET_SIZE:
+                self._socket.sendto(packet, self.address)
+                packet = ''
+            packet = packet + '\n' + line if packet else line
+        if packet:
+            self._socket.sendto(packet, self.address)
+
+    def close(self):
+        self._socket.close()
@@ -0,0 +1,131 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import bisect
+import re
+import threading
+import time
+
+
+class ClientResolver(object):
+    """
+    Resolve client handles given as command arguments with the same semantics
+    as b3.clients.Clients.getByMagic(), without scanning the whole client list
+    on every lookup. Connected clients are indexed by database id (@id) and by
+    every suffix of their whitespace stripped lowercase name, so that a partial
+    name is resolved with a binary search over the sorted suffixes. Results are
+    memoized for a short time: the index and the memoized results are dropped
+    as soon as the roster version changes (connect, disconnect, name change).
+    """
+    def __init__(self, clients, ttl=30):
+        """
+        Object constructor.
+        :param clients: The b3.clients.Clients instance of the console
+        :param ttl: The number of seconds a resolved handle is memoized for
+        """
+        self.clients = clients
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._built = None
+        self._suffixes = []
+        self._owners = []
+        self._order = {}
+        self._ids = {}
+        self._memo = {}
+
+    def invalidate(self):
+        """
+        Notify a roster change: the index is rebuilt on the next lookup
+        """
+        with self._lock:
+            self.version += 1
+            self._memo = {}
+
+    def resolve(self, handle):
+        """
+        Return the list of clients matching the given handle
+        :param handle: The search handle (slot number, @id, \\exactname or partial name)
+        :return: list of clients
+        """
+        handle = handle.strip()
+        if handle.isdigit() or handle[:1] == '\\':
+            # slot numbers and exact names are already resolved through the client list indexes
+            return self.clients.getByMagic(handle)
+
+        with self._lock:
+            version = self.version
+            now = time.time()
+            entry = self._memo.get(handle)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+            if self._built != version:
+                self._build()
+            if re.match(r'^@([0-9]+)$', handle):
+                client = self._ids.get(handle)
+                result = [client] if client else None
+            else:
+                result = self._search(re.sub(r'\s', '', handle.lower()))
+
+        if result is None:
+            # not connected: let B3 look the client up in the storage
+            result = self.clients.getByMagic(handle)
+
+        with self._lock:
+            if self.version == version:
+                self._memo[handle] = (now + self.ttl, tuple(result))
+        return result
+
+    def _build(self):
+        """
+        Rebuild the index out of the connected clients (must be called holding the lock)
+        """
+        entries = []
+        self._order = {}
+        self._ids = {}
+        for client in self.clients.values():
+            if client.id:
+                self._ids['@%s' % client.id] = client
+            if client.hide or not client.name:
+                continue
+            self._order[client.cid] = len(self._order)
+            name = re.sub(r'\s', '', client.name.lower())
+            entries.extend((name[i:], client) for i in xrange(len(name)))
+        entries.sort(key=lambda x: x[0])
+        self._suffixes = [x[0] for x in entries]
+        self._owners = [x[1] for x in entries]
+        self._built = self.version
+
+    def _search(self, needle):
+        """
+        Return the clients whose name contains the given needle (must be called holding the lock)
+        """
+        if not needle:
+            found = dict((x.cid, x) for x in self._owners)
+        else:
+            found = {}
+            i = bisect.bisect_left(self._suffixes, needle)
+            while i < len(self._suffixes) and self._suffixes[i].startswith(needle):
+                client = self._owners[i]
+                found[client.cid] = client
+                i += 1
+        return sorted(found.itervalues(), key=lambda x: self._order[x.cid])
@@ -0,0 +1,394 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import json
+import os
+import socket
+import SocketServer
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+from .store import LocationRecord
+from .strings import intern_location
+
+
+class SharedCacheServer(object):
+    """
+    In memory location cache shared by all the B3 instances running on the
+    same host, served over a Unix socket by one of them. Records are keyed by
+    client GUID (or IP address when the GUID is not available) and follow
+    these rules:
+
+      - a record is replaced only by a record with a newer (or equal) update
+        timestamp, so a late write can't overwrite a fresher location
+      - records older than the TTL are never returned and get evicted
+      - when the cache is full the least recently used record is evicted
+    """
+    def __init__(self, ttl, capacity=10000):
+        """
+        Object constructor.
+        :param ttl: The number of seconds a record is valid for
+        :param capacity: The maximum number of records kept in memory
+        """
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._ips = {}
+        self._server = None
+        self._thread = None
+        self._connections = set()
+
+    def handle(self, request):
+        """
+        Execute a request and return the reply
+        :param request: dict with key op (put, get, evict, len) and the operation arguments
+        :return: dict
+        """
+        op = request.get('op')
+        with self._lock:
+            if op == 'put':
+                return {'stored': self._put(request['key'], request.get('ip'), request['record'],
+                                            request['updated'])}
+            if op == 'get':
+                return self._get(request.get('key'), request.get('ip'))
+            if op == 'evict':
+                return {'removed': self._evict()}
+            if op == 'len':
+                return {'size': len(self._records)}
+        raise ValueError('invalid operation: %r' % op)
+
+    def _put(self, key, ip, record, updated):
+        """
+        Store a record (must be called holding the lock)
+        :return: True if the record has been stored, False if a newer one is already cached
+        """
+        current = self._records.get(key)
+        if current is not None and current[0] > updated:
+            return False
+        if current is not None and current[1] and self._ips.get(current[1]) == key:
+            del self._ips[current[1]]
+        self._records.pop(key, None)
+        self._records[key] = (updated, ip, dict((k, intern_location(k, v)) for k, v in record.iteritems()))
+        if ip:
+            other = self._records.get(self._ips.get(ip))
+            if other is None or other[0] <= updated:
+                self._ips[ip] = key
+        if len(self._records) > self.capacity:
+            self._evict()
+            while len(self._records) > self.capacity:
+                self._remove(next(iter(self._records)))
+        return True
+
+    def _get(self, key, ip):
+        """
+        Return the most recent valid record matching the key, or the IP address (must be called holding the lock)
+        """
+        limit = time.time() - self.ttl
+        for k in (key, self._ips.get(ip) if ip else None):
+            entry = self._records.get(k) if k else None
+            if entry is not None and entry[0] >= limit:
+                # move to the end of the LRU order
+                del self._records[k]
+                self._records[k] = entry
+                return {'record': entry[2], 'updated': entry[0]}
+        return {'record': None}
+
+    def _remove(self, key):
+        """
+        Remove a record (must be called holding the lock)
+        """
+        updated, ip, record = self._records.pop(key)
+        if ip and self._ips.get(ip) == key:
+            del self._ips[ip]
+
+    def _evict(self):
+        """
+        Remove expired records (must be called holding the lock)
+        :return: The number of records removed
+        """
+        limit = time.time() - self.ttl
+        expired = [k for k, v in self._records.iteritems() if v[0] < limit]
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+    def serve(self, path):
+        """
+        Start serving requests on the given Unix socket in a background thread
+        :param path: The path of the Unix socket
+        """
+        cache = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+
+            def handle(self):
+                with cache._lock:
+                    cache._connections.add(self.request)
+                try:
+                    for line in iter(self.rfile.readline, ''):
+                        try:
+                            reply = cache.handle(json.loads(line))
+                        except Exception, e:
+                            reply = {'error': str(e)}
+                        self.wfile.write(json.dumps(reply) + '\n')
+                        self.wfile.flush()
+                except socket.error:
+                    pass
+                finally:
+                    with cache._lock:
+                        cache._connections.discard(self.request)
+
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError('%s exists and is not a Unix socket' % path)
+            if not self._stale(path):
+                raise socket.error(errno.EADDRINUSE, '%s is in use by another process' % path)
+            # left behind by an instance which is not running anymore
+            os.unlink(path)
+        self._server = SocketServer.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='location-shared-cache')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @staticmethod
+    def _stale(path):
+        """
+        Whether the given Unix socket has been left behind by a process which is not running anymore
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(0.5)
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            return e.errno in (errno.ECONNREFUSED, errno.ENOENT)
+        finally:
+            sock.close()
+        return False
+
+    def shutdown(self):
+        """
+        Stop serving requests
+        """
+        if self._server is not None:
+            path = self._server.server_address
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            with self._lock:
+                # make the other instances notice that this one is not serving anymore
+                for connection in self._connections:
+                    try:
+                        connection.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                self._connections.clear()
+            self._server = None
+            self._thread = None
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class SharedCache(object):
+    """
+    Client of the location cache shared by the B3 instances running on the
+    same host. It exposes the same methods as LocationStore. The first
+    instance acquiring the lock file next to the Unix socket serves the cache
+    for all the others; when it goes away, the next instance which fails to
+    reach the socket takes over (with an empty cache). The socket is opened
+    on first use.
+    """
+    def __init__(self, path, ttl, capacity=10000, timeout=0.5):
+        """
+        Object constructor.
+        :param path: The path of the Unix socket
+        :param ttl: The number of seconds a record is valid for
+        :param capacity: The maximum number of records kept by the serving instance
+        :param timeout: The number of seconds to wait for the serving instance to reply
+        """
+        if os.path.lexists(path) and not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise ValueError('%s exists and is not a Unix socket' % path)
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+        self._server = None
+        self._lockfile = None
+
+    @property
+    def connected(self):
+        """
+        Whether the cache is being served by this instance or this instance is connected to the serving one
+        """
+        return self._server is not None or self._socket is not None
+
+    @property
+    def serving(self):
+        """
+        Whether this instance is serving the cache
+        """
+        return self._server is not None
+
+    def _elect(self):
+        """
+        Start serving the cache if no other instance is doing it (must be called holding the lock)
+        :return: True if this instance is now serving the cache
+        """
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        lockfile = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lockfile.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        server = SharedCacheServer(self.ttl, self.capacity)
+        try:
+            server.serve(self.path)
+        except Exception:
+            lockfile.close()
+            raise
+        self._server = server
+        self._lockfile = lockfile
+        return True
+
+    def _connect(self):
+        """
+        Connect to the serving instance, or start serving the cache (must be called holding the lock)
+        """
+        if self.connected:
+            return
+        if self._elect():
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self._socket = sock
+        self._file = sock.makefile('rb')
+
+    def _disconnect(self):
+        """
+        Drop the connection with the serving instance (must be called holding the lock)
+        """
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+            self._file = None
+
+    def _request(self, request):
+        """
+        Send a request to the serving instance and return the reply (retried once on a broken connection)
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                self._connect()
+                if self._server is not None:
+                    return self._server.handle(request)
+                try:
+                    self._socket.sendall(json.dumps(request) + '\n')
+                    line = self._file.readline()
+                    if not line:
+                        raise socket.error(errno.ECONNRESET, 'connection closed by the serving instance')
+                except socket.error:
+                    self._disconnect()
+                    if attempt == 2:
+                        raise
+                    continue
+                reply = json.loads(line)
+                if 'error' in reply:
+                    raise ValueError(reply['error'])
+                return reply
+
+    @staticmethod
+    def _key(guid, ip):
+        """
+        Return the key used to store a client location
+        """
+        return guid or 'ip:%s' % ip
+
+    def put(self, guid, ip, location, updated=None):
+        """
+        Store the location of a client
+        :param guid: The client GUID
+        :param ip: The client IP address
+        :param location: The client location object
+        :param updated: The timestamp of the update (defaults to now)
+        :return: True if the location has been stored, False if a more recent one is already cached
+        """
+        if not guid and not ip:
+            return False
+        record = LocationRecord.fromLocation(location)
+        return self._request({
+            'op': 'put',
+            'key': self._key(guid, ip),
+            'ip': ip,
+            'record': dict((x, getattr(record, x)) for x in LocationRecord.FIELDS),
+            'updated': int(updated if updated is not None else time.time()),
+        })['stored']
+
+    def get(self, guid=None, ip=None):
+        """
+        Return the last known location of a client
+        :param guid: The client GUID
+        :param ip: The client IP address (used when no record matches the GUID)
+        :return: LocationRecord or None if there is no valid record
+        """
+        reply = self._request({'op': 'get', 'key': guid, 'ip': ip})
+        if not reply['record']:
+            return None
+        return LocationRecord(updated=reply['updated'], **reply['record'])
+
+    def evict(self):
+        """
+        Remove expired records
+        :return: The number of records removed
+        """
+        return self._request({'op': 'evict'})['removed']
+
+    def __len__(self):
+        return self._request({'op': 'len'})['size']
+
+    def close(self):
+        """
+        Disconnect from the serving instance, or stop serving the cache
+        """
+        with self._lock:
+            self._disconnect()
+            if self._server is not None:
+                self._server.shutdown()
+                self._server = None
+                self._lockfile.close()
+                self._lockfile = None
@@ -0,0 +1,101 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+
+
+class LoadShedder(object):
+    """
+    Track the load of the B3 event processing out of the event queue size and
+    the event lag (time elapsed between an event being created and handled),
+    and turn it into a load level:
+
+      - NORMAL: both below their thresholds
+      - DEGRADED: one of them above its threshold
+      - CRITICAL: one of them above twice its threshold
+
+    The level is raised as soon as the load grows, while it's lowered by one
+    step only after the load stayed below the current level for the recovery
+    time, so that a single quiet sample doesn't make the plugin flap between
+    levels. A lag sample is considered for the recovery time as well, since
+    the lag is only known when an event is handled.
+    """
+    NORMAL = 0
+    DEGRADED = 1
+    CRITICAL = 2
+
+    NAMES = ('normal', 'degraded', 'critical')
+
+    def __init__(self, queue_size=10, lag=3, recovery=30):
+        """
+        Object constructor.
+        :param queue_size: The event queue size above which the load is considered high (0 = ignore)
+        :param lag: The event lag (in seconds) above which the load is considered high (0 = ignore)
+        :param recovery: The number of seconds the load must stay low before lowering the level
+        """
+        self.queue_size = queue_size
+        self.lag = lag
+        self.recovery = recovery
+        self.level = self.NORMAL
+        self._lock = threading.Lock()
+        self._lag = 0.0
+        self._lag_time = 0
+        self._calm = None
+
+    @property
+    def name(self):
+        """
+        The name of the current load level
+        """
+        return self.NAMES[self.level]
+
+    def _pressure(self, value, threshold):
+        """
+        Return the load level matching the given value
+        """
+        if threshold <= 0 or value < threshold:
+            return self.NORMAL
+        return self.CRITICAL if value >= 2 * threshold else self.DEGRADED
+
+    def sample(self, queue_size=0, lag=None, now=None):
+        """
+        Update the load level with a new sample
+        :param queue_size: The current size of the event queue
+        :param lag: The lag of the event being handled (None if not handling an event)
+        :param now: The current timestamp (defaults to now)
+        :return: The load level
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if lag is not None:
+                self._lag = lag
+                self._lag_time = now
+            elif now - self._lag_time > self.recovery:
+                self._lag = 0.0
+            pressure = max(self._pressure(queue_size, self.queue_size), self._pressure(self._lag, self.lag))
+            if pressure >= self.level:
+                self.level = pressure
+                self._calm = None
+            elif self._calm is None:
+                self._calm = now
+            elif now - self._calm >= self.recovery:
+                self.level -= 1
+                self._calm = now if self.level > pressure else None
+            return self.level
@@ -0,0 +1,64 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from collections import namedtuple
+from .geo import GeoPoint
+from .strings import intern_location
+
+
+def _normalize(value):
+    """
+    Return the given location attribute as displayed in messages ('--' when not available)
+    """
+    if isinstance(value, basestring):
+        value = value.strip()
+    return value if value else '--'
+
+
+def _coordinate(value):
+    """
+    Return the given coordinate as a float (None when not available or not valid)
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LocationSnapshot(namedtuple('LocationSnapshot', 'country region city cc rc isp timezone zipcode lat lon point')):
+    """
+    Immutable copy of a client location taken when the client is geolocated:
+    strings are normalized ('--' when not available) and interned, coordinates
+    are parsed into floats and the trigonometric data needed to compute
+    distances is precomputed, so reading any field is a plain attribute access.
+    """
+    __slots__ = ()
+
+    STRINGS = ('country', 'region', 'city', 'cc', 'rc', 'isp', 'timezone', 'zipcode')
+
+    @classmethod
+    def fromLocation(cls, location):
+        """
+        Build a snapshot out of a location object
+        :param location: The location object attached to the client by the geolocation plugin
+        """
+        values = [intern_location(x, _normalize(getattr(location, x, None))) for x in cls.STRINGS]
+        lat = _coordinate(getattr(location, 'lat', None))
+        lon = _coordinate(getattr(location, 'lon', None))
+        point = GeoPoint(lat, lon) if lat is not None and lon is not None else None
+        return cls(*(values + [lat, lon, point]))
@@ -0,0 +1,170 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import math
+
+from array import array
+from collections import Counter
+from .geo import EARTH_RADIUS
+from .geo import get_numpy
+from .strings import STRINGS
+
+
+class GeoStats(object):
+    """
+    Population statistics maintained incrementally as clients are added and
+    removed: counters by country code, region code and isp, plus a histogram
+    of pairwise distances (1 Km resolution) used to compute average and median
+    distance without storing every pair.
+    """
+    RESOLUTION = 1.0  # histogram bin width in Km
+    BINS = int(math.pi * EARTH_RADIUS / RESOLUTION) + 2
+
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self.cc = Counter()
+        self.rc = Counter()
+        self.isp = Counter()
+        self._entries = {}
+        self._bins = None  # allocated when the first distance is added
+        self._count = 0
+        self._total = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, cc, rc, isp, distances=None):
+        """
+        Add a client to the statistics.
+        To update a client already added call remove() first, passing its current distances.
+        :param key: The key identifying the client
+        :param cc: The client country code
+        :param rc: The client region code (should be qualified with the country code)
+        :param isp: The client isp
+        :param distances: The distances from the other clients with coordinates (None if the client has none)
+        """
+        if key in self._entries:
+            self.remove(key)
+        cc = STRINGS['cc'].intern(cc)
+        rc = STRINGS['cc-rc'].intern(rc)
+        isp = STRINGS['isp'].intern(isp)
+        self._entries[key] = (cc, rc, isp)
+        self.cc[cc] += 1
+        self.rc[rc] += 1
+        self.isp[isp] += 1
+        if distances is not None:
+            self._histogram(distances, 1)
+
+    def remove(self, key, distances=None):
+        """
+        Remove a client from the statistics
+        :param key: The key identifying the client
+        :param distances: The distances from the other clients with coordinates (None if the client has none)
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for counter, value in zip((self.cc, self.rc, self.isp), entry):
+            counter[value] -= 1
+            if counter[value] <= 0:
+                del counter[value]
+        if distances is not None:
+            self._histogram(distances, -1)
+
+    def clear(self):
+        """
+        Remove all the clients from the statistics
+        """
+        self.__init__()
+
+    def _histogram(self, distances, sign):
+        """
+        Add (sign = 1) or remove (sign = -1) the given distances from the histogram
+        """
+        numpy = get_numpy()
+        if self._bins is None:
+            self._bins = numpy.zeros(self.BINS, dtype=numpy.int64) if numpy is not None else array('l', [0]) * self.BINS
+        if numpy is not None:
+            distances = numpy.asarray(distances, dtype=numpy.float64)
+            if not distances.size:
+                return
+            bins = numpy.minimum((distances / self.RESOLUTION).astype(numpy.int64), self.BINS - 1)
+            self._bins += sign * numpy.bincount(bins, minlength=self.BINS)
+            self._count += sign * int(distances.size)
+            self._total += sign * float(distances.sum())
+        else:
+            limit = self.BINS - 1
+            for distance in distances:
+                self._bins[min(int(distance / self.RESOLUTION), limit)] += sign
+                self._count += sign
+                self._total += sign * distance
+        if not self._count:
+            self._total = 0.0
+
+    def _bin(self, position):
+        """
+        Return the midpoint of the histogram bin holding the distance at the given position (in sorted order)
+        """
+        numpy = get_numpy()
+        if numpy is not None:
+            i = int(numpy.searchsorted(numpy.cumsum(self._bins), position, side='right'))
+        else:
+            i = seen = 0
+            for i, count in enumerate(self._bins):
+                seen += count
+                if seen > position:
+                    break
+        return (i + 0.5) * self.RESOLUTION
+
+    def average(self):
+        """
+        Return the average pairwise distance (None if less than 2 clients have coordinates)
+        """
+        if not self._count:
+            return None
+        return self._total / self._count
+
+    def median(self):
+        """
+        Return the median pairwise distance, with 1 Km resolution (None if less than 2 clients have coordinates)
+        """
+        count = self._count
+        if not count:
+            return None
+        if count % 2:
+            return self._bin(count // 2)
+        return (self._bin(count // 2 - 1) + self._bin(count // 2)) / 2
+
+    def summary(self):
+        """
+        Return a snapshot of the statistics
+        :return: dict
+        """
+        return {
+            'population': len(self._entries),
+            'cc': dict(self.cc),
+            'rc': dict(self.rc),
+            'isp': dict(self.isp),
+            'average_distance': self.average(),
+            'median_distance': self.median(),
+        }
@@ -0,0 +1,249 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from .strings import intern_location
+
+
+class LocationRecord(object):
+    """
+    A location retrieved from the persistent store: exposes the same attributes
+    as the location objects attached to clients by the geolocation plugin.
+    """
+    FIELDS = ('country', 'region', 'city', 'cc', 'rc', 'isp', 'timezone', 'lat', 'lon', 'zipcode')
+
+    __slots__ = FIELDS + ('updated',)
+
+    def __init__(self, updated=None, **kwargs):
+        """
+        Object constructor.
+        :param updated: The timestamp of the last update of this record
+        :param kwargs: The location attributes
+        """
+        for field in self.FIELDS:
+            setattr(self, field, intern_location(field, kwargs.get(field)))
+        self.updated = updated
+
+    def __repr__(self):
+        return 'LocationRecord(%s)' % ', '.join(['%s=%r' % (x, getattr(self, x)) for x in self.FIELDS])
+
+    @classmethod
+    def fromLocation(cls, location, updated=None):
+        """
+        Build a record out of a location object
+        :param location: The location object
+        :param updated: The timestamp of the last update of this record
+        """
+        return cls(updated=updated, **dict((x, getattr(location, x, None)) for x in cls.FIELDS))
+
+
+class LocationStore(object):
+    """
+    Persist the last known location of clients in a SQLite database, keyed by
+    client GUID (or IP address when the GUID is not available): records older
+    than the configured TTL are never returned and get evicted by evict().
+    The database is opened on first use, so that B3 startup does not wait for
+    the SQLite module import and the schema creation. Writes are collected in
+    memory and stored with a single transaction when flush() is called (or
+    when the buffer is full), so geolocating a client never waits for a disk
+    sync: buffered records are returned by get() like stored ones. While the
+    database can't be written the buffer keeps only the most recent records.
+    """
+    def __init__(self, path, ttl, buffer_size=1000):
+        """
+        Object constructor.
+        :param path: The path of the SQLite database file
+        :param ttl: The number of seconds a record is valid for
+        :param buffer_size: The number of buffered records triggering a flush
+        """
+        self.path = path
+        self.ttl = ttl
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._db = None
+        self._pending = OrderedDict()
+        self.errors = 0
+
+    @property
+    def connected(self):
+        """
+        Whether the database has been opened
+        """
+        return self._db is not None
+
+    def _connect(self):
+        """
+        Return the database connection, opening it if needed (must be called holding the lock)
+        """
+        if self._db is not None:
+            return self._db
+        import sqlite3
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # a crash may lose the last transactions but never corrupts the database
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS locations (
+                              guid TEXT PRIMARY KEY,
+                              ip TEXT,
+                              country TEXT,
+                              region TEXT,
+                              city TEXT,
+                              cc TEXT,
+                              rc TEXT,
+                              isp TEXT,
+                              timezone TEXT,
+                              lat REAL,
+                              lon REAL,
+                              zipcode TEXT,
+                              updated INTEGER NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS locations_ip ON locations (ip)")
+        db.commit()
+        self._db = db
+        return db
+
+    @staticmethod
+    def _key(guid, ip):
+        """
+        Return the key used to store a client location
+        """
+        return guid or 'ip:%s' % ip
+
+    def put(self, guid, ip, location, updated=None):
+        """
+        Store the location of a client
+        :param guid: The client GUID
+        :param ip: The client IP address
+        :param location: The client location object
+        :param updated: The timestamp of the update (defaults to now)
+        """
+        if not guid and not ip:
+            return
+        record = LocationRecord.fromLocation(location, int(updated if updated is not None else time.time()))
+        key = self._key(guid, ip)
+        with self._lock:
+            # the last location of a client replaces the buffered one
+            self._pending.pop(key, None)
+            self._pending[key] = (ip, record)
+            if len(self._pending) >= self.buffer_size:
+                try:
+                    self._flush()
+                finally:
+                    while len(self._pending) > self.buffer_size:
+                        self._pending.popitem(last=False)
+
+    def flush(self):
+        """
+        Store the buffered records in the database
+        :return: The number of records stored
+        """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        """
+        Store the buffered records in the database (must be called holding the lock)
+        """
+        if not self._pending:
+            return 0
+        rows = [[key, ip] + [getattr(record, x) for x in LocationRecord.FIELDS] + [record.updated]
+                for key, (ip, record) in self._pending.iteritems()]
+        try:
+            db = self._connect()
+            db.executemany("INSERT OR REPLACE INTO locations (guid, ip, %s, updated) VALUES (%s)" % (
+                           ', '.join(LocationRecord.FIELDS), ', '.join(['?'] * len(rows[0]))), rows)
+            db.commit()
+        except Exception:
+            self.errors += 1
+            raise
+        self.errors = 0
+        self._pending = OrderedDict()
+        return len(rows)
+
+    def _buffered(self, key, ip, limit):
+        """
+        Return the most recent valid buffered record matching the key, or the IP address (must be called holding
+        the lock)
+        """
+        entry = self._pending.get(key) if key else None
+        if entry is None and ip:
+            for x in self._pending.itervalues():
+                if x[0] == ip and (entry is None or x[1].updated >= entry[1].updated):
+                    entry = x
+        if entry is None or entry[1].updated < limit:
+            return None
+        return entry[1]
+
+    def get(self, guid=None, ip=None):
+        """
+        Return the last known location of a client
+        :param guid: The client GUID
+        :param ip: The client IP address (used when no record matches the GUID)
+        :return: LocationRecord or None if there is no valid record
+        """
+        limit = int(time.time() - self.ttl)
+        query = "SELECT %s, updated FROM locations WHERE %%s AND updated >= ? ORDER BY updated DESC LIMIT 1" % \
+                ', '.join(LocationRecord.FIELDS)
+        with self._lock:
+            db = self._connect()
+            if guid:
+                record = self._buffered(guid, None, limit)
+                if record is not None:
+                    return record
+                row = db.execute(query % 'guid = ?', (guid, limit)).fetchone()
+                if row:
+                    return LocationRecord(updated=row[-1], **dict(zip(LocationRecord.FIELDS, row)))
+            if not ip:
+                return None
+            record = self._buffered(None, ip, limit)
+            row = db.execute(query % 'ip = ?', (ip, limit)).fetchone()
+        if row and (record is None or row[-1] > record.updated):
+            return LocationRecord(updated=row[-1], **dict(zip(LocationRecord.FIELDS, row)))
+        return record
+
+    def evict(self):
+        """
+        Remove expired records
+        :return: The number of records removed
+        """
+        with self._lock:
+            self._flush()
+            db = self._connect()
+            cursor = db.execute("DELETE FROM locations WHERE updated < ?", (int(time.time() - self.ttl),))
+            db.commit()
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._lock:
+            self._flush()
+            return self._connect().execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+
+    def close(self):
+        """
+        Store the buffered records and close the database connection
+        """
+        with self._lock:
+            try:
+                self._flush()
+            finally:
+                if self._db is not None:
+                    self._db.close()
+                    self._db = None
@@ -0,0 +1,103 @@
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+
+
+class StringTable(object):
+    """
+    Table of interned strings: every distinct value is stored once and gets
+    a small integer id, so that the location caches, the statistics and the
+    history of thousands of clients share a single copy of values such as
+    'United States' or 'Google Inc.' (unicode values included, which the
+    builtin intern() does not accept). Values are keyed by type as well, so
+    that a str lookup never returns an equal unicode copy (or vice versa).
+    Entries are never removed: tables are bounded by the number of distinct
+    countries, regions, cities and isps.
+    """
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._strings = []
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __contains__(self, value):
+        return (type(value), value) in self._ids
+
+    def id(self, value):
+        """
+        Return the id of the given string, adding it to the table if needed
+        :param value: The string
+        :return: int
+        """
+        key = (type(value), value)
+        i = self._ids.get(key)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(key)
+                if i is None:
+                    # the string is added before its id is published to readers not holding the lock
+                    self._strings.append(value)
+                    i = self._ids[key] = len(self._strings) - 1
+        return i
+
+    def get(self, i):
+        """
+        Return the string having the given id
+        :param i: The string id
+        :return: str
+        """
+        return self._strings[i]
+
+    def intern(self, value):
+        """
+        Return the shared copy of the given string (non string values are returned as they are)
+        :param value: The string
+        :return: str
+        """
+        if not isinstance(value, basestring):
+            return value
+        return self._strings[self.id(value)]
+
+
+# tables shared by all the plugin features, by location attribute
+STRINGS = {
+    'country': StringTable(),
+    'region': StringTable(),
+    'city': StringTable(),
+    'cc': StringTable(),
+    'rc': StringTable(),
+    'isp': StringTable(),
+    'timezone': StringTable(),
+    'cc-rc': StringTable(),  # country qualified region codes (i.e: IT-07) used by the statistics
+}
+
+
+def intern_location(attr, value):
+    """
+    Return the shared copy of the given location attribute value
+    :param attr: The location attribute name (i.e: country)
+    :param value: The attribute value
+    """
+    table = STRINGS.get(attr)
+    return table.intern(value) if table is not None else value
@@ -17,9 +17,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import os
 import time
+import random
+import socket
+import threading
 import logging
+import tempfile
 import unittest2
+import b3
 
 from mock import Mock
 from mockito import when, unstub
@@ -27,6 +33,28 @@ from b3.config import MainConfig
 from b3.config import CfgConfigParser
 from b3.plugins.admin import AdminPlugin
 from location import LocationPlugin
+from location import MessageTemplate
+from location import WorkerPool
+from location.geo import DistanceMatrix
+from location.geo import GeoPoint
+from location.geo import SpatialIndex
+from location.stats import GeoStats
+from location.snapshot import LocationSnapshot
+from location.history import LocationHistory
+from location.shared import SharedCache
+from location.shedding import LoadShedder
+from location.store import LocationStore
+from location.store import LocationRecord
+from location.strings import STRINGS
+from location.strings import StringTable
+from location.geo import haversine
+from location.geo import DISTANCE_MODELS
+from location.geo import distance_lookup
+from location.geo import distance_vincenty
+from location.metrics import Histogram
+from location.metrics import Metrics
+from location.metrics import StatsdExporter
+from location.metrics import format_prometheus
 from textwrap import dedent
 
 
@@ -54,6 +82,18 @@ LOCATION_BILL.lat = 37.386
 LOCATION_BILL.lon = -122.0838
 LOCATION_BILL.zipcode = 94035
 
+LOCATION_MARK = Mock()
+LOCATION_MARK.country = 'Italy'
+LOCATION_MARK.region = 'Lombardia'
+LOCATION_MARK.city = 'Milan'
+LOCATION_MARK.cc = 'IT'
+LOCATION_MARK.rc = '09'
+LOCATION_MARK.isp = 'Telecom Italia'
+LOCATION_MARK.timezone = 'Europe/Rome'
+LOCATION_MARK.lat = 45.4643
+LOCATION_MARK.lon = 9.1895
+LOCATION_MARK.zipcode = 20121
+
 
 class logging_disabled(object):
     """
@@ -115,6 +155,8 @@ class LocationTestCase(unittest2.TestCase):
 
             [messages]
             client_connect: ^7$name ^3from ^7$city ^3(^7$country^3) connected
+            client_connect_many: ^7$count ^3players connected from ^7$countries
+            client_connect_short: ^7$name ^3(^7$cc^3)
             cmd_locate: ^7$name ^3is connected from ^7$city ^3(^7$country^3)
             cmd_locate_failed: ^7Could not locate ^1$name
             cmd_distance: ^7$name ^3is ^7$distance ^3km away from you
@@ -122,11 +164,25 @@ class LocationTestCase(unittest2.TestCase):
             cmd_distance_failed: ^7Could not compute distance with ^1$name
             cmd_isp: ^7$name ^3is using ^7$isp ^3as isp
             cmd_isp_failed: ^7Could not determine ^1$name ^7isp
+            cmd_nearest: ^7$name ^3is the nearest player: ^7$distance ^3km away from you
+            cmd_nearest_failed: ^7Could not find any player near you
+            cmd_farthest: ^7$name ^3is the farthest player: ^7$distance ^3km away from you
+            cmd_farthest_failed: ^7Could not find any player far from you
+            cmd_nearby: ^3Players within ^7$distance ^3km: ^7$players
+            cmd_nearby_failed: ^7Could not find any player within ^1$distance ^7km from you
+            cmd_geostats: ^7$count ^3players from ^7$countries ^3| average distance: ^7$average ^3km | median distance: ^7$median ^3km
+            cmd_geostats_failed: ^7No geolocation data available
 
             [commands]
             locate: user
             distance: user
             isp: mod
+            nearest: user
+            farthest: user
+            nearby: user
+            geostats: mod
+            locstats: admin
+            lochistory: mod
         """))
 
         self.p = LocationPlugin(self.console, self.conf)
@@ -138,10 +194,13 @@ class LocationTestCase(unittest2.TestCase):
 
         self.mike = FakeClient(console=self.console, name="Mike", guid="MIKEGUID", groupBits=1)
         self.bill = FakeClient(console=self.console, name="Bill", guid="BILLGUID", groupBits=16)
+        self.mark = FakeClient(console=self.console, name="Mark", guid="MARKGUID", groupBits=1)
         self.mike.location = LOCATION_MIKE
         self.bill.location = LOCATION_BILL
+        self.mark.location = LOCATION_MARK
 
     def tearDown(self):
+        self.p.onDisable()
         unstub()
 
     ####################################################################################################################
@@ -159,6 +218,125 @@ class LocationTestCase(unittest2.TestCase):
         # THEN
         self.console.say.assert_called_with('^7Mike ^3from ^7Rome ^3(^7Italy^3) connected')
 
+    def test_event_client_geolocation_success_batched(self):
+        # GIVEN
+        self.conf.set('settings', 'announce_window', '60')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.console.say = Mock()
+        # WHEN
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # THEN
+        self.assertFalse(self.console.say.called)
+        self.assertEqual(3, len(self.p._announcer))
+        # WHEN
+        self.p._announcer.flush()
+        # THEN
+        self.console.say.assert_called_once_with('^73 ^3players connected from ^7Italy, United States')
+        self.assertEqual(0, len(self.p._announcer))
+
+    def test_event_client_geolocation_success_batched_single(self):
+        # GIVEN
+        self.conf.set('settings', 'announce_window', '60')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.console.say = Mock()
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p._announcer.flush()
+        # THEN
+        self.console.say.assert_called_once_with('^7Mike ^3from ^7Rome ^3(^7Italy^3) connected')
+
+    def test_event_client_geolocation_success_batched_flush_cancels_timer(self):
+        # GIVEN
+        self.conf.set('settings', 'announce_window', '60')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        timer = self.p._announcer._timer
+        # WHEN
+        self.p._announcer.flush()
+        self.p.onDisable()
+        # THEN
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+        self.assertIsNone(self.p._announcer._timer)
+
+    def test_event_client_geolocation_success_rate_limited(self):
+        # GIVEN
+        self.conf.set('settings', 'announce_rate', '0.001')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.console.say = Mock()
+        # WHEN
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # THEN
+        self.console.say.assert_called_once_with('^7Mike ^3from ^7Rome ^3(^7Italy^3) connected')
+        self.assertEqual(2, len(self.p._announcer))
+
+    def test_event_client_geolocation_success_workers(self):
+        # GIVEN
+        self.conf.set('settings', 'workers', '2')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.console.say = Mock()
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p._pool.join()
+        # THEN
+        self.console.say.assert_called_once_with('^7Mike ^3from ^7Rome ^3(^7Italy^3) connected')
+
+    def test_message_template_default(self):
+        # GIVEN
+        self.conf.remove_option('messages', 'cmd_isp')
+        # WHEN
+        self.p.onLoadConfig()
+        # THEN
+        self.assertEqual('^7%(name)s ^3is using ^7%(isp)s ^3as isp', self.p._templates['cmd_isp'].text)
+
+    def test_event_client_disconnect(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.assertIn('1', self.p._matrix)
+        # WHEN
+        self.mike.disconnects()
+        # THEN
+        self.assertNotIn('1', self.p._matrix)
+        self.assertNotIn('1', self.p._snapshots)
+
+    def test_geopoint_cached_on_geolocation(self):
+        # GIVEN
+        self.mike.connects('1')
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # THEN
+        location, snapshot = self.p._snapshots['1']
+        self.assertIs(LOCATION_MIKE, location)
+        self.assertIs(snapshot, self.p.getSnapshot(self.mike))
+        self.assertIs(snapshot.point, self.p.getGeoPoint(self.mike))
+        self.assertEqual('Rome', snapshot.city)
+        self.assertAlmostEqual(41.9, snapshot.point.lat)
+        self.assertAlmostEqual(12.4833, snapshot.point.lon)
+
+    def test_geopoint_rebuilt_on_location_change(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # WHEN
+        self.mike.location = LOCATION_MARK
+        # THEN
+        self.assertAlmostEqual(45.4643, self.p.getGeoPoint(self.mike).lat)
+        self.mike.location = None
+        self.assertIsNone(self.p.getGeoPoint(self.mike))
+        self.assertNotIn('1', self.p._matrix)
+
     ####################################################################################################################
     #                                                                                                                  #
     #   TEST COMMANDS                                                                                                   #
@@ -196,74 +374,1695 @@ class LocationTestCase(unittest2.TestCase):
         # THEN
         self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
 
-    def test_cmd_distance_no_arguments(self):
+    def test_cmd_locate_workers(self):
         # GIVEN
+        self.conf.set('settings', 'workers', '1')
+        self.p.onLoadConfig()
         self.mike.connects('1')
         self.bill.connects('2')
         # WHEN
         self.mike.clearMessageHistory()
-        self.mike.says("!distance")
+        self.mike.says("!locate bill")
+        self.p._pool.join()
         # THEN
-        self.assertListEqual(['missing data, try !help distance'], self.mike.message_history)
+        self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
 
-    def test_cmd_distance_self(self):
+    def test_disable_drains_workers(self):
+        # GIVEN
+        self.conf.set('settings', 'workers', '1')
+        self.p.onLoadConfig()
+        pool = self.p._pool
+        task = Mock()
+        # WHEN
+        pool.submit(task)
+        self.p.onDisable()
+        # THEN
+        task.assert_called_once_with()
+        self.assertIsNone(self.p._pool)
+
+    def test_cmd_locate_from_store(self):
         # GIVEN
+        self.conf.set('settings', 'cache_file', ':memory:')
+        self.p.onLoadConfig()
         self.mike.connects('1')
         self.bill.connects('2')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.bill))
+        self.bill.location = None
         # WHEN
         self.mike.clearMessageHistory()
-        self.mike.says("!distance mike")
+        self.mike.says("!locate bill")
         # THEN
-        self.assertListEqual(['Sorry, I\'m not that smart...meh!'], self.mike.message_history)
+        self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
 
-    def test_cmd_distance_failed(self):
+    def test_announce_non_ascii_name_after_store_load(self):
+        # GIVEN
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        location = Mock()
+        location.country = 'Austria'
+        location.region = 'Wien'
+        location.city = 'Vienna'
+        location.cc = 'AT'
+        location.rc = '09'
+        location.isp = 'A1 Telekom'
+        location.timezone = 'Europe/Vienna'
+        location.lat = 48.2
+        location.lon = 16.3667
+        location.zipcode = 1010
+        # values read back from sqlite (or decoded from JSON) are unicode
+        stored = Mock()
+        for name in LocationRecord.FIELDS:
+            value = getattr(location, name)
+            setattr(stored, name, value.decode('ascii') if isinstance(value, str) else value)
+        store = LocationStore(path, 3600)
+        store.put('JORGGUID', '9.9.9.9', stored)
+        store.close()
+        self.conf.set('settings', 'cache_file', path)
+        self.p.onLoadConfig()
+        try:
+            from b3.fake import FakeClient
+            jorg = FakeClient(console=self.console, name='J\xf6rg', guid='JORGGUID', groupBits=1)
+            jorg.location = None
+            self.mike.connects('1')
+            jorg.connects('4')
+            # the stored location (read back from sqlite as unicode) is loaded first
+            self.mike.says('!locate 4')
+            # WHEN
+            jorg.location = location
+            self.console.say = Mock()
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=jorg))
+            # THEN
+            self.console.say.assert_called_once_with('^7J\xf6rg ^3from ^7Vienna ^3(^7Austria^3) connected')
+            self.assertIsInstance(self.console.say.call_args[0][0], str)
+        finally:
+            self.p._store.close()
+            os.unlink(path)
+
+    def test_store_write_failures(self):
+        # GIVEN
+        self.conf.set('settings', 'cache_file', '/nonexistent/dir/location.db')
+        self.p.onLoadConfig()
+        self.p._store.buffer_size = 1
+        self.console.say = Mock()
+        # WHEN
+        with logging_disabled():
+            for client, cid in ((self.mike, '1'), (self.bill, '2'), (self.mark, '3')):
+                client.connects(cid)
+                self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # THEN
+        self.assertEqual(3, self.console.say.call_count)
+        self.assertIsNone(self.p._store)
+        self.assertIsNone(self.p._store_cron)
+
+    def test_store_buffered_writes(self):
+        # GIVEN
+        self.conf.set('settings', 'cache_file', ':memory:')
+        self.p.onLoadConfig()
+        self.bill.connects('2')
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.bill))
+        # THEN
+        self.assertFalse(self.p._store.connected)
+        # WHEN
+        self.p.flushStore()
+        # THEN
+        self.assertTrue(self.p._store.connected)
+        self.assertEqual(1, len(self.p._store))
+
+    def test_cmd_locate_from_shared_cache(self):
+        # GIVEN
+        path = os.path.join(tempfile.mkdtemp(), 'location.sock')
+        sibling = SharedCache(path, 3600)
+        sibling.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.conf.set('settings', 'shared_cache', path)
+        self.p.onLoadConfig()
+        try:
+            self.mike.connects('1')
+            self.bill.connects('2')
+            self.bill.location = None
+            # WHEN
+            self.mike.clearMessageHistory()
+            self.mike.says("!locate bill")
+            # THEN
+            self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
+            self.assertFalse(self.p._shared.serving)
+            self.assertEqual(1, self.p._metrics.counter('location_shared_cache_total', outcome='hit'))
+        finally:
+            self.p._shared.close()
+            sibling.close()
+
+    def test_shared_cache_regular_file(self):
+        # GIVEN
+        path = os.path.join(tempfile.mkdtemp(), 'data.db')
+        with open(path, 'w') as f:
+            f.write('data')
+        self.conf.set('settings', 'shared_cache', path)
+        # WHEN
+        self.p.onLoadConfig()
+        # THEN
+        self.assertIsNone(self.p._shared)
+        with open(path) as f:
+            self.assertEqual('data', f.read())
+
+    def test_shared_cache_misses_remembered(self):
+        # GIVEN
+        path = os.path.join(tempfile.mkdtemp(), 'location.sock')
+        sibling = SharedCache(path, 3600)
+        sibling.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.conf.set('settings', 'shared_cache', path)
+        self.p.onLoadConfig()
+        try:
+            self.bill.connects('2')
+            self.bill.location = None
+            # WHEN
+            for _ in range(3):
+                self.p.getSnapshot(self.bill)
+            # THEN
+            self.assertEqual(1, self.p._metrics.counter('location_shared_cache_total', outcome='miss'))
+            # WHEN
+            sibling.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+            self.p._missed[self.bill.cid] -= self.p._missed_ttl
+            # THEN
+            self.assertEqual('Mountain View', self.p.getSnapshot(self.bill).city)
+            self.assertEqual(1, self.p._metrics.counter('location_shared_cache_total', outcome='hit'))
+        finally:
+            self.p._shared.close()
+            sibling.close()
+
+    def test_event_geolocation_shared(self):
+        # GIVEN
+        path = os.path.join(tempfile.mkdtemp(), 'location.sock')
+        self.conf.set('settings', 'shared_cache', path)
+        self.p.onLoadConfig()
+        sibling = SharedCache(path, 3600)
+        try:
+            self.mike.connects('1')
+            # WHEN
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+            # THEN
+            self.assertTrue(self.p._shared.serving)
+            self.assertEqual('Rome', sibling.get('MIKEGUID').city)
+        finally:
+            sibling.close()
+            self.p._shared.close()
+
+    def test_cmd_lochistory(self):
+        # GIVEN
+        self.conf.set('settings', 'history_file', os.path.join(tempfile.mkdtemp(), 'location.history'))
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.mike.location = LOCATION_MARK
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!lochistory mike")
+        # THEN
+        self.assertEqual(1, len(self.bill.message_history))
+        self.assertRegexpMatches(self.bill.message_history[0], r'^Mike locations: \d\d/\d\d \d\d:\d\d IT-09 Telecom '
+                                                               r'Italia, \d\d/\d\d \d\d:\d\d IT-07 Fastweb$')
+        changes = self.p.getLocationChanges(self.mike)
+        self.assertEqual(1, len(changes))
+        self.assertEqual('Fastweb', changes[0][0].isp)
+        self.assertEqual('Telecom Italia', changes[0][1].isp)
+        self.assertListEqual([], self.p.getLocationChanges(self.mike, field='cc'))
+
+    def test_cmd_lochistory_failed(self):
         # GIVEN
+        self.conf.set('settings', 'history_file', os.path.join(tempfile.mkdtemp(), 'location.history'))
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!lochistory mike")
+        # THEN
+        self.assertListEqual(['No location history for Mike'], self.bill.message_history)
+
+    def test_history_retention(self):
+        # GIVEN
+        self.conf.set('settings', 'history_file', os.path.join(tempfile.mkdtemp(), 'location.history'))
+        self.conf.set('settings', 'history_max_entries', '2')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        for location in (LOCATION_MIKE, LOCATION_MARK, LOCATION_BILL):
+            self.mike.location = location
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p.flushHistory()
+        size = os.path.getsize(self.p._history.path)
+        # WHEN
+        self.p.evictStore()
+        # THEN
+        self.assertTrue(self.p._history.loaded)
+        self.assertLess(os.path.getsize(self.p._history.path), size)
+        self.assertListEqual(['Telecom Italia', 'Google Inc.'], [x.isp for x in self.p.getLocationHistory(self.mike)])
+
+    def test_stop_flushes_buffers(self):
+        # GIVEN
+        directory = tempfile.mkdtemp()
+        self.conf.set('settings', 'cache_file', os.path.join(directory, 'location.db'))
+        self.conf.set('settings', 'history_file', os.path.join(directory, 'location.history'))
+        self.conf.set('settings', 'workers', '1')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p._pool.join()
+        self.assertFalse(self.p._store.connected)
+        size = os.path.getsize(self.p._history.path)
+        # WHEN
+        self.p.parseEvent(self.console.getEvent('EVT_STOP'))
+        # THEN
+        self.assertIsNone(self.p._pool)
+        self.assertGreater(os.path.getsize(self.p._history.path), size)
+        store = LocationStore(os.path.join(directory, 'location.db'), 3600)
+        try:
+            self.assertEqual('Rome', store.get('MIKEGUID').city)
+        finally:
+            store.close()
+
+    def test_history_disabled(self):
+        # GIVEN
+        self.mike.connects('1')
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # THEN
+        self.assertIsNone(self.p._history)
+        self.assertListEqual([], self.p.getLocationHistory(self.mike))
+
+    def test_load_shedding_degraded(self):
+        # GIVEN
+        self.conf.set('settings', 'load_shedding', 'yes')
+        self.p.onLoadConfig()
+        self.console.queue = Mock(maxsize=50)
+        self.console.queue.qsize.return_value = 15
+        self.console.say = Mock()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # THEN
+        self.assertEqual(LoadShedder.DEGRADED, self.p._shedder.level)
+        self.assertFalse(self.console.say.called)
+        self.p._shed_announcer.flush()
+        self.console.say.assert_called_once_with('^7Mike ^3(^7IT^3)')
+        self.assertEqual(1, self.p._metrics.counter('location_shed_total', action='short_announce'))
+
+    def test_load_shedding_critical(self):
+        # GIVEN
+        self.conf.set('settings', 'load_shedding', 'yes')
+        self.conf.set('settings', 'shed_recovery', '0')
+        self.p.onLoadConfig()
+        self.console.queue = Mock(maxsize=50)
+        self.console.queue.qsize.return_value = 25
+        self.console.say = Mock()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.mike.clearMessageHistory()
+        self.bill.clearMessageHistory()
+        self.mike.says("!locate bill")
+        self.bill.says("!locate mike")
+        # THEN
+        self.assertEqual(LoadShedder.CRITICAL, self.p._shedder.level)
+        self.assertFalse(self.console.say.called)
+        self.assertEqual(1, self.p._metrics.counter('location_shed_total', action='skip_announce'))
+        self.assertListEqual([], self.mike.message_history)
+        self.assertListEqual(['Mike is connected from Rome (Italy)'], self.bill.message_history)
+        self.assertEqual(1, len(self.p._backlog))
+        # WHEN
+        self.console.queue.qsize.return_value = 0
+        for _ in range(3):
+            self.p.sampleLoad()
+        # THEN
+        self.assertEqual(LoadShedder.NORMAL, self.p._shedder.level)
+        self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
+        self.assertEqual(0, len(self.p._backlog))
+
+    def test_load_shedding_queue_size_capped(self):
+        # GIVEN
+        self.conf.set('settings', 'load_shedding', 'yes')
+        self.conf.set('settings', 'shed_queue_size', '50')
+        self.p.onLoadConfig()
+        self.console.queue = Mock(maxsize=50)
+        # WHEN
+        self.console.queue.qsize.return_value = 30
+        # THEN
+        self.assertEqual(25, self.p.getShedQueueSize())
+        self.assertEqual(LoadShedder.DEGRADED, self.p.sampleLoad())
+        # WHEN
+        self.console.queue.qsize.return_value = 50
+        # THEN
+        self.assertEqual(LoadShedder.CRITICAL, self.p.sampleLoad())
+
+    def test_load_shedding_queue_size_default(self):
+        # GIVEN
+        self.conf.set('settings', 'load_shedding', 'yes')
+        self.p.onLoadConfig()
+        self.console.queue = Mock(maxsize=50)
+        # WHEN
+        self.console.queue.qsize.return_value = 9
+        # THEN
+        self.assertEqual(10, self.p.getShedQueueSize())
+        self.assertEqual(LoadShedder.NORMAL, self.p.sampleLoad())
+        # WHEN
+        self.console.queue.qsize.return_value = 20
+        # THEN
+        self.assertEqual(LoadShedder.CRITICAL, self.p.sampleLoad())
+
+    def test_store_opened_on_first_use(self):
+        # GIVEN
+        self.conf.set('settings', 'cache_file', ':memory:')
+        self.p.onLoadConfig()
+        self.assertFalse(self.p._store.connected)
         self.mike.connects('1')
         self.bill.connects('2')
         self.bill.location = None
         # WHEN
+        self.mike.says("!locate bill")
+        # THEN
+        self.assertTrue(self.p._store.connected)
+
+    def test_cmd_locate_partial_name_memoized(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mike.says("!locate il")
+        when(self.console.clients).getClientsByName('il').thenRaise(AssertionError('client list scanned'))
+        # WHEN
         self.mike.clearMessageHistory()
-        self.mike.says("!distance bill")
+        self.mike.says("!locate il")
         # THEN
-        self.assertListEqual(['Could not compute distance with Bill'], self.mike.message_history)
+        self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
+        self.assertEqual(1, self.p._resolver.hits)
 
-    def test_cmd_distance(self):
+    def test_cmd_locate_partial_name_after_connect(self):
         # GIVEN
         self.mike.connects('1')
         self.bill.connects('2')
+        self.mike.says("!locate m")
         # WHEN
+        self.mark.connects('3')
         self.mike.clearMessageHistory()
-        self.mike.says("!distance bill")
+        self.mike.says("!locate m")
         # THEN
-        self.assertListEqual(['Bill is 10068.18 km away from you'], self.mike.message_history)
+        self.assertListEqual(['Players matching m Mike [1], Mark [3]'], self.mike.message_history)
 
-    def test_cmd_isp_no_arguments(self):
+    def test_cmd_locate_partial_name_after_disconnect(self):
         # GIVEN
         self.mike.connects('1')
         self.bill.connects('2')
+        self.mike.says("!locate bill")
         # WHEN
-        self.bill.clearMessageHistory()
-        self.bill.says("!isp")
+        self.bill.disconnects()
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate bill")
         # THEN
-        self.assertListEqual(['missing data, try !help isp'], self.bill.message_history)
+        self.assertListEqual(['No players found matching bill'], self.mike.message_history)
 
-    def test_cmd_isp_failed(self):
+    def test_cmd_locate_partial_name_after_name_change(self):
         # GIVEN
         self.mike.connects('1')
         self.bill.connects('2')
-        self.mike.location = None
+        self.mike.says("!locate bill")
         # WHEN
-        self.bill.clearMessageHistory()
-        self.bill.says("!isp mike")
+        self.bill.name = 'William'
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate bill")
+        self.mike.says("!locate liam")
         # THEN
-        self.assertListEqual(['Could not determine Mike isp'], self.bill.message_history)
+        self.assertListEqual(['No players found matching bill',
+                              'William is connected from Mountain View (United States)'], self.mike.message_history)
 
-    def test_cmd_isp(self):
+    def test_cmd_locate_database_id(self):
         # GIVEN
         self.mike.connects('1')
         self.bill.connects('2')
         # WHEN
-        self.bill.clearMessageHistory()
-        self.bill.says("!isp mike")
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate @%s" % self.bill.id)
+        # THEN
+        self.assertListEqual(['Bill is connected from Mountain View (United States)'], self.mike.message_history)
+
+    def test_cmd_locate_all(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.mark.location = None
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate all")
+        # THEN
+        self.assertListEqual(['Mike is connected from Rome (Italy) | Bill is connected from Mountain View (United States) | '
+                              'Could not locate Mark'], self.mike.message_history)
+
+    def test_cmd_locate_all_line_length(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.mark.location = None
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate all")
+        # THEN
+        self.assertListEqual(['Mike is connected from Rome (Italy)',
+                              'Bill is connected from Mountain View (United States)',
+                              'Could not locate Mark'], self.mike.message_history)
+
+    def test_cmd_locate_team(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.bill.team = b3.TEAM_RED
+        self.mark.team = b3.TEAM_RED
+        self.mike.team = b3.TEAM_BLUE
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate red")
+        self.mike.says("!locate spec")
         # THEN
-        self.assertListEqual(['Mike is using Fastweb as isp'], self.bill.message_history)
\ No newline at end of file
+        self.assertListEqual(['Bill is connected from Mountain View (United States) | Mark is connected from Milan (Italy)',
+                              'No players found matching spec'], self.mike.message_history)
+
+    def test_cmd_locate_list(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!locate mark, bill,foo")
+        # THEN
+        self.assertListEqual(['No players found matching foo',
+                              'Mark is connected from Milan (Italy) | Bill is connected from Mountain View (United States)'],
+                             self.mike.message_history)
+
+    def test_cmd_distance_vincenty(self):
+        # GIVEN
+        self.conf.set('settings', 'distance_model', 'vincenty')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance bill")
+        # THEN
+        self.assertListEqual(['Bill is 10091.82 km away from you'], self.mike.message_history)
+
+    def test_cmd_farthest_vincenty(self):
+        # GIVEN
+        self.conf.set('settings', 'distance_model', 'vincenty')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!farthest")
+        self.mike.says("!distance bill")
+        # THEN
+        self.assertListEqual(['Bill is the farthest player: 10091.82 km away from you',
+                              'Bill is 10091.82 km away from you'], self.mike.message_history)
+
+    def test_cmd_distance_miles(self):
+        # GIVEN
+        self.conf.set('settings', 'distance_unit', 'mi')
+        self.conf.set('messages', 'cmd_distance', '^7$name ^3is ^7$distance ^3$unit away from you')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance bill")
+        # THEN
+        self.assertListEqual(['Bill is 6256.08 mi away from you'], self.mike.message_history)
+
+    def test_cmd_nearby_miles(self):
+        # GIVEN
+        self.conf.set('settings', 'distance_unit', 'mi')
+        self.conf.set('settings', 'query_distance_model', 'equirectangular')
+        self.conf.set('messages', 'cmd_nearby', '^3Players within ^7$distance ^3$unit: ^7$players')
+        self.conf.set('messages', 'cmd_nearby_failed', '^7Could not find any player within ^1$distance ^7$unit from you')
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearby 300")
+        self.mike.says("!nearby 250")
+        # THEN
+        self.assertEqual(2, len(self.mike.message_history))
+        self.assertTrue(self.mike.message_history[0].startswith('Players within 300 mi: Mark (296.'))
+        self.assertEqual('Could not find any player within 250 mi from you', self.mike.message_history[1])
+
+    def test_distance_model_invalid(self):
+        # WHEN
+        self.conf.set('settings', 'distance_model', 'flat')
+        self.p.onLoadConfig()
+        # THEN
+        self.assertEqual('haversine', self.p._distance_model)
+
+    def test_cmd_distance_all(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance all")
+        # THEN
+        self.assertListEqual(['Bill is 10068.18 km away from you | Mark is 476.59 km away from you'],
+                             self.mike.message_history)
+
+    def test_cmd_distance_list(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.bill.location = None
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance mike,bill,mark")
+        # THEN
+        self.assertListEqual(["Sorry, I'm not that smart...meh! | Could not compute distance with Bill | "
+                              "Mark is 476.59 km away from you"], self.mike.message_history)
+
+    def test_cmd_isp_all_line_length(self):
+        # GIVEN
+        self.console._line_length = 200
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.bill.groupBits = 16
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!isp all")
+        # THEN
+        self.assertListEqual(['Mike is using Fastweb as isp | Bill is using Google Inc. as isp'], self.bill.message_history)
+
+    def test_cmd_distance_no_arguments(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance")
+        # THEN
+        self.assertListEqual(['missing data, try !help distance'], self.mike.message_history)
+
+    def test_cmd_distance_self(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance mike")
+        # THEN
+        self.assertListEqual(['Sorry, I\'m not that smart...meh!'], self.mike.message_history)
+
+    def test_cmd_distance_failed(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.bill.location = None
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance bill")
+        # THEN
+        self.assertListEqual(['Could not compute distance with Bill'], self.mike.message_history)
+
+    def test_cmd_distance(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!distance bill")
+        # THEN
+        self.assertListEqual(['Bill is 10068.18 km away from you'], self.mike.message_history)
+
+    def test_cmd_isp_no_arguments(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!isp")
+        # THEN
+        self.assertListEqual(['missing data, try !help isp'], self.bill.message_history)
+
+    def test_cmd_isp_failed(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mike.location = None
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!isp mike")
+        # THEN
+        self.assertListEqual(['Could not determine Mike isp'], self.bill.message_history)
+
+    def test_cmd_isp(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!isp mike")
+        # THEN
+        self.assertListEqual(['Mike is using Fastweb as isp'], self.bill.message_history)
+
+    def test_cmd_nearest(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearest")
+        # THEN
+        self.assertListEqual(['Mark is the nearest player: 476.59 km away from you'], self.mike.message_history)
+
+    def test_cmd_nearest_skips_clients_gone(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # mark leaves without a disconnect event reaching the plugin
+        del self.console.clients['3']
+        self.console.clients.resetIndex()
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearest")
+        # THEN
+        self.assertEqual(1, len(self.mike.message_history))
+        self.assertTrue(self.mike.message_history[0].startswith('Bill is the nearest player'))
+
+    def test_offline_client_not_indexed(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        from b3.fake import FakeClient
+        offline = FakeClient(console=self.console, name='Offline', guid='OFFLINEGUID', groupBits=1)
+        offline.location = LOCATION_MARK
+        # WHEN
+        snapshot = self.p.getSnapshot(offline)
+        # THEN
+        self.assertEqual('Milan', snapshot.city)
+        self.assertEqual(1, self.p.getGeoStats()['population'])
+        self.assertNotIn(None, self.p._matrix)
+        self.assertNotIn(None, self.p._index)
+        self.assertNotIn(None, self.p._snapshots)
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearest")
+        self.assertListEqual(['Could not find any player near you'], self.mike.message_history)
+
+    def test_cmd_nearest_failed(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearest")
+        # THEN
+        self.assertListEqual(['Could not find any player near you'], self.mike.message_history)
+
+    def test_cmd_farthest(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!farthest")
+        # THEN
+        self.assertListEqual(['Bill is the farthest player: 10068.18 km away from you'], self.mike.message_history)
+
+    def test_cmd_nearby(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearby 500")
+        # THEN
+        self.assertListEqual(['Players within 500 km: Mark (476.59)'], self.mike.message_history)
+
+    def test_cmd_nearby_failed(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearby 100.5")
+        # THEN
+        self.assertListEqual(['Could not find any player within 100.5 km from you'], self.mike.message_history)
+
+    def test_cmd_nearby_invalid_distance(self):
+        # GIVEN
+        self.mike.connects('1')
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!nearby far")
+        # THEN
+        self.assertListEqual(['invalid distance, try !help nearby'], self.mike.message_history)
+
+    def test_cmd_geostats(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!geostats")
+        # THEN
+        self.assertListEqual(['3 players from IT (2), US (1) | average distance: 6712.2 km | median distance: 9591.5 km'],
+                             self.bill.message_history)
+
+    def test_cmd_geostats_failed(self):
+        # GIVEN
+        self.bill.connects('2')
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!geostats")
+        # THEN
+        self.assertListEqual(['No geolocation data available'], self.bill.message_history)
+
+    def test_geostats_disconnect(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        for client in (self.mike, self.bill):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        # WHEN
+        self.bill.disconnects()
+        # THEN
+        stats = self.p.getGeoStats()
+        self.assertEqual(1, stats['population'])
+        self.assertDictEqual({'IT': 1}, stats['cc'])
+        self.assertDictEqual({'IT-07': 1}, stats['rc'])
+        self.assertDictEqual({'Fastweb': 1}, stats['isp'])
+        self.assertIsNone(stats['average_distance'])
+
+    def test_geostats_concurrent_updates(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        for client in (self.mike, self.bill, self.mark):
+            self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            # what commands running on worker threads do: the location object of mike keeps changing
+            try:
+                while not done.is_set():
+                    self.mike.location = LOCATION_MARK if self.mike.location is LOCATION_MIKE else LOCATION_MIKE
+                    self.p.getSnapshot(self.mike)
+                    self.p.getGeoStats()
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        # WHEN
+        try:
+            deadline = time.time() + 0.5
+            while time.time() < deadline:
+                self.p.onDisconnect(self.console.getEvent('EVT_CLIENT_DISCONNECT', client=self.bill))
+                self.p.onGeolocalization(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.bill))
+        finally:
+            done.set()
+            thread.join()
+        # THEN
+        self.assertListEqual([], errors)
+        self.p.getSnapshot(self.mike)
+        stats = self.p.getGeoStats()
+        self.assertEqual(3, stats['population'])
+        self.assertEqual(3, sum(stats['cc'].values()))
+        # one distance for every pair of clients
+        self.assertEqual(3, self.p._stats._count)
+
+    def test_cmd_locstats(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.mike.says("!locate bill")
+        # WHEN
+        self.bill.clearMessageHistory()
+        self.bill.says("!locstats")
+        # THEN
+        self.assertEqual(3, len(self.bill.message_history))
+        self.assertTrue(self.bill.message_history[0].startswith('geolocation: 1 events | avg'))
+        self.assertTrue(self.bill.message_history[1].startswith('locate: 1 calls (ok 1) | avg'))
+        self.assertTrue(self.bill.message_history[2].startswith('queues: event'))
+
+    def test_metrics_command_outcomes(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.bill.location = None
+        # WHEN
+        self.mike.says("!locate bill")
+        self.mike.says("!distance bill")
+        self.mike.says("!distance mike")
+        # THEN
+        metrics = self.p._metrics
+        self.assertEqual(2, metrics.counter('location_commands_total', command='distance'))
+        self.assertEqual(1, metrics.counter('location_command_results_total', command='locate', outcome='failed'))
+        self.assertEqual(1, metrics.counter('location_command_results_total', command='distance', outcome='failed'))
+        self.assertEqual(1, metrics.counter('location_command_results_total', command='distance', outcome='self'))
+        self.assertEqual(2, metrics.histogram('location_command_seconds', command='distance').count)
+
+    def test_metrics_command_outcomes_once_per_command(self):
+        # GIVEN
+        self.mike.connects('1')
+        self.bill.connects('2')
+        self.mark.connects('3')
+        self.mark.location = None
+        # WHEN
+        self.mike.says("!locate all")
+        self.p.renderMessage('cmd_locate', self.bill)
+        # THEN
+        metrics = self.p._metrics
+        self.assertEqual(1, metrics.counter('location_commands_total', command='locate'))
+        self.assertEqual(1, metrics.counter('location_command_results_total', command='locate', outcome='ok'))
+        self.assertEqual(0, metrics.counter('location_command_results_total', command='locate', outcome='failed'))
+
+    def test_metrics_export_prometheus(self):
+        # GIVEN
+        fd, path = tempfile.mkstemp(suffix='.prom')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.conf.set('settings', 'metrics_exporter', 'prometheus')
+        self.conf.set('settings', 'metrics_target', path)
+        self.p.onLoadConfig()
+        self.mike.connects('1')
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        # WHEN
+        self.p.exportMetrics()
+        # THEN
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('# TYPE location_event_seconds histogram', text)
+        self.assertIn('location_event_seconds_count{event="geolocation_success"} 1', text)
+        self.assertIn('location_clients_geolocated 1', text)
+
+    def test_metrics_interval_invalid(self):
+        # WHEN
+        self.conf.set('settings', 'metrics_interval', '7')
+        self.p.onLoadConfig()
+        # THEN
+        self.assertEqual(15, self.p._metrics_interval)
+
+
+class LocationSnapshotTestCase(unittest2.TestCase):
+
+    def test_from_location(self):
+        snapshot = LocationSnapshot.fromLocation(LOCATION_MIKE)
+        self.assertEqual('Italy', snapshot.country)
+        self.assertEqual('IT', snapshot.cc)
+        self.assertAlmostEqual(41.9, snapshot.lat)
+        self.assertAlmostEqual(12.4833, snapshot.point.lon)
+
+    def test_normalize(self):
+        location = Mock()
+        location.country = ' Italy '
+        location.city = ''
+        location.isp = None
+        location.lat = '41.9'
+        location.lon = None
+        snapshot = LocationSnapshot.fromLocation(location)
+        self.assertEqual('Italy', snapshot.country)
+        self.assertEqual('--', snapshot.city)
+        self.assertEqual('--', snapshot.isp)
+        self.assertAlmostEqual(41.9, snapshot.lat)
+        self.assertIsNone(snapshot.lon)
+        self.assertIsNone(snapshot.point)
+
+    def test_immutable(self):
+        snapshot = LocationSnapshot.fromLocation(LOCATION_MIKE)
+        with self.assertRaises(AttributeError):
+            snapshot.city = 'Milan'
+        with self.assertRaises(AttributeError):
+            snapshot.foo = 'bar'
+
+
+class LoadShedderTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.shedder = LoadShedder(queue_size=50, lag=3, recovery=10)
+
+    def test_levels(self):
+        self.assertEqual(LoadShedder.NORMAL, self.shedder.sample(10, 0, now=100))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(50, 0, now=101))
+        self.assertEqual(LoadShedder.CRITICAL, self.shedder.sample(10, 6, now=102))
+        self.assertEqual('critical', self.shedder.name)
+
+    def test_recovery(self):
+        self.shedder.sample(100, now=100)
+        self.assertEqual(LoadShedder.CRITICAL, self.shedder.sample(0, now=101))
+        self.assertEqual(LoadShedder.CRITICAL, self.shedder.sample(0, now=110))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(0, now=111))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(60, now=115))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(0, now=120))
+        self.assertEqual(LoadShedder.NORMAL, self.shedder.sample(0, now=130))
+
+    def test_stale_lag(self):
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(0, 4, now=100))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(0, now=105))
+        self.assertEqual(LoadShedder.DEGRADED, self.shedder.sample(0, now=111))
+        self.assertEqual(LoadShedder.NORMAL, self.shedder.sample(0, now=122))
+
+    def test_disabled_thresholds(self):
+        shedder = LoadShedder(queue_size=0, lag=0)
+        self.assertEqual(LoadShedder.NORMAL, shedder.sample(1000, 1000))
+
+
+class StringTableTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.table = StringTable()
+
+    def test_ids(self):
+        self.assertEqual(0, self.table.id('Italy'))
+        self.assertEqual(1, self.table.id(u'United States'))
+        self.assertEqual(0, self.table.id('Italy'))
+        self.assertEqual(2, self.table.id(u'Italy'))
+        self.assertEqual('Italy', self.table.get(0))
+        self.assertEqual(3, len(self.table))
+        self.assertIn(u'United States', self.table)
+        self.assertNotIn('United States', self.table)
+
+    def test_intern(self):
+        first = self.table.intern(''.join(['Goo', 'gle Inc.']))
+        self.assertIs(first, self.table.intern(''.join(['Google', ' Inc.'])))
+        self.assertIsNone(self.table.intern(None))
+        self.assertEqual(94035, self.table.intern(94035))
+        self.assertEqual(1, len(self.table))
+
+    def test_intern_keeps_type(self):
+        self.assertIsInstance(self.table.intern(u'Google Inc.'), unicode)
+        self.assertIsInstance(self.table.intern('Google Inc.'), str)
+        self.assertIsInstance(self.table.intern(u'Google Inc.'), unicode)
+
+    def test_location_values_shared(self):
+        location = Mock()
+        location.country = ''.join(['Ita', 'ly'])
+        location.isp = ''.join(['Fast', 'web'])
+        snapshot = LocationSnapshot.fromLocation(LOCATION_MIKE)
+        record = LocationRecord.fromLocation(location)
+        self.assertIs(snapshot.country, record.country)
+        self.assertIs(snapshot.isp, record.isp)
+        self.assertIs(snapshot.isp, STRINGS['isp'].intern('Fastweb'))
+
+
+class LocationStoreTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.store = LocationStore(self.path, 3600)
+
+    def tearDown(self):
+        self.store.close()
+        os.unlink(self.path)
+
+    def test_put_and_get(self):
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        record = self.store.get('MIKEGUID')
+        self.assertEqual('Rome', record.city)
+        self.assertEqual('Fastweb', record.isp)
+        self.assertAlmostEqual(41.9, record.lat)
+        self.assertAlmostEqual(12.4833, record.lon)
+        self.assertEqual(record.city, self.store.get(ip='1.2.3.4').city)
+        self.assertIsNone(self.store.get('BILLGUID'))
+
+    def test_persistence(self):
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.store.close()
+        self.store = LocationStore(self.path, 3600)
+        self.assertEqual('Rome', self.store.get('MIKEGUID').city)
+
+    def test_lazy_connection(self):
+        self.assertFalse(self.store.connected)
+        self.assertIsNone(self.store.get('MIKEGUID'))
+        self.assertTrue(self.store.connected)
+        self.store.close()
+        self.assertFalse(self.store.connected)
+
+    def test_ttl(self):
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE, updated=time.time() - 7200)
+        self.store.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.assertIsNone(self.store.get('MIKEGUID', '1.2.3.4'))
+        self.assertEqual(1, self.store.evict())
+        self.assertEqual(1, len(self.store))
+
+    def test_buffered_writes(self):
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MARK)
+        self.assertFalse(self.store.connected)
+        self.assertEqual('Milan', self.store.get('MIKEGUID').city)
+        self.assertEqual('Milan', self.store.get(ip='1.2.3.4').city)
+        other = LocationStore(self.path, 3600)
+        self.assertIsNone(other.get('MIKEGUID'))
+        self.assertEqual(1, self.store.flush())
+        self.assertEqual(0, self.store.flush())
+        self.assertEqual('Milan', other.get('MIKEGUID').city)
+        other.close()
+
+    def test_buffer_bounded_on_failure(self):
+        store = LocationStore('/nonexistent/dir/location.db', 3600, buffer_size=2)
+        store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        for guid in ('BILLGUID', 'MARKGUID', 'JOHNGUID'):
+            self.assertRaises(Exception, store.put, guid, '5.6.7.8', LOCATION_BILL)
+        self.assertEqual(3, store.errors)
+        # the most recent records are kept
+        self.assertListEqual(['MARKGUID', 'JOHNGUID'], list(store._pending))
+
+    def test_buffered_ip_lookup(self):
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE, updated=time.time() - 60)
+        self.store.flush()
+        self.store.put('BILLGUID', '1.2.3.4', LOCATION_BILL)
+        self.assertEqual('Rome', self.store.get('MIKEGUID', '1.2.3.4').city)
+        self.assertEqual('Mountain View', self.store.get('MARKGUID', '1.2.3.4').city)
+
+    def test_buffer_size(self):
+        self.store = LocationStore(self.path, 3600, buffer_size=2)
+        self.store.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.assertFalse(self.store.connected)
+        self.store.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.assertTrue(self.store.connected)
+        self.assertEqual(0, self.store.flush())
+
+
+class SharedCacheTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'location.sock')
+        self.first = SharedCache(self.path, 3600, capacity=3)
+        self.second = SharedCache(self.path, 3600, capacity=3)
+
+    def tearDown(self):
+        self.second.close()
+        self.first.close()
+
+    def test_put_and_get(self):
+        self.assertTrue(self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE))
+        record = self.second.get('MIKEGUID')
+        self.assertTrue(self.first.serving)
+        self.assertFalse(self.second.serving)
+        self.assertEqual('Rome', record.city)
+        self.assertAlmostEqual(41.9, record.lat)
+        self.assertEqual('Rome', self.second.get(ip='1.2.3.4').city)
+        self.assertIsNone(self.second.get('BILLGUID'))
+
+    def test_newer_record_wins(self):
+        self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE, updated=time.time())
+        self.assertFalse(self.second.put('MIKEGUID', '1.2.3.4', LOCATION_MARK, updated=time.time() - 60))
+        self.assertEqual('Rome', self.second.get('MIKEGUID').city)
+        self.assertTrue(self.second.put('MIKEGUID', '1.2.3.4', LOCATION_MARK, updated=time.time() + 60))
+        self.assertEqual('Milan', self.first.get('MIKEGUID').city)
+
+    def test_ttl(self):
+        self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE, updated=time.time() - 7200)
+        self.second.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.assertIsNone(self.second.get('MIKEGUID', '1.2.3.4'))
+        self.assertEqual(1, self.second.evict())
+        self.assertEqual(1, len(self.first))
+
+    def test_capacity(self):
+        self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.first.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.first.put('MARKGUID', '9.9.9.9', LOCATION_MARK)
+        self.second.get('MIKEGUID')
+        self.second.put('JOHNGUID', '1.1.1.1', LOCATION_MARK)
+        self.assertEqual(3, len(self.second))
+        self.assertIsNone(self.second.get('BILLGUID', '5.6.7.8'))
+        self.assertEqual('Rome', self.second.get('MIKEGUID').city)
+
+    def test_takeover(self):
+        self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.assertEqual('Rome', self.second.get('MIKEGUID').city)
+        self.first.close()
+        self.assertIsNone(self.second.get('MIKEGUID'))
+        self.assertTrue(self.second.serving)
+        self.first.put('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        self.assertEqual('Mountain View', self.second.get('BILLGUID').city)
+
+    def test_regular_file_not_removed(self):
+        path = os.path.join(os.path.dirname(self.path), 'data.db')
+        with open(path, 'w') as f:
+            f.write('data')
+        self.assertRaises(ValueError, SharedCache, path, 3600)
+        with open(path) as f:
+            self.assertEqual('data', f.read())
+
+    def test_stale_socket_removed(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        self.first.put('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.assertTrue(self.first.serving)
+        self.assertEqual('Rome', self.second.get('MIKEGUID').city)
+
+    def test_socket_in_use_not_removed(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+        try:
+            self.assertRaises(socket.error, self.first.put, 'MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+            self.assertFalse(self.first.serving)
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            sock.close()
+
+
+class LocationHistoryTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'location.history')
+        self.history = LocationHistory(self.path)
+
+    def tearDown(self):
+        self.history.close()
+
+    def test_record_after_close(self):
+        self.assertTrue(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=100))
+        self.history.close()
+        size = os.path.getsize(self.path)
+        self.assertFalse(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MARK, timestamp=200))
+        self.assertIsNone(self.history._file)
+        self.assertEqual(size, os.path.getsize(self.path))
+
+    def test_record_and_history(self):
+        self.assertTrue(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=100))
+        self.assertFalse(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=200))
+        self.assertTrue(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MARK, timestamp=300))
+        self.assertTrue(self.history.record(None, '5.6.7.8', LOCATION_BILL, timestamp=400))
+        entries = self.history.history('MIKEGUID')
+        self.assertListEqual([100, 300], [x.timestamp for x in entries])
+        self.assertEqual(('IT', '07', 'Fastweb'), entries[0][1:4])
+        self.assertAlmostEqual(41.9, entries[0].lat, places=4)
+        self.assertAlmostEqual(12.4833, entries[0].lon, places=4)
+        self.assertEqual('Telecom Italia', self.history.history('MIKEGUID', limit=1)[0].isp)
+        self.assertEqual('Google Inc.', self.history.history(ip='5.6.7.8')[0].isp)
+        self.assertListEqual([], self.history.history('BILLGUID'))
+        self.assertEqual(3, len(self.history))
+
+    def test_buffered_writes(self):
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE)
+        self.history.record('BILLGUID', '5.6.7.8', LOCATION_BILL)
+        size = os.path.getsize(self.path)
+        self.assertEqual(LocationHistory.HEADER.size, size)
+        self.assertGreater(self.history.flush(), 0)
+        self.assertGreater(os.path.getsize(self.path), size)
+        self.assertEqual(0, self.history.flush())
+
+    def test_persistence(self):
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=100)
+        self.history.record('BILLGUID', '5.6.7.8', LOCATION_BILL, timestamp=200)
+        self.history.close()
+        self.history = LocationHistory(self.path)
+        self.assertFalse(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=300))
+        self.assertTrue(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_BILL, timestamp=400))
+        self.assertListEqual(['Fastweb', 'Google Inc.'], [x.isp for x in self.history.history('MIKEGUID')])
+        self.assertEqual(3, len(self.history))
+
+    def test_incomplete_record_discarded(self):
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=100)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MARK, timestamp=200)
+        self.history.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        self.history = LocationHistory(self.path)
+        self.assertListEqual([100], [x.timestamp for x in self.history.history('MIKEGUID')])
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_BILL, timestamp=300)
+        self.history.close()
+        self.history = LocationHistory(self.path)
+        self.assertListEqual([100, 300], [x.timestamp for x in self.history.history('MIKEGUID')])
+
+    def test_changes(self):
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=100)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MARK, timestamp=200)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_BILL, timestamp=300)
+        self.assertListEqual([('Fastweb', 'Telecom Italia'), ('Telecom Italia', 'Google Inc.')],
+                             [(a.isp, b.isp) for a, b in self.history.changes('MIKEGUID')])
+        self.assertListEqual([('IT', 'US')], [(a.cc, b.cc) for a, b in self.history.changes('MIKEGUID', field='cc')])
+        self.assertListEqual([300], [b.timestamp for a, b in self.history.changes('MIKEGUID', since=250)])
+
+    def test_max_entries(self):
+        self.history = LocationHistory(self.path, max_entries=2)
+        for i, location in enumerate((LOCATION_MIKE, LOCATION_MARK, LOCATION_BILL)):
+            self.history.record('MIKEGUID', '1.2.3.4', location, timestamp=100 + i)
+        self.assertListEqual([101, 102], [x.timestamp for x in self.history.history('MIKEGUID')])
+        self.assertEqual(2, len(self.history))
+
+    def test_compact(self):
+        now = int(time.time())
+        self.history = LocationHistory(self.path, max_age=1000, max_entries=2)
+        self.history.record('BILLGUID', '5.6.7.8', LOCATION_BILL, timestamp=now - 2000)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=now - 30)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MARK, timestamp=now - 20)
+        self.history.record('MIKEGUID', '1.2.3.4', LOCATION_BILL, timestamp=now - 10)
+        self.history.flush()
+        size = os.path.getsize(self.path)
+        self.assertListEqual([], self.history.history('BILLGUID'))
+        # WHEN
+        self.assertEqual(2, self.history.compact(now))
+        # THEN
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(0, self.history.compact(now))
+        self.assertListEqual(['Telecom Italia', 'Google Inc.'], [x.isp for x in self.history.history('MIKEGUID')])
+        self.assertFalse(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_BILL, timestamp=now))
+        self.assertTrue(self.history.record('MIKEGUID', '1.2.3.4', LOCATION_MIKE, timestamp=now))
+        self.history.close()
+        self.history = LocationHistory(self.path, max_age=1000, max_entries=2)
+        self.assertListEqual(['Google Inc.', 'Fastweb'], [x.isp for x in self.history.history('MIKEGUID')])
+        self.assertEqual(2, len(self.history))
+
+
+class GeoStatsTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.stats = GeoStats()
+        self.stats.add('a', 'IT', 'IT-07', 'Fastweb', [])
+        self.stats.add('b', 'US', 'US-CA', 'Google Inc.', [10.0])
+        self.stats.add('c', 'IT', 'IT-09', 'Fastweb', [2.0, 6.0])
+
+    def test_counters(self):
+        self.assertDictEqual({'IT': 2, 'US': 1}, dict(self.stats.cc))
+        self.assertDictEqual({'Fastweb': 2, 'Google Inc.': 1}, dict(self.stats.isp))
+        self.assertEqual(3, len(self.stats))
+
+    def test_distances(self):
+        self.assertAlmostEqual(6.0, self.stats.average())
+        self.assertAlmostEqual(6.5, self.stats.median())
+        self.stats.remove('c', [2.0, 6.0])
+        self.assertAlmostEqual(10.0, self.stats.average())
+        self.assertAlmostEqual(10.5, self.stats.median())
+        self.stats.add('d', 'US', 'US-CA', 'Comcast', [4.0, 1.0])
+        self.assertAlmostEqual(5.0, self.stats.average())
+        self.assertAlmostEqual(4.5, self.stats.median())
+
+    def test_update(self):
+        self.stats.remove('c', [2.0, 6.0])
+        self.stats.add('c', 'US', 'US-NY', 'Comcast', [8.0, 8.0])
+        self.assertDictEqual({'IT': 1, 'US': 2}, dict(self.stats.cc))
+        self.assertAlmostEqual(26.0 / 3, self.stats.average())
+        self.assertAlmostEqual(8.5, self.stats.median())
+
+    def test_remove(self):
+        self.stats.remove('c', [2.0, 6.0])
+        self.stats.remove('b', [10.0])
+        self.stats.remove('a', [])
+        self.assertEqual(0, len(self.stats))
+        self.assertDictEqual({}, dict(self.stats.cc))
+        self.assertIsNone(self.stats.average())
+        self.assertIsNone(self.stats.median())
+
+
+class DistanceMatrixTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.matrix = DistanceMatrix()
+        self.matrix.update('mike', GeoPoint(LOCATION_MIKE.lat, LOCATION_MIKE.lon))
+        self.matrix.update('bill', GeoPoint(LOCATION_BILL.lat, LOCATION_BILL.lon))
+        self.matrix.update('mark', GeoPoint(LOCATION_MARK.lat, LOCATION_MARK.lon))
+
+    def test_row(self):
+        row = dict(self.matrix.row('mike'))
+        self.assertSetEqual(set(['bill', 'mark']), set(row.keys()))
+        self.assertAlmostEqual(haversine(LOCATION_MIKE.lat, LOCATION_MIKE.lon, LOCATION_BILL.lat, LOCATION_BILL.lon), row['bill'], places=6)
+        self.assertAlmostEqual(haversine(LOCATION_MIKE.lat, LOCATION_MIKE.lon, LOCATION_MARK.lat, LOCATION_MARK.lon), row['mark'], places=6)
+
+    def test_row_unknown_key(self):
+        self.assertListEqual([], self.matrix.row('john'))
+
+    def test_matrix(self):
+        keys, rows = self.matrix.matrix()
+        self.assertListEqual(['mike', 'bill', 'mark'], keys)
+        for i in xrange(len(keys)):
+            self.assertAlmostEqual(0.0, rows[i][i], places=6)
+            for j in xrange(len(keys)):
+                self.assertAlmostEqual(rows[i][j], rows[j][i], places=6)
+
+    def test_remove(self):
+        self.matrix.remove('mike')
+        self.assertNotIn('mike', self.matrix)
+        self.assertEqual(2, len(self.matrix))
+        self.assertListEqual(['mark', 'bill'], self.matrix.keys())
+        self.assertAlmostEqual(haversine(LOCATION_MARK.lat, LOCATION_MARK.lon, LOCATION_BILL.lat, LOCATION_BILL.lon), dict(self.matrix.row('mark'))['bill'], places=6)
+
+    def test_geopoint_distance(self):
+        point1 = GeoPoint(LOCATION_MIKE.lat, LOCATION_MIKE.lon)
+        point2 = GeoPoint(LOCATION_BILL.lat, LOCATION_BILL.lon)
+        self.assertAlmostEqual(haversine(LOCATION_MIKE.lat, LOCATION_MIKE.lon, LOCATION_BILL.lat, LOCATION_BILL.lon), point1.distance(point2), places=6)
+        self.assertAlmostEqual(0.0, point1.distance(point1), places=6)
+
+
+class DistanceModelsTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        # Flinders Peak and Buninyong: reference geodesic distance on WGS-84 is 54972.271 meters
+        self.flinders = GeoPoint(-(37 + 57 / 60.0 + 3.72030 / 3600), 144 + 25 / 60.0 + 29.52440 / 3600)
+        self.buninyong = GeoPoint(-(37 + 39 / 60.0 + 10.15610 / 3600), 143 + 55 / 60.0 + 35.38390 / 3600)
+
+    def test_vincenty(self):
+        self.assertAlmostEqual(54.972271, distance_vincenty(self.flinders, self.buninyong), places=6)
+        self.assertEqual(0, distance_vincenty(self.flinders, self.flinders))
+
+    def test_vincenty_antipodal(self):
+        p1 = GeoPoint(0, 0)
+        p2 = GeoPoint(0.5, 179.7)
+        self.assertAlmostEqual(p1.distance(p2), distance_vincenty(p1, p2), delta=p1.distance(p2) * 0.01)
+
+    def test_models(self):
+        for name, model in DISTANCE_MODELS.iteritems():
+            self.assertAlmostEqual(54.97, model(self.flinders, self.buninyong), delta=0.1, msg=name)
+
+    def test_lookup(self):
+        p1 = GeoPoint(41.9, 12.4833)
+        for p2 in (GeoPoint(37.386, -122.0838), GeoPoint(-41.9, -167.5), GeoPoint(41.9, 12.4834)):
+            self.assertAlmostEqual(p1.distance(p2), distance_lookup(p1, p2), delta=0.01)
+
+
+class SpatialIndexTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.index = SpatialIndex(cell_size=200)
+        self.index.update('mike', GeoPoint(LOCATION_MIKE.lat, LOCATION_MIKE.lon))
+        self.index.update('bill', GeoPoint(LOCATION_BILL.lat, LOCATION_BILL.lon))
+        self.index.update('mark', GeoPoint(LOCATION_MARK.lat, LOCATION_MARK.lon))
+
+    def test_nearest(self):
+        key, distance = self.index.nearest(self.index.get('mike'), exclude='mike')
+        self.assertEqual('mark', key)
+        self.assertAlmostEqual(476.59, distance, places=2)
+        self.assertEqual('mike', self.index.nearest(self.index.get('mike'))[0])
+        self.assertEqual('bill', self.index.nearest(self.index.get('mike'), exclude=set(['mike', 'mark']))[0])
+
+    def test_nearest_empty(self):
+        self.assertIsNone(SpatialIndex().nearest(GeoPoint(0, 0)))
+
+    def test_within(self):
+        point = self.index.get('mike')
+        self.assertListEqual(['mark'], [x[0] for x in self.index.within(point, 500, exclude='mike')])
+        self.assertListEqual(['mike', 'mark', 'bill'], [x[0] for x in self.index.within(point, 20000)])
+        self.assertListEqual([], self.index.within(point, 100, exclude='mike'))
+
+    def test_update_and_remove(self):
+        self.index.update('mark', GeoPoint(LOCATION_BILL.lat, LOCATION_BILL.lon + 0.1))
+        self.assertEqual('bill', self.index.nearest(self.index.get('mark'), exclude='mark')[0])
+        self.index.remove('mark')
+        self.assertNotIn('mark', self.index)
+        self.assertEqual(2, len(self.index))
+        self.assertEqual('bill', self.index.nearest(self.index.get('mike'), exclude='mike')[0])
+
+    def test_concurrent_queries(self):
+        # GIVEN
+        rnd = random.Random(1)
+        errors = []
+        done = threading.Event()
+
+        def writer():
+            try:
+                while not done.is_set():
+                    key = rnd.randrange(200)
+                    if rnd.random() < 0.5:
+                        self.index.update(key, GeoPoint(rnd.uniform(-90, 90), rnd.uniform(-180, 180)))
+                    else:
+                        self.index.remove(key)
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        # WHEN
+        try:
+            point = self.index.get('mike')
+            deadline = time.time() + 0.5
+            while time.time() < deadline:
+                self.index.within(point, 20000)
+                self.index.nearest(point, exclude='mike')
+        finally:
+            done.set()
+            thread.join()
+        # THEN
+        self.assertListEqual([], errors)
+
+
+class MessageTemplateTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.id = 876
+        self.client.name = 'Mike'
+        self.client.connections = 3
+        self.client.location = LOCATION_MIKE
+
+    def test_compile(self):
+        template = MessageTemplate('^7$name ^3from ^7$city ^3(^7$country^3) connected ')
+        self.assertEqual('^7%(name)s ^3from ^7%(city)s ^3(^7%(country)s^3) connected', template.text)
+        self.assertListEqual(['city', 'country', 'name'], [x[0] for x in template.variables])
+
+    def test_render(self):
+        template = MessageTemplate('^7$name ^3is using ^7$isp ^3as isp')
+        self.assertEqual('^7Mike ^3is using ^7Fastweb ^3as isp', template.render(self.client, self.client.location))
+
+    def test_render_without_location(self):
+        self.client.location = None
+        template = MessageTemplate('^7$name ^3is connected from ^7$city')
+        self.assertEqual('^7Mike ^3is connected from ^7--', template.render(self.client, self.client.location))
+
+    def test_render_extra_variables(self):
+        template = MessageTemplate('^7$name ^3is ^7$distance ^3km away from you')
+        self.assertEqual('^7Mike ^3is ^710.5 ^3km away from you', template.render(self.client, self.client.location, distance=10.5))
+        self.assertEqual('^7Mike ^3is ^7-- ^3km away from you', template.render(self.client, self.client.location))
+
+    def test_render_only_used_variables(self):
+        client = Mock(spec=['name', 'location'])
+        client.name = 'Mike'
+        client.location = LOCATION_MIKE
+        template = MessageTemplate('^7$name ^3from ^7$city')
+        self.assertEqual('^7Mike ^3from ^7Rome', template.render(client, client.location))
+
+
+class WorkerPoolTestCase(unittest2.TestCase):
+
+    def test_policy_drop(self):
+        pool = WorkerPool(Mock(), 1, size=1, policy='drop')
+        self.assertTrue(pool.submit(Mock(name='first')))
+        self.assertFalse(pool.submit(Mock(name='second')))
+        self.assertEqual(1, pool.dropped)
+        self.assertEqual('first', pool.queue.get_nowait()[0]._mock_name)
+
+    def test_policy_oldest(self):
+        pool = WorkerPool(Mock(), 1, size=1, policy='oldest')
+        self.assertTrue(pool.submit(Mock(name='first')))
+        self.assertTrue(pool.submit(Mock(name='second')))
+        self.assertEqual(1, pool.dropped)
+        self.assertEqual('second', pool.queue.get_nowait()[0]._mock_name)
+
+    def test_exception_in_task(self):
+        plugin = Mock()
+        pool = WorkerPool(plugin, 1)
+        pool.start()
+        task = Mock()
+        pool.submit(Mock(side_effect=ValueError('boom')))
+        pool.submit(task, 1, foo='bar')
+        pool.stop()
+        self.assertTrue(plugin.error.called)
+        task.assert_called_once_with(1, foo='bar')
+
+
+class MetricsTestCase(unittest2.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertListEqual([1, 2, 1, 1], histogram.counts)
+        self.assertEqual(5, histogram.count)
+        self.assertAlmostEqual(3.3, histogram.average())
+        self.assertAlmostEqual(1.75, histogram.quantile(0.5))  # interpolated inside the (1, 2] bucket
+        self.assertEqual(10, histogram.quantile(1))
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_counters(self):
+        self.metrics.increment('commands', command='locate')
+        self.metrics.increment('commands', 2, command='locate')
+        self.metrics.increment('commands', command='isp')
+        self.assertEqual(3, self.metrics.counter('commands', command='locate'))
+        self.assertEqual(0, self.metrics.counter('commands', command='distance'))
+
+    def test_timer(self):
+        with self.metrics.timer('elapsed', command='locate'):
+            pass
+        self.assertEqual(1, self.metrics.histogram('elapsed', command='locate').count)
+        self.assertIsNone(self.metrics.histogram('elapsed', command='isp'))
+
+    def test_format_prometheus(self):
+        self.metrics.increment('commands_total', command='locate')
+        self.metrics.gauge('queue_size', 3)
+        self.metrics.observe('elapsed_seconds', 0.5, buckets=(1,))
+        self.assertEqual(dedent('''\
+            # TYPE commands_total counter
+            commands_total{command="locate"} 1
+            # TYPE queue_size gauge
+            queue_size 3
+            # TYPE elapsed_seconds histogram
+            elapsed_seconds_bucket{le="1"} 1
+            elapsed_seconds_bucket{le="+Inf"} 1
+            elapsed_seconds_sum 0.5
+            elapsed_seconds_count 1
+        '''), format_prometheus(self.metrics.snapshot()))
+
+    def test_statsd_exporter(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        self.addCleanup(listener.close)
+        exporter = StatsdExporter('127.0.0.1', listener.getsockname()[1])
+        self.addCleanup(exporter.close)
+        self.metrics.increment('commands_total', 2, command='locate')
+        self.metrics.gauge('queue_size', 3)
+        self.metrics.observe('elapsed_seconds', 0.25)
+        exporter.export(self.metrics)
+        self.assertListEqual(['b3.location.commands_total.locate:2|c',
+                              'b3.location.queue_size:3|g',
+                              'b3.location.elapsed_seconds.count:1|c',
+                              'b3.location.elapsed_seconds.sum:250.000|c'], listener.recv(4096).split('\n'))
+        # counters are sent as increments since the previous export
+        self.metrics.increment('commands_total', command='locate')
+        exporter.export(self.metrics)
+        self.assertListEqual(['b3.location.commands_total.locate:1|c',
+                              'b3.location.queue_size:3|g'], listener.recv(4096).split('\n'))
+
+
+class BenchmarkTestCase(unittest2.TestCase):
+
+    def test_run(self):
+        from location.tests import benchmark
+        results = list(benchmark.run([50], 20))
+        self.assertSetEqual(set(['populate', 'getLocationDistance', 'getMessageVariables', 'getMessage',
+                                 'renderMessage', 'announce', 'nearest', 'matrix_row']),
+                            set([x['name'] for x in results]))
+        self.assertTrue(all([x['ops_sec'] > 0 for x in results]))
+
+    def test_run_models(self):
+        from location.tests import benchmark
+        results = list(benchmark.run_models(50))
+        self.assertSetEqual(set(['equirectangular', 'haversine', 'vincenty', 'lookup']),
+                            set([x['model'] for x in results]))
+        self.assertSetEqual(set(['local', 'global']), set([x['pairs'] for x in results]))
+        for result in results:
+            if result['model'] == 'vincenty':
+                self.assertEqual(0, result['max_error'])
+            elif result['model'] in ('haversine', 'lookup'):
+                self.assertLess(result['max_relative_error'], 0.6)
+
+    def test_run_startup(self):
+        from location.tests import benchmark
+        results = benchmark.run_startup(1)
+        self.assertEqual(1, len(results))
+        for phase in ('import', 'init', 'onLoadConfig', 'onStartup'):
+            self.assertGreater(results[0][phase], 0)
+        self.assertFalse(results[0]['numpy'])
+        self.assertFalse(results[0]['store'])
+
+    def test_compare(self):
+        from location.tests import benchmark
+        baseline = [{'size': 10, 'name': 'announce', 'ops_sec': 100.0},
+                    {'size': 10, 'name': 'nearest', 'ops_sec': 100.0}]
+        results = [{'size': 10, 'name': 'announce', 'ops_sec': 70.0},
+                   {'size': 10, 'name': 'nearest', 'ops_sec': 90.0}]
+        self.assertListEqual([(10, 'announce', 100.0, 70.0)], benchmark.compare(results, baseline, 0.2))
+
+
+class ReplayTestCase(unittest2.TestCase):
+
+    def test_generate_storm(self):
+        from location.tests import replay
+        events = replay.generate_storm(20, seed=3, window=10, commands=1)
+        self.assertListEqual(events, replay.generate_storm(20, seed=3, window=10, commands=1))
+        self.assertListEqual(sorted(events, key=lambda x: x['t']), events)
+        counts = dict((kind, len([x for x in events if x['type'] == kind]))
+                      for kind in ('connect', 'geolocation', 'disconnect', 'say'))
+        self.assertDictEqual({'connect': 40, 'geolocation': 40, 'disconnect': 20, 'say': 20}, counts)
+
+    def test_save_load(self):
+        from location.tests import replay
+        events = replay.generate_storm(10)
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        try:
+            replay.save_stream(events, path)
+            self.assertListEqual(events, replay.load_stream(path))
+        finally:
+            os.unlink(path)
+
+    def test_replay(self):
+        from location.tests import replay
+        events = replay.generate_storm(20, window=5, commands=0)
+        results = replay.replay(events)
+        self.assertSetEqual(set(['connect', 'geolocation', 'disconnect']), set(results['events']))
+        self.assertEqual(40, results['events']['geolocation']['count'])
+        # one announcement for every geolocation
+        self.assertEqual(40, results['rcon']['say'])
+        self.assertEqual(40, results['rcon']['total'])
+        self.assertGreater(results['events_sec'], 0)
+
+    def test_replay_announce_window(self):
+        from location.tests import replay
+        events = replay.generate_storm(20, window=5, commands=0)
+        results = replay.replay(events, {'announce_window': 60, 'workers': 2})
+        # everything replayed within the window: announcements merged
+        self.assertLess(results['rcon']['say'], 40)
+        self.assertGreater(results['rcon']['say'], 0)
+        # announcements complete when the window is flushed, not when the handler returns
+        completion = results['completion']['geolocation']
+        self.assertEqual(40, completion['count'])
+        self.assertEqual(0, completion['incomplete'])
+        self.assertGreater(completion['avg'], results['events']['geolocation']['avg'])
+
+    def test_replay_dropped_tasks(self):
+        from location.tests import replay
+        events = replay.generate_storm(20, window=5, commands=0)
+        results = replay.replay(events, {'workers': 1, 'queue_size': 1})
+        # handlers return in any case, tasks dropped by the worker queue never complete
+        completion = results['completion']['geolocation']
+        self.assertEqual(40, results['events']['geolocation']['count'])
+        self.assertEqual(40, completion['count'] + completion['incomplete'])
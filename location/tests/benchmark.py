@@ -0,0 +1,384 @@
+# coding=utf-8
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Benchmarks for the location plugin hot paths.
+
+Synthetic rosters of clients with random coordinates are loaded in a plugin
+instance created with the same fake console used by the test suite, so the
+benchmarks run offline. Results can be saved and compared with a previous run
+to detect regressions.
+
+USAGE:
+    python -m location.tests.benchmark [--sizes 1000,10000,100000] [--ops 10000] [--seed 1]
+                                       [--output results.json] [--compare baseline.json] [--threshold 0.2]
+    python -m location.tests.benchmark --models [--ops 10000] [--seed 1]
+    python -m location.tests.benchmark --startup [--runs 5]
+"""
+
+import gc
+import json
+import logging
+import math
+import optparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOCATIONS = [
+    ('Italy', 'IT', 'Lazio', '07', 'Rome', 'Fastweb', 'Europe/Rome'),
+    ('Italy', 'IT', 'Lombardia', '09', 'Milan', 'Telecom Italia', 'Europe/Rome'),
+    ('United States', 'US', 'California', 'CA', 'Mountain View', 'Google Inc.', 'America/Los_Angeles'),
+    ('United States', 'US', 'New York', 'NY', 'New York', 'Comcast', 'America/New_York'),
+    ('Germany', 'DE', 'Berlin', '16', 'Berlin', 'Deutsche Telekom AG', 'Europe/Berlin'),
+    ('France', 'FR', 'Ile-de-France', 'A8', 'Paris', 'Orange', 'Europe/Paris'),
+    ('Brazil', 'BR', 'Sao Paulo', '27', 'Sao Paulo', 'Vivo', 'America/Sao_Paulo'),
+    ('Japan', 'JP', 'Tokyo', '40', 'Tokyo', 'NTT', 'Asia/Tokyo'),
+]
+
+
+class SyntheticLocation(object):
+    """
+    Lightweight replacement of the location objects attached by the geolocation plugin.
+    """
+    __slots__ = ('country', 'cc', 'region', 'rc', 'city', 'isp', 'timezone', 'lat', 'lon', 'zipcode')
+
+    def __init__(self, rnd):
+        # fresh copies of the strings, like the ones built out of every geolocation plugin result
+        self.country, self.cc, self.region, self.rc, self.city, self.isp, self.timezone = \
+            [x[:1] + x[1:] for x in rnd.choice(LOCATIONS)]
+        self.lat = math.degrees(math.asin(rnd.uniform(-1, 1)))  # uniformly distributed on the sphere
+        self.lon = rnd.uniform(-180, 180)
+        self.zipcode = '%05d' % rnd.randint(0, 99999)
+
+
+class SyntheticClient(object):
+    """
+    Lightweight replacement of b3.clients.Client objects.
+    """
+    __slots__ = ('cid', 'id', 'name', 'guid', 'ip', 'connections', 'connected', 'location')
+
+    def __init__(self, cid, rnd):
+        self.cid = str(cid)
+        self.id = cid
+        self.name = 'Player%s' % cid
+        self.guid = 'GUID%032d' % cid
+        self.ip = '10.%s.%s.%s' % (cid >> 16 & 255, cid >> 8 & 255, cid & 255)
+        self.connections = rnd.randint(1, 100)
+        self.connected = True
+        self.location = SyntheticLocation(rnd)
+
+
+def generate_roster(size, seed=1):
+    """
+    Return a list of synthetic clients with random locations
+    :param size: The number of clients
+    :param seed: The random generator seed (the same seed always produces the same roster)
+    """
+    rnd = random.Random(seed)
+    return [SyntheticClient(cid, rnd) for cid in xrange(size)]
+
+
+def create_plugin():
+    """
+    Return a LocationPlugin instance loaded on the fake console used by the test suite
+    """
+    from location.tests import LocationTestCase
+    from location.tests import logging_disabled
+    case = LocationTestCase('setUp')
+    with logging_disabled():
+        case.setUp()
+    logging.getLogger('output').setLevel(logging.CRITICAL)
+    return case.p
+
+
+def measure(func, args):
+    """
+    Call the given function once for every item of args and measure it
+    :param func: The function to benchmark
+    :param args: A list of argument tuples
+    :return: dict with ops, seconds, ops_sec, allocated (peak bytes, None if tracemalloc is not available) and
+             objects (number of objects tracked by the garbage collector left allocated by the benchmark)
+    """
+    gc.collect()
+    objects = len(gc.get_objects())
+    allocated = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = default_timer()
+    for x in args:
+        func(*x)
+    seconds = default_timer() - start
+    if tracemalloc is not None:
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    gc.collect()
+    return {
+        'ops': len(args),
+        'seconds': seconds,
+        'ops_sec': len(args) / seconds if seconds else float('inf'),
+        'allocated': allocated,
+        'objects': len(gc.get_objects()) - objects,
+    }
+
+
+def run(sizes, ops, seed=1):
+    """
+    Run all the benchmarks, yielding results as soon as they are available
+    :param sizes: The list of roster sizes to benchmark
+    :param ops: The number of operations measured by each benchmark
+    :param seed: The random generator seed
+    :return: generator of result dicts (each one having keys size and name in addition to the measure() ones)
+    """
+    for size in sizes:
+        plugin = create_plugin()
+        plugin.console.say = lambda *args: None
+        plugin.console.upTime = lambda: 1000
+        rnd = random.Random(seed)
+        clients = generate_roster(size, seed)
+        sample = [(rnd.choice(clients),) for _ in xrange(ops)]
+        pairs = [(rnd.choice(clients), rnd.choice(clients)) for _ in xrange(ops)]
+        events = [(plugin.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=x[0]),) for x in sample]
+
+        benchmarks = [
+            ('populate', plugin.updateClientLocation, [(x,) for x in clients]),
+            ('getLocationDistance', plugin.getLocationDistance, pairs),
+            ('getMessageVariables', plugin.getMessageVariables, sample),
+            ('getMessage', lambda x: plugin.getMessage('cmd_locate', plugin.getMessageVariables(x)), sample),
+            ('renderMessage', lambda x: plugin.renderMessage('cmd_locate', x), sample),
+            ('announce', plugin.onGeolocalization, events),
+            ('nearest', lambda x: plugin._index.nearest(plugin.getGeoPoint(x), exclude=x.cid), sample[:1000]),
+            ('matrix_row', lambda x: plugin._matrix.distances(x.cid), sample[:100]),
+        ]
+
+        for name, func, args in benchmarks:
+            result = measure(func, args)
+            result['size'] = size
+            result['name'] = name
+            yield result
+
+        plugin.onDisable()
+
+
+def generate_pairs(count, seed=1, spread=None):
+    """
+    Return a list of random GeoPoint pairs
+    :param count: The number of pairs
+    :param seed: The random generator seed
+    :param spread: The maximum coordinates difference (in degrees) between the points of a pair (None = anywhere)
+    """
+    from location.geo import GeoPoint
+    rnd = random.Random(seed)
+    pairs = []
+    for _ in xrange(count):
+        lat = math.degrees(math.asin(rnd.uniform(-1, 1)))
+        lon = rnd.uniform(-180, 180)
+        if spread is None:
+            other = GeoPoint(math.degrees(math.asin(rnd.uniform(-1, 1))), rnd.uniform(-180, 180))
+        else:
+            other = GeoPoint(max(-90, min(90, lat + rnd.uniform(-spread, spread))),
+                             (lon + rnd.uniform(-spread, spread) + 180) % 360 - 180)
+        pairs.append((GeoPoint(lat, lon), other))
+    return pairs
+
+
+def run_models(ops, seed=1):
+    """
+    Benchmark the distance models and measure their accuracy against the WGS-84 ellipsoid (Vincenty)
+    :param ops: The number of point pairs
+    :param seed: The random generator seed
+    :return: generator of result dicts (each one having keys model, pairs, mean_error, max_error (in Km) and
+             max_relative_error (in %) in addition to the measure() ones)
+    """
+    from location.geo import DISTANCE_MODELS
+    from location.geo import distance_vincenty
+    for pairs, spread in (('local', 3), ('global', None)):
+        sample = generate_pairs(ops, seed, spread)
+        reference = [distance_vincenty(p1, p2) for p1, p2 in sample]
+        for name in sorted(DISTANCE_MODELS):
+            model = DISTANCE_MODELS[name]
+            result = measure(model, sample)
+            errors = [abs(model(p1, p2) - d) for (p1, p2), d in zip(sample, reference)]
+            result['model'] = name
+            result['pairs'] = pairs
+            result['mean_error'] = sum(errors) / len(errors)
+            result['max_error'] = max(errors)
+            result['max_relative_error'] = max(e / d * 100 for e, d in zip(errors, reference) if d)
+            yield result
+
+
+# executed in a fresh interpreter: the B3 modules are imported beforehand since B3 loads them before any plugin
+STARTUP_PROBE = '''
+import b3.cron, b3.config, b3.events, b3.functions, b3.plugin, json, sys
+from timeit import default_timer
+start = default_timer()
+import location
+seconds = default_timer() - start
+from location.tests.benchmark import probe_startup
+sys.stdout.write('%s\\n' % json.dumps(probe_startup(seconds)))
+'''
+
+
+def probe_startup(seconds=None):
+    """
+    Measure the plugin startup in the current interpreter
+    :param seconds: The number of seconds spent importing the plugin package
+    :return: dict with the seconds spent in import, init, onLoadConfig and onStartup, and whether numpy and the
+             persistent store have been loaded during startup
+    """
+    from b3.config import CfgConfigParser
+    import location
+
+    logging.getLogger('output').addHandler(logging.NullHandler())
+    result = {'import': seconds}
+
+    from location.tests import LocationTestCase
+    from location.tests import logging_disabled
+    case = LocationTestCase('setUp')
+    with logging_disabled():
+        case.setUp()
+    logging.getLogger('output').setLevel(logging.CRITICAL)
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conf = CfgConfigParser()
+        conf.load(os.path.join(os.path.dirname(location.__file__), 'conf', 'plugin_location.ini'))
+        conf.set('settings', 'cache_file', path)
+        start = default_timer()
+        plugin = location.LocationPlugin(case.console, conf)
+        result['init'] = default_timer() - start
+        start = default_timer()
+        plugin.onLoadConfig()
+        result['onLoadConfig'] = default_timer() - start
+        start = default_timer()
+        plugin.onStartup()
+        result['onStartup'] = default_timer() - start
+        result['numpy'] = 'numpy' in sys.modules
+        result['store'] = plugin._store is not None and plugin._store.connected
+        plugin.onDisable()
+    finally:
+        os.unlink(path)
+    return result
+
+
+def run_startup(runs):
+    """
+    Measure the plugin startup in fresh interpreters
+    :param runs: The number of interpreters to start
+    :return: list of probe_startup() result dicts
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [x for x in [env.get('PYTHONPATH')] if x])
+    results = []
+    for _ in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_PROBE], env=env)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a previous run
+    :param results: The list of results of the current run
+    :param baseline: The list of results of the previous run
+    :param threshold: The maximum allowed relative slowdown (i.e: 0.2 = 20% less ops/sec)
+    :return: list of (size, name, baseline ops/sec, current ops/sec) tuples for each regression
+    """
+    previous = dict(((x['size'], x['name']), x['ops_sec']) for x in baseline)
+    regressions = []
+    for result in results:
+        before = previous.get((result['size'], result['name']))
+        if before and result['ops_sec'] < before * (1 - threshold):
+            regressions.append((result['size'], result['name'], before, result['ops_sec']))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m location.tests.benchmark [options]')
+    parser.add_option('--sizes', default='1000,10000,100000', help='comma separated roster sizes')
+    parser.add_option('--ops', type='int', default=10000, help='number of operations per benchmark')
+    parser.add_option('--seed', type='int', default=1, help='random generator seed')
+    parser.add_option('--output', help='save results to this JSON file')
+    parser.add_option('--compare', help='compare results with this JSON file')
+    parser.add_option('--threshold', type='float', default=0.2, help='relative slowdown reported as regression')
+    parser.add_option('--models', action='store_true', help='benchmark distance models and report their accuracy')
+    parser.add_option('--startup', action='store_true', help='measure the plugin import and startup time')
+    parser.add_option('--runs', type='int', default=5, help='number of fresh interpreters used by --startup')
+    options, _ = parser.parse_args(argv)
+
+    if options.startup:
+        results = run_startup(options.runs)
+        sys.stdout.write('%-14s %12s %12s\n' % ('phase', 'median (ms)', 'max (ms)'))
+        for phase in ('import', 'init', 'onLoadConfig', 'onStartup'):
+            values = sorted(x[phase] for x in results)
+            sys.stdout.write('%-14s %12.3f %12.3f\n' % (phase, values[len(values) // 2] * 1000, values[-1] * 1000))
+        for subsystem in ('numpy', 'store'):
+            loaded = len([x for x in results if x[subsystem]])
+            sys.stdout.write('%s loaded during startup: %s/%s runs\n' % (subsystem, loaded, len(results)))
+        return 0
+
+    if options.models:
+        sys.stdout.write('%-8s %-16s %14s %16s %16s %12s\n' % ('pairs', 'model', 'ops/sec', 'mean err (km)',
+                                                              'max err (km)', 'max err (%)'))
+        for result in run_models(options.ops, options.seed):
+            sys.stdout.write('%-8s %-16s %14.1f %16.4f %16.4f %12.4f\n' % (result['pairs'], result['model'],
+                                                                        result['ops_sec'], result['mean_error'],
+                                                                        result['max_error'],
+                                                                        result['max_relative_error']))
+        return 0
+
+    sizes = [int(x) for x in options.sizes.split(',') if x.strip()]
+    sys.stdout.write('%8s  %-20s %8s %10s %14s %12s %10s\n' % ('size', 'benchmark', 'ops', 'seconds', 'ops/sec',
+                                                               'alloc (KB)', 'objects'))
+    results = []
+    for result in run(sizes, options.ops, options.seed):
+        results.append(result)
+        allocated = '%.1f' % (result['allocated'] / 1024.0) if result['allocated'] is not None else 'n/a'
+        sys.stdout.write('%8d  %-20s %8d %10.4f %14.1f %12s %10d\n' % (result['size'], result['name'], result['ops'],
+                                                                       result['seconds'], result['ops_sec'],
+                                                                       allocated, result['objects']))
+        sys.stdout.flush()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        for size, name, before, after in regressions:
+            sys.stdout.write('REGRESSION: %s (size %s): %.1f -> %.1f ops/sec\n' % (name, size, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,472 @@
+# coding=utf-8
+#
+# Location Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2013 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Replay harness for connect storms.
+
+A stream of client events (connect, geolocation, disconnect and chat
+commands), either recorded or synthetic, is replayed against a plugin
+instance loaded on the same fake console used by the test suite, so the
+replay runs offline. For every event type the harness reports the latency of
+the event handlers and, separately, the end-to-end latency until all the work
+triggered by the event is done (tasks executed by the worker threads, commands
+put aside by load shedding and coalesced connect announcements). For the whole
+replay it reports the number of RCON commands the plugin would have sent to the
+game server and the peak memory growth.
+
+Streams are stored as JSON lines, one event per line:
+
+    {"t": 3.25, "type": "connect", "cid": "7", "name": "Player7", "guid": "GUID...", "ip": "10.0.0.7"}
+    {"t": 4.02, "type": "geolocation", "cid": "7", "location": {"country": "Italy", "cc": "IT", ...}}
+    {"t": 9.50, "type": "say", "cid": "7", "text": "!locate Player12"}
+    {"t": 12.0, "type": "disconnect", "cid": "7"}
+
+where t is the number of seconds since the beginning of the stream.
+
+USAGE:
+    python -m location.tests.replay [--players 200] [--seed 1] [--window 30] [--commands 0.2]
+                                    [--input storm.jsonl] [--save storm.jsonl] [--speed 0]
+                                    [--set workers=4 --set load_shedding=yes ...] [--output results.json]
+"""
+
+import gc
+import json
+import optparse
+import random
+import resource
+import sys
+import threading
+import time
+
+from timeit import default_timer
+from location.tests.benchmark import SyntheticLocation
+from location.tests.benchmark import create_plugin
+
+COMMANDS = ['!locate %s', '!distance %s', '!isp %s', '!nearest', '!nearby 1000', '!geostats']
+
+LOCATION_FIELDS = ('country', 'cc', 'region', 'rc', 'city', 'isp', 'timezone', 'lat', 'lon', 'zipcode')
+
+
+def generate_storm(players=200, seed=1, window=30, commands=0.2):
+    """
+    Return a synthetic reconnect burst: a full server whose players all drop within a couple of seconds (i.e: a
+    game server restart) and come back within the given window, each one geolocated shortly after connecting
+    :param players: The number of players
+    :param seed: The random generator seed (the same seed always produces the same stream)
+    :param window: The number of seconds players reconnect within
+    :param commands: The fraction of players issuing a command after reconnecting
+    :return: list of event dicts sorted by time
+    """
+    rnd = random.Random(seed)
+    events = []
+    for i in xrange(players):
+        cid = str(i)
+        name = 'Player%s' % i
+        location = SyntheticLocation(rnd)
+        location = dict((x, getattr(location, x)) for x in LOCATION_FIELDS)
+        connect = {'type': 'connect', 'cid': cid, 'name': name, 'guid': 'GUID%032d' % i,
+                   'ip': '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255)}
+        # initial roster
+        events.append(dict(connect, t=0.0))
+        events.append({'t': 0.0, 'type': 'geolocation', 'cid': cid, 'location': location})
+        # burst
+        dropped = rnd.uniform(1, 3)
+        back = dropped + rnd.uniform(0, window)
+        events.append({'t': dropped, 'type': 'disconnect', 'cid': cid})
+        events.append(dict(connect, t=back))
+        events.append({'t': back + rnd.uniform(0.2, 2), 'type': 'geolocation', 'cid': cid, 'location': location})
+        if rnd.random() < commands:
+            command = rnd.choice(COMMANDS)
+            if '%s' in command:
+                command %= 'Player%s' % rnd.randrange(players)
+            events.append({'t': back + rnd.uniform(2, 10), 'type': 'say', 'cid': cid, 'text': command})
+    events.sort(key=lambda x: x['t'])
+    return events
+
+
+def load_stream(path):
+    """
+    Load a stream of events from a JSON lines file
+    :param path: The path of the file
+    :return: list of event dicts sorted by time
+    """
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events.sort(key=lambda x: x['t'])
+    return events
+
+
+def save_stream(events, path):
+    """
+    Save a stream of events to a JSON lines file
+    :param events: The list of event dicts
+    :param path: The path of the file
+    """
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+class ReplayLocation(object):
+    """
+    Location object attached to clients by replayed geolocation events.
+    """
+    __slots__ = LOCATION_FIELDS
+
+    def __init__(self, values):
+        for field in LOCATION_FIELDS:
+            setattr(self, field, values.get(field))
+
+
+class NullOutput(object):
+    """
+    Swallow the output printed by the fake console and fake clients.
+    """
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class RconCounter(object):
+    """
+    Count the lines that would be sent to the game server (every line is an RCON command):
+    server messages are wrapped according to the console line length, like B3 parsers do.
+    """
+    def __init__(self, console):
+        self.console = console
+        self.lines = {'say': 0, 'saybig': 0, 'message': 0, 'write': 0}
+
+    def count(self, kind, text):
+        self.lines[kind] += len(self.console.getWrap(text)) if kind in ('say', 'message') else 1
+
+    def install(self):
+        self.console.say = lambda msg, *args: self.count('say', msg % args if args else msg)
+        self.console.saybig = lambda msg, *args: self.count('saybig', msg % args if args else msg)
+        self.console.write = lambda msg, *args, **kwargs: self.count('write', msg)
+
+    def attach(self, client):
+        client.message = lambda msg, *args: self.count('message', msg % args if args else msg)
+
+    @property
+    def total(self):
+        return sum(self.lines.itervalues())
+
+
+class CompletionTracker(object):
+    """
+    Track when the work triggered by every replayed event is done: event handlers hand work over to the worker
+    threads, put commands aside while the load is critical and queue connect announcements, so an event is
+    complete only when all of them have been executed (or sent to the game server).
+    """
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.tokens = []
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def begin(self, kind):
+        """
+        Start tracking the event being handled by the current thread
+        """
+        token = {'kind': kind, 'start': default_timer(), 'end': None, 'pending': 1}
+        self.tokens.append(token)
+        self._local.token = token
+        return token
+
+    def end(self, token):
+        """
+        Mark the synchronous part of the event handling as done
+        """
+        self._local.token = None
+        self.done(token)
+
+    def done(self, token):
+        """
+        Mark one of the parts of the given event as done
+        """
+        with self._lock:
+            token['pending'] -= 1
+            token['end'] = max(token['end'] or 0, default_timer())
+
+    def track(self, func):
+        """
+        Wrap a task handed over by the event being handled so that its completion is tracked
+        """
+        token = getattr(self._local, 'token', None)
+        if token is None or getattr(func, 'tracked', False):
+            # tasks put aside are tracked on behalf of the event which deferred them
+            return func
+        with self._lock:
+            token['pending'] += 1
+
+        def tracked(*args, **kwargs):
+            previous = getattr(self._local, 'token', None)
+            self._local.token = token
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.token = previous
+                self.done(token)
+
+        tracked.tracked = True
+        tracked.__name__ = getattr(func, '__name__', 'task')
+        return tracked
+
+    def watch(self, announcer):
+        """
+        Track the connect announcements queued in the given announcer: they are complete once sent (or discarded
+        because the client disconnected in the meantime)
+        """
+        announcing = {}
+        push = announcer.push
+        flush = announcer.flush
+
+        def tracked_push(client):
+            with self._lock:
+                token = getattr(self._local, 'token', None)
+                if token is not None:
+                    token['pending'] += 1
+                    announcing.setdefault(id(client), []).append(token)
+                push(client)
+
+        def tracked_flush():
+            flush()
+            with self._lock:
+                with announcer._lock:
+                    queued = set(id(x) for x in announcer._pending)
+                for key in [x for x in announcing if x not in queued]:
+                    for token in announcing.pop(key):
+                        self.done(token)
+
+        announcer.push = tracked_push
+        announcer.flush = tracked_flush
+
+    def install(self):
+        plugin = self.plugin
+        dispatch = plugin.dispatch
+        defer = plugin.deferCommand
+        plugin.dispatch = lambda func, *args, **kwargs: dispatch(self.track(func), *args, **kwargs)
+        plugin.deferCommand = lambda func, data, client, cmd: defer(self.track(func), data, client, cmd)
+        for announcer in (plugin._announcer, plugin._shed_announcer):
+            if announcer is not None:
+                self.watch(announcer)
+
+
+def percentile(values, q):
+    """
+    Return the given percentile of a sorted list of values (nearest rank)
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(values):
+    """
+    Return count, average, median, 95th percentile and maximum of the given list of latencies
+    """
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'avg': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'max': values[-1] if values else None,
+    }
+
+
+def peak_memory():
+    """
+    Return the peak resident memory of the current process (in KB)
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 if sys.platform == 'darwin' else usage
+
+
+def replay(events, settings=None, speed=0):
+    """
+    Replay a stream of events against a plugin instance loaded on the fake console used by the test suite
+    :param events: The list of event dicts sorted by time
+    :param settings: dict of plugin [settings] values overriding the test configuration (i.e: workers=4)
+    :param speed: Replay speed (1 = as recorded, 2 = twice as fast, ...; 0 = as fast as possible)
+    :return: dict with keys events (count, avg, p50, p95, max handler latency in seconds by event type),
+             completion (count, avg, p50, p95, max end-to-end latency in seconds and the number of incomplete
+             events, i.e. whose tasks were dropped, by event type), rcon (lines by kind and total), seconds,
+             events_sec, drain (seconds spent waiting for worker threads after the last event) and peak_memory
+             (peak resident memory growth in KB)
+    """
+    from b3.fake import FakeClient
+
+    plugin = create_plugin()
+    console = plugin.console
+    for name, value in (settings or {}).iteritems():
+        plugin.config.set('settings', name, str(value))
+    plugin.onLoadConfig()
+
+    def handle(event):
+        # same as the fake console, minus the 1ms sleep after every handler
+        for handler in console._handlers.get(event.type, []):
+            if handler.isEnabled():
+                handler.parseEvent(event)
+
+    console.queueEvent = lambda event, expire=10: handle(event)
+    counter = RconCounter(console)
+    counter.install()
+    tracker = CompletionTracker(plugin)
+    tracker.install()
+    clients = {}
+    latencies = {}
+
+    gc.collect()
+    memory = peak_memory()
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    start = default_timer()
+    try:
+        for event in events:
+            if speed > 0:
+                delay = start + event['t'] / speed - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+            kind = event['type']
+            token = tracker.begin(kind)
+            begin = token['start']
+            if kind == 'connect':
+                client = clients.get(event['cid'])
+                if client is None:
+                    client = clients[event['cid']] = FakeClient(console=console, name=event['name'],
+                                                                guid=event.get('guid'), groupBits=1)
+                    client.ip = event.get('ip')
+                    counter.attach(client)
+                client.connected = True
+                client.location = None
+                client.connects(event['cid'])
+            elif kind == 'geolocation':
+                client = clients[event['cid']]
+                client.location = ReplayLocation(event['location'])
+                handle(console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=client))
+            elif kind == 'disconnect':
+                clients[event['cid']].disconnects()
+            elif kind == 'say':
+                clients[event['cid']].says(event['text'])
+            else:
+                raise ValueError('invalid event type: %s' % kind)
+            latencies.setdefault(kind, []).append(default_timer() - begin)
+            tracker.end(token)
+        seconds = default_timer() - start
+        begin = default_timer()
+        if plugin._pool:
+            plugin._pool.join()
+        drain = default_timer() - begin
+        # announcements still waiting for their window would be sent anyway (with speed 0 the replay ends before
+        # any window expires, so coalesced announcements complete here)
+        for announcer in (plugin._announcer, plugin._shed_announcer):
+            if announcer is not None:
+                announcer.flush()
+    finally:
+        sys.stdout = stdout
+        plugin.onDisable()
+
+    results = {}
+    for kind, values in latencies.iteritems():
+        results[kind] = summarize(values)
+
+    completion = {}
+    for token in tracker.tokens:
+        completion.setdefault(token['kind'], []).append(token)
+    for kind, tokens in completion.iteritems():
+        values = [x['end'] - x['start'] for x in tokens if x['pending'] <= 0]
+        completion[kind] = dict(summarize(values), incomplete=len(tokens) - len(values))
+
+    return {
+        'events': results,
+        'completion': completion,
+        'rcon': dict(counter.lines, total=counter.total),
+        'seconds': seconds,
+        'events_sec': len(events) / seconds if seconds else float('inf'),
+        'drain': drain,
+        'peak_memory': peak_memory() - memory,
+    }
+
+
+def write_table(title, rows):
+    """
+    Print a latency table (one row per event type)
+    """
+    incomplete = any('incomplete' in x for x in rows.itervalues())
+    sys.stdout.write('%s\n' % title)
+    sys.stdout.write('%-12s %8s %10s %10s %10s %10s' % ('event', 'count', 'avg (ms)', 'p50 (ms)', 'p95 (ms)',
+                                                      'max (ms)'))
+    sys.stdout.write(' %10s\n' % 'incomplete' if incomplete else '\n')
+    for kind in ('connect', 'geolocation', 'say', 'disconnect'):
+        x = rows.get(kind)
+        if x is None:
+            continue
+        if x['count']:
+            sys.stdout.write('%-12s %8d %10.3f %10.3f %10.3f %10.3f' % (kind, x['count'], x['avg'] * 1000,
+                                                                      x['p50'] * 1000, x['p95'] * 1000,
+                                                                      x['max'] * 1000))
+        else:
+            sys.stdout.write('%-12s %8d %10s %10s %10s %10s' % (kind, 0, '-', '-', '-', '-'))
+        sys.stdout.write(' %10d\n' % x['incomplete'] if incomplete else '\n')
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m location.tests.replay [options]')
+    parser.add_option('--players', type='int', default=200, help='number of players of the synthetic burst')
+    parser.add_option('--seed', type='int', default=1, help='random generator seed')
+    parser.add_option('--window', type='float', default=30, help='number of seconds players reconnect within')
+    parser.add_option('--commands', type='float', default=0.2, help='fraction of players issuing a command')
+    parser.add_option('--input', help='replay the events recorded in this JSON lines file')
+    parser.add_option('--save', help='save the replayed events to this JSON lines file')
+    parser.add_option('--speed', type='float', default=0, help='replay speed (1 = as recorded, 0 = no waits)')
+    parser.add_option('--set', action='append', default=[], metavar='NAME=VALUE',
+                      help='override a plugin setting (i.e: workers=4), can be repeated')
+    parser.add_option('--output', help='save results to this JSON file')
+    options, _ = parser.parse_args(argv)
+
+    if options.input:
+        events = load_stream(options.input)
+    else:
+        events = generate_storm(options.players, options.seed, options.window, options.commands)
+    if options.save:
+        save_stream(events, options.save)
+
+    settings = dict(x.split('=', 1) for x in options.set)
+    results = replay(events, settings, options.speed)
+
+    write_table('handler latency', results['events'])
+    write_table('end-to-end latency', results['completion'])
+    rcon = results['rcon']
+    sys.stdout.write('rcon commands: %s (say %s, message %s, saybig %s, write %s)\n' % (
+                     rcon['total'], rcon['say'], rcon['message'], rcon['saybig'], rcon['write']))
+    sys.stdout.write('replayed %d events in %.3f seconds (%.1f events/sec), worker drain %.3f seconds\n' % (
+                     len(events), results['seconds'], results['events_sec'], results['drain']))
+    sys.stdout.write('peak memory growth: %s KB\n' % results['peak_memory'])
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())